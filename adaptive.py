@@ -0,0 +1,110 @@
+# This code is under MIT licence, you can find the complete file here: https://github.com/ivanovrvl/pg_tasks/blob/main/LICENSE
+"""
+Adaptive limit of the tasks running on the node (config.adaptive_task_count)
+
+AIMD by the tasks completed in each window: the limit grows by one while it is reached
+and the tasks neither slow down nor fail more, and is cut by the decrease factor when
+they fail more than allowed, run longer than the tolerance times the baseline duration
+or the throughput drops after a growth
+
+The limit starts at the initial one (max_limit by default), so the node runs as many tasks
+as configured until the tasks fail more. The baseline duration is measured at the initial limit,
+so to find the limit the host is overloaded above, start lower (config.initial_task_count).
+After a cut it ramps back by one per window.
+A window with no task completed (the tasks run longer than the window) has nothing to judge by
+but the running tasks: the limit still grows by one if it is reached and the running tasks are
+not older than the tolerance times the baseline (unknown baseline - no signal), so a node of long
+tasks ramps from min_limit to max_limit in (max_limit - min_limit) windows
+"""
+import time
+
+class AimdLimit:
+
+    def __init__(self, min_limit:int, max_limit:int, latency_tolerance:float=2.0, max_failure_rate:float=0.2, \
+        decrease:float=0.7, throughput_drop:float=0.1, baseline_drift:float=0.05, initial_limit:int=None):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.max_failure_rate = max_failure_rate
+        self.decrease = decrease
+        self.throughput_drop = throughput_drop # the part of the throughput lost after a growth to cut the limit
+        self.baseline_drift = baseline_drift # the baseline rises so much per window at most to follow the tasks mix
+        self.limit = max_limit if initial_limit is None else max(min_limit, min(max_limit, initial_limit))
+        self.baseline = None # the task duration when the node is not overloaded, s
+        self.throughput = None # tasks per second of the last window with the limit reached
+        self.increased = False # the limit was raised by the last window
+        self.last = None # (throughput, latency, failure rate) of the last window
+        self.reset(time.monotonic())
+
+    def reset(self, now:float):
+        self.started = now
+        self.completed = 0
+        self.failed = 0
+        self.latency_sum = 0.0
+        self.saturated = False
+
+    def record(self, latency:float, failed:bool):
+        """
+        The task process exited after latency seconds
+        """
+        self.completed += 1
+        self.latency_sum += latency
+        if failed:
+            self.failed += 1
+
+    def saturate(self):
+        """
+        The running tasks reached the limit
+        """
+        self.saturated = True
+
+    def update(self, now:float=None, running_age:float=None) -> bool:
+        """
+        Ends the window, returns True if the limit is changed.
+        running_age - the mean time the running tasks run so far, s (None - none running)
+        """
+        if now is None:
+            now = time.monotonic()
+        dt = now - self.started
+        if dt <= 0:
+            return False
+        if self.completed == 0:
+            # the tasks are longer than the window: grow while the running ones are not late
+            saturated = self.saturated
+            self.last = (0.0, running_age or 0.0, 0.0)
+            self.reset(now)
+            limit = self.limit
+            if saturated and (self.baseline is None or running_age is None \
+            or running_age <= self.baseline * self.latency_tolerance):
+                limit = min(self.max_limit, limit + 1)
+            return self.set_limit(limit)
+        throughput = self.completed / dt
+        latency = self.latency_sum / self.completed
+        failure_rate = self.failed / self.completed
+        saturated = self.saturated
+        self.last = (throughput, latency, failure_rate)
+        self.reset(now)
+
+        baseline = self.baseline
+        if baseline is None or latency < baseline:
+            self.baseline = latency
+        else:
+            self.baseline = min(latency, baseline * (1 + self.baseline_drift))
+
+        limit = self.limit
+        if failure_rate > self.max_failure_rate \
+        or (baseline is not None and latency > baseline * self.latency_tolerance) \
+        or (self.increased and saturated and self.throughput is not None and throughput < self.throughput * (1 - self.throughput_drop)):
+            limit = max(self.min_limit, int(limit * self.decrease))
+        elif saturated:
+            limit = min(self.max_limit, limit + 1)
+        if saturated:
+            self.throughput = throughput
+        return self.set_limit(limit)
+
+    def set_limit(self, limit:int) -> bool:
+        self.increased = limit > self.limit
+        if limit == self.limit:
+            return False
+        self.limit = limit
+        return True
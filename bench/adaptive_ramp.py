@@ -0,0 +1,68 @@
+# Adaptive task limit (adaptive.AimdLimit, config.adaptive_task_count) on simulated time
+# A node with an endless queue runs tasks of the given duration, a task runs slower when more
+# tasks than <capacity> run at once (duration * (running / capacity)^2, the throughput drops).
+# The limit is updated every window as AdaptTaskLimit does: saturated when the running tasks
+# reach it, the mean age of the running tasks passed for the windows with no task completed.
+#
+#   long  - tasks 5 windows long, capacity above max: from min_limit the limit has to reach
+#           max_limit in (max_limit - min_limit) windows though no task completes in most windows
+#   short - tasks 1/10 of the window, capacity below max, started from min_limit (initial_task_count):
+#           the limit has to stay near the capacity
+#
+# Prints the limit of each window and exits with 1 if a check fails.
+#
+# python bench/adaptive_ramp.py [<min_limit> [<max_limit> [<capacity>]]]
+
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+import adaptive
+
+min_limit = int(sys.argv[1]) if len(sys.argv) >= 2 else 1
+max_limit = int(sys.argv[2]) if len(sys.argv) >= 3 else 20
+capacity = int(sys.argv[3]) if len(sys.argv) >= 4 else 8
+window = 30.0
+step = 0.5
+
+def simulate(duration:float, capacity:int, initial_limit:int, windows:int) -> list:
+    limiter = adaptive.AimdLimit(min_limit, max_limit, initial_limit=initial_limit)
+    limiter.reset(0.0)
+    running = [] # (started, ends)
+    limits = []
+    t = 0.0
+    next_window = window
+    while len(limits) < windows:
+        for started, ends in [r for r in running if r[1] <= t]:
+            running.remove((started, ends))
+            limiter.record(t - started, False)
+        while len(running) < limiter.limit:
+            running.append((t, t + duration * max(1.0, (len(running) + 1) / capacity) ** 2))
+        if len(running) >= limiter.limit:
+            limiter.saturate()
+        t += step
+        if t >= next_window:
+            ages = [t - started for started, ends in running]
+            limiter.update(t, sum(ages) / len(ages) if ages else None)
+            limits.append(limiter.limit)
+            next_window += window
+    return limits
+
+failed = False
+
+def check(name:str, limits:list, ok:bool):
+    global failed
+    print("{}: {} {}".format(name, ' '.join(str(n) for n in limits), 'ok' if ok else 'FAILED'))
+    if not ok:
+        failed = True
+
+ramp = max_limit - min_limit
+limits = simulate(window * 5, max_limit * 2, min_limit, ramp + 5)
+check("long from min", limits, max_limit in limits[:ramp])
+limits = simulate(window * 5, max_limit * 2, None, 10)
+check("long from max", limits, min(limits) == max_limit)
+limits = simulate(window / 10, capacity, min_limit, 40)
+tail = limits[-10:]
+check("short over capacity {}".format(capacity), limits, max(tail) <= capacity * 2 and min(tail) >= min_limit)
+
+sys.exit(1 if failed else 0)
@@ -0,0 +1,89 @@
+# Claim throughput with competing nodes
+# Fills a dedicated group with waiting tasks, then lets 1..16 processes
+# claim them concurrently through long_task.start_tasks (or start_task)
+# and prints the claims per second for each number of competitors.
+#
+# python bench/claim_contention.py [<task_count> [<batch> [<group_id>]]]
+# batch=0 uses long_task.start_task (one task per call)
+
+import sys
+import json
+import time
+import multiprocessing
+import psycopg2
+
+task_count = int(sys.argv[1]) if len(sys.argv) >= 2 else 5000
+batch = int(sys.argv[2]) if len(sys.argv) >= 3 else 50
+group_id = int(sys.argv[3]) if len(sys.argv) >= 4 else -1000
+node_counts = [1, 2, 4, 8, 16]
+
+def connect():
+    with open('db_config.json', 'r') as f:
+        db_config = json.load(f)
+    conn = psycopg2.connect(host=db_config['host'], port=db_config['port'], dbname=db_config['database'], user=db_config['user'], password=db_config['password'])
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+def claim_all(worker_id, start_event, result):
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            claimed = 0
+            calls = 0
+            start_event.wait()
+            while True:
+                calls += 1
+                if batch > 0:
+                    cur.execute("SELECT id FROM long_task.start_tasks(%s,%s,%s)", (group_id, worker_id, batch))
+                    n = len(cur.fetchall())
+                else:
+                    cur.execute("SELECT long_task.start_task(%s,%s)", (group_id, worker_id))
+                    n = 0 if cur.fetchone()[0] is None else 1
+                if n == 0:
+                    break
+                claimed += n
+            result.put((claimed, calls))
+    finally:
+        conn.close()
+
+def fill(cur):
+    cur.execute("DELETE FROM long_task.task WHERE group_id=%s", (group_id,))
+    cur.execute("""
+        INSERT INTO long_task.task(group_id, state_id, priority, command)
+        SELECT %s, 'AW', i %% 10, '{/bin/true}'
+        FROM generate_series(1, %s) i
+        """, (group_id, task_count))
+
+def run(nodes:int):
+    start_event = multiprocessing.Event()
+    result = multiprocessing.Queue()
+    procs = [multiprocessing.Process(target=claim_all, args=(-1 - i, start_event, result)) for i in range(nodes)]
+    for p in procs:
+        p.start()
+    time.sleep(0.5) # let them connect
+    t = time.monotonic()
+    start_event.set()
+    stats = [result.get() for p in procs]
+    dt = time.monotonic() - t
+    for p in procs:
+        p.join()
+    claimed = sum(s[0] for s in stats)
+    calls = sum(s[1] for s in stats)
+    return claimed, calls, dt
+
+if __name__ == '__main__':
+
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            print("function:", "start_tasks(batch={})".format(batch) if batch > 0 else "start_task")
+            print("{:>6} {:>8} {:>8} {:>10} {:>12}".format("nodes", "claimed", "calls", "seconds", "claims/s"))
+            for nodes in node_counts:
+                fill(cur)
+                claimed, calls, dt = run(nodes)
+                print("{:>6} {:>8} {:>8} {:>10.3f} {:>12.1f}".format(nodes, claimed, calls, dt, claimed / dt))
+                if claimed != task_count:
+                    print("! claimed {} of {}".format(claimed, task_count))
+            cur.execute("DELETE FROM long_task.task WHERE group_id=%s", (group_id,))
+    finally:
+        conn.close()
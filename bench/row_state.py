@@ -0,0 +1,102 @@
+# Memory and refresh time of the loaded task states
+# Compares the dict layout the node used (a dict per record built from cursor.description,
+# a copy of it as the current state and a set of the changed fields) with storage.row_class()
+# (__slots__ record, the changed fields as a bit mask) for <count> tasks:
+#
+#   bytes per task   - tracemalloc of the states kept for all the tasks
+#   build            - making the states from the rows fetched (the refresh)
+#   merge            - applying a newer state with the same version to the objects having a change
+#
+# python bench/row_state.py [<count>]
+
+import os
+import sys
+import copy
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')))
+import storage
+
+count = int(sys.argv[1]) if len(sys.argv) >= 2 else 50000
+
+table_fields = ['state_id', 'worker_id', 'group_id', 'next_start', 'shed_period_id', 'shed_period_count', 'shed_enabled', 'cleanup_pending', 'last_state_change']
+TaskRow = storage.row_class('TaskRow', table_fields, ['error'])
+
+class Column:
+    def __init__(self, name):
+        self.name = name
+
+description = [Column(n) for n in ['id'] + table_fields]
+
+def fetched_rows() -> list:
+    now = datetime.now(timezone.utc)
+    return [(i, 'CS', 1, 0, datetime(2026, 1, 1), 'MIN', 5, True, False, now) for i in range(count)]
+
+class DictState:
+    """
+    The layout before row_class()
+    """
+    def __init__(self, state:dict):
+        self._old_db_state = state
+        self.db_state = copy.copy(state)
+        self.changed_fields = set()
+
+    def set_db_state(self, state:dict):
+        self._old_db_state = state
+        old = self.db_state
+        self.db_state = copy.copy(state)
+        for n in self.changed_fields:
+            self.db_state[n] = old[n]
+
+class RowState:
+
+    def __init__(self, state):
+        self._db_version = state.last_state_change
+        self.db_state = state
+        self.changed_mask = 0
+
+    def set_db_state(self, state):
+        if self.changed_mask != 0:
+            state.merge(self.db_state, self.changed_mask)
+        self._db_version = state.last_state_change
+        self.db_state = state
+
+def build_dicts(rows:list) -> list:
+    return [DictState({d.name: row[i] for i, d in enumerate(description)}) for row in rows]
+
+def build_rows(rows:list) -> list:
+    return [RowState(TaskRow(*row)) for row in rows]
+
+def change_dicts(objs:list):
+    for obj in objs:
+        obj.db_state['state_id'] = 'AW'
+        obj.changed_fields.add('state_id')
+
+def change_rows(objs:list):
+    for obj in objs:
+        obj.db_state.state_id = 'AW'
+        obj.changed_mask |= TaskRow.bits['state_id']
+
+def measure(name:str, build, change, new_state):
+    rows = fetched_rows()
+    tracemalloc.start()
+    objs = build(rows)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    t = time.perf_counter()
+    objs = build(rows)
+    build_time = time.perf_counter() - t
+    change(objs)
+    states = [new_state(row) for row in rows]
+    t = time.perf_counter()
+    for obj, state in zip(objs, states):
+        obj.set_db_state(state)
+    merge_time = time.perf_counter() - t
+    print('{:<6} {:>10.0f} {:>10.1f} {:>10.1f}'.format(name, size / count, build_time * 1000, merge_time * 1000))
+
+print('{} tasks'.format(count))
+print('{:<6} {:>10} {:>10} {:>10}'.format('layout', 'bytes/task', 'build ms', 'merge ms'))
+measure('dict', build_dicts, change_dicts, lambda row: {d.name: row[i] for i, d in enumerate(description)})
+measure('slots', build_rows, change_rows, lambda row: TaskRow(*row))
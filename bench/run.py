@@ -0,0 +1,426 @@
+# Throughput benchmark suite
+# Starts a throwaway Postgres (initdb in a temp dir, unix socket only), applies db/changelog.xml,
+# runs node.py instances and the scenarios, writes the results as JSON to compare across versions:
+#
+#   burst    - <tasks> tasks {/bin/true} queued at once, run until all completed
+#   pairs    - example/looped_task_pairs.py: <pairs> pairs of tasks restarting each other for <duration> s
+#   sched    - <sched> tasks scheduled each second (shed_period SEC) for <duration> s
+#   failover - burst of {sleep,0.2} tasks, node 1 is killed after a third of them is done,
+#              reports how long its tasks stayed executing and the overall throughput
+#
+# For each scenario and node count: throughput (tasks completed per second), queue wait
+# (AW -> AE) p50/p99 and DB statements per task (pg_stat_statements if available,
+# transactions otherwise - the nodes use autocommit).
+#
+# python bench/run.py [--nodes 1,2,4] [--slots 50] [--tasks 10000] [--pairs 10] [--sched 100]
+#                     [--duration 30] [--scenarios burst,pairs,sched,failover] [--engine select] [--out results.json]
+# --engine sets config.engine of the nodes ("select" or "asyncio", node_async.py)
+# Postgres binaries are taken from --pg-bin, PATH or pg_config --bindir
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
+import psycopg2
+
+root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+changelog = os.path.join(root, 'db', 'changelog.xml')
+
+ROLE = 'long_task' # the schema is found by the role name in search_path as in production
+DB = 'long_task'
+PORT = 5432 # unix socket only, the socket file is in the temp dir
+
+# the trigger created by the "task" changeset and dropped later, not in the changelog
+PRE_SQL = """
+CREATE OR REPLACE FUNCTION public.table_notify_iud() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    RETURN NULL;
+END;
+$$;
+"""
+
+# state transitions log for the queue wait and throughput, kept out of the measured statements
+EVENTS_SQL = """
+CREATE SCHEMA bench;
+CREATE TABLE bench.event (
+  task_id BIGINT NOT NULL,
+  state_id CHAR(2) NOT NULL,
+  queued TIMESTAMP(3) WITH TIME ZONE,
+  at TIMESTAMP WITH TIME ZONE DEFAULT clock_timestamp() NOT NULL
+);
+CREATE FUNCTION bench.event_tr() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    INSERT INTO bench.event(task_id, state_id, queued) VALUES (NEW.id, NEW.state_id, NEW.queued);
+    RETURN NULL;
+END;
+$$;
+CREATE TRIGGER bench_event_tr AFTER UPDATE OF state_id ON long_task.task
+FOR EACH ROW WHEN (OLD.state_id IS DISTINCT FROM NEW.state_id) EXECUTE FUNCTION bench.event_tr();
+"""
+
+# node.py with config.engine replaced, the engine is the argument after the node ones
+NODE_LAUNCHER = """
+import sys, runpy
+sys.path.insert(0, {root!r})
+import config
+get_config = config.get_config
+config.get_config = lambda: dict(get_config(), engine=sys.argv[5])
+runpy.run_path({node!r}, run_name='__main__')
+"""
+
+def find_pg_bin(pg_bin:str) -> str:
+    if pg_bin is not None:
+        return pg_bin
+    path = shutil.which('initdb')
+    if path is not None:
+        return os.path.dirname(path)
+    return subprocess.check_output(['pg_config', '--bindir']).decode().strip()
+
+class CountingCursor(psycopg2.extensions.cursor):
+    """
+    Counts the bench own statements to exclude them
+    """
+    count = 0
+
+    def execute(self, query, vars=None):
+        CountingCursor.count += 1
+        return super().execute(query, vars)
+
+class Postgres:
+
+    def __init__(self, pg_bin:str):
+        self.pg_bin = pg_bin
+        self.dir = tempfile.mkdtemp(prefix='pg_tasks_bench_')
+        self.data = os.path.join(self.dir, 'data')
+        self.has_pg_stat_statements = False
+        self.preload = False # pg_stat_statements is installed
+
+    def bin(self, name:str) -> str:
+        return os.path.join(self.pg_bin, name)
+
+    def start(self):
+        subprocess.check_call([self.bin('initdb'), '-D', self.data, '-U', 'postgres', '-A', 'trust', '-E', 'UTF8'], stdout=subprocess.DEVNULL)
+        options = "-c listen_addresses='' -c unix_socket_directories='{}' -p {} -c max_connections=300 -c fsync=off" \
+            .format(self.dir, PORT)
+        pg_config = self.bin('pg_config') if os.path.exists(self.bin('pg_config')) else 'pg_config'
+        share_dir = subprocess.check_output([pg_config, '--sharedir']).decode().strip()
+        self.preload = os.path.exists(os.path.join(share_dir, 'extension', 'pg_stat_statements.control'))
+        if self.preload:
+            options += ' -c shared_preload_libraries=pg_stat_statements'
+        subprocess.check_call([self.bin('pg_ctl'), '-D', self.data, '-o', options, '-l', os.path.join(self.dir, 'postgres.log'), '-w', 'start'], stdout=subprocess.DEVNULL)
+        conn = self.connect('postgres', 'postgres')
+        try:
+            with conn.cursor() as cur:
+                cur.execute('CREATE ROLE ' + ROLE + ' LOGIN SUPERUSER')
+                cur.execute('CREATE DATABASE ' + DB + ' OWNER ' + ROLE)
+        finally:
+            conn.close()
+
+    def stop(self):
+        subprocess.call([self.bin('pg_ctl'), '-D', self.data, '-m', 'immediate', 'stop'], stdout=subprocess.DEVNULL)
+
+    def connect(self, user:str='postgres', dbname:str=DB):
+        conn = psycopg2.connect(host=self.dir, port=PORT, dbname=dbname, user=user, cursor_factory=CountingCursor)
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        return conn
+
+    def db_config(self) -> dict:
+        return {"host": self.dir, "port": str(PORT), "database": DB, "user": ROLE, "password": ""}
+
+def apply_changelog(cur):
+    """
+    Applies the changesets in order as liquibase update does on the empty DB
+    """
+    base = os.path.dirname(changelog)
+    for cs in ET.parse(changelog).getroot():
+        if not cs.tag.endswith('changeSet'):
+            continue
+        for item in cs:
+            if item.tag.endswith('sqlFile'):
+                path = os.path.join(base, *item.get('path').replace('\\', '/').split('/'))
+                with open(path, encoding='utf-8-sig') as f:
+                    sql = f.read()
+            elif item.tag.endswith('sql'):
+                sql = item.text
+            else:
+                continue
+            try:
+                cur.execute(sql)
+            except Exception as e:
+                raise Exception('changeSet {}: {}'.format(cs.get('id'), e))
+
+def setup_db(pg:Postgres):
+    # as the role owning the schema, the changelog relies on its search_path
+    conn = pg.connect(ROLE)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(PRE_SQL)
+            apply_changelog(cur)
+            cur.execute(EVENTS_SQL)
+            if pg.preload:
+                cur.execute('CREATE EXTENSION IF NOT EXISTS pg_stat_statements')
+                pg.has_pg_stat_statements = True
+    finally:
+        conn.close()
+
+class Nodes:
+    """
+    node.py processes running in the work dir with db_config.json of the bench DB
+    """
+
+    def __init__(self, work_dir:str, count:int, slots:int, group_id:int=0, engine:str=None):
+        self.work_dir = work_dir
+        self.engine = engine
+        self.procs = {}
+        for worker_id in range(1, count + 1):
+            self.start(worker_id, slots, group_id)
+
+    def start(self, worker_id:int, slots:int, group_id:int):
+        log = open(os.path.join(self.work_dir, 'node_{}.log'.format(worker_id)), 'ab')
+        node_args = [str(worker_id), str(group_id), str(slots), 'bench' + str(worker_id)]
+        if self.engine is None:
+            cmd = [sys.executable, os.path.join(root, 'node.py')] + node_args
+        else:
+            cmd = [sys.executable, '-c', NODE_LAUNCHER.format(root=root, node=os.path.join(root, 'node.py'))] + node_args + [self.engine]
+        self.procs[worker_id] = subprocess.Popen(cmd, cwd=self.work_dir, stdout=log, stderr=subprocess.STDOUT)
+        log.close()
+
+    def wait_ready(self, cur, timeout:float=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            cur.execute("SELECT count(*) FROM long_task.worker WHERE id = any(%s) AND locked_until IS NOT NULL AND active", \
+                (list(self.procs),))
+            if cur.fetchone()[0] == len(self.procs):
+                return
+            for worker_id, proc in self.procs.items():
+                if proc.poll() is not None:
+                    raise Exception('node {} exited with {}, see node_{}.log'.format(worker_id, proc.returncode, worker_id))
+            time.sleep(0.1)
+        raise Exception('nodes are not ready')
+
+    def kill(self, worker_id:int):
+        self.procs.pop(worker_id).kill()
+
+    def stop(self):
+        for proc in self.procs.values():
+            proc.terminate()
+        deadline = time.monotonic() + 15
+        for proc in self.procs.values():
+            try:
+                proc.wait(max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        self.procs = {}
+
+def reset(cur):
+    cur.execute("TRUNCATE long_task.task, long_task.worker, bench.event RESTART IDENTITY")
+
+def statements(pg:Postgres, cur) -> int:
+    """
+    Statements made by the nodes (and their tasks) so far
+    """
+    if pg.has_pg_stat_statements:
+        # the bench connects as postgres
+        cur.execute("SELECT coalesce(sum(calls), 0) FROM pg_stat_statements s \
+            JOIN pg_database d ON d.oid = s.dbid JOIN pg_roles r ON r.oid = s.userid \
+            WHERE d.datname = %s AND r.rolname = %s", (DB, ROLE))
+        return int(cur.fetchone()[0])
+    # the stats are sent by the backends with a delay
+    time.sleep(1)
+    cur.execute("SELECT pg_stat_clear_snapshot()")
+    cur.execute("SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = %s", (DB,))
+    return int(cur.fetchone()[0]) - CountingCursor.count
+
+def wait_done(cur, timeout:float):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        cur.execute("SELECT count(*) FROM long_task.task WHERE state_id like 'A%'")
+        if cur.fetchone()[0] == 0:
+            return
+        time.sleep(0.2)
+    raise Exception('timeout')
+
+def summary(cur, since:float, until:float) -> dict:
+    """
+    Completed tasks and queue waits from the events between since and until (epoch)
+    """
+    cur.execute("""
+        SELECT
+            count(*) FILTER (WHERE state_id = 'CS'),
+            count(*) FILTER (WHERE state_id like 'C%%' AND state_id <> 'CS'),
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY extract(epoch from at - queued)) FILTER (WHERE state_id = 'AE'),
+            percentile_cont(0.99) WITHIN GROUP (ORDER BY extract(epoch from at - queued)) FILTER (WHERE state_id = 'AE')
+        FROM bench.event
+        WHERE at >= to_timestamp(%s) AND at < to_timestamp(%s)
+        """, (since, until))
+    completed, failed, p50, p99 = cur.fetchone()
+    seconds = until - since
+    return {
+        "completed": completed,
+        "failed": failed,
+        "seconds": round(seconds, 3),
+        "throughput": round(completed / seconds, 2) if seconds > 0 else None,
+        "queue_wait_p50": round(p50, 4) if p50 is not None else None,
+        "queue_wait_p99": round(p99, 4) if p99 is not None else None,
+    }
+
+def run_burst(ctx, cur, node_count:int, command:list=['/bin/true'], kill_after:float=None) -> dict:
+    nodes = Nodes(ctx.work_dir, node_count, ctx.args.slots, engine=ctx.args.engine)
+    try:
+        nodes.wait_ready(cur)
+        stmts = statements(ctx.pg, cur)
+        since = time.time()
+        cur.execute("INSERT INTO long_task.task(group_id, state_id, priority, command) \
+            SELECT 0, 'AW', 0, %s FROM generate_series(1, %s)", (command, ctx.args.tasks))
+        res = {}
+        if kill_after is not None:
+            # wait for a part of the tasks done and kill node 1 under load
+            while True:
+                cur.execute("SELECT count(*) FROM long_task.task WHERE state_id like 'C%'")
+                if cur.fetchone()[0] >= ctx.args.tasks * kill_after:
+                    break
+                time.sleep(0.05)
+            killed_at = time.time()
+            nodes.kill(1)
+            while True:
+                cur.execute("SELECT count(*) FROM long_task.task WHERE worker_id = 1 AND state_id = 'AE'")
+                if cur.fetchone()[0] == 0:
+                    break
+                time.sleep(0.05)
+            res["failover_seconds"] = round(time.time() - killed_at, 3)
+        wait_done(cur, ctx.args.timeout)
+        until = time.time()
+        stmts = statements(ctx.pg, cur) - stmts
+    finally:
+        nodes.stop()
+    res.update(summary(cur, since, until))
+    res["statements_per_task"] = round(stmts / ctx.args.tasks, 2)
+    return res
+
+def run_loop(ctx, cur, node_count:int, create) -> dict:
+    """
+    Tasks created by create(cur) run for duration, the completions in the window are counted
+    """
+    nodes = Nodes(ctx.work_dir, node_count, ctx.args.slots, engine=ctx.args.engine)
+    try:
+        nodes.wait_ready(cur)
+        create(cur)
+        time.sleep(min(5, ctx.args.duration / 5)) # warm up
+        stmts = statements(ctx.pg, cur)
+        since = time.time()
+        time.sleep(ctx.args.duration)
+        until = time.time()
+        stmts = statements(ctx.pg, cur) - stmts
+    finally:
+        nodes.stop()
+    res = summary(cur, since, until)
+    res["statements_per_task"] = round(stmts / res["completed"], 2) if res["completed"] > 0 else None
+    return res
+
+def scenario_burst(ctx, cur, node_count:int) -> dict:
+    return run_burst(ctx, cur, node_count)
+
+def scenario_failover(ctx, cur, node_count:int) -> dict:
+    if node_count < 2:
+        return None
+    return run_burst(ctx, cur, node_count, ['sleep', '0.2'], kill_after=1/3)
+
+def scenario_pairs(ctx, cur, node_count:int) -> dict:
+    def create(cur):
+        # ids 2k-1, 2k make a pair, the odd ones start
+        cur.execute("INSERT INTO long_task.task(group_id, state_id, priority, command) \
+            SELECT 0, 'DR', 0, %s FROM generate_series(1, %s)", \
+            ([sys.executable, os.path.join(root, 'example', 'looped_task_pairs.py'), '%TASK'], ctx.args.pairs * 2))
+        cur.execute("UPDATE long_task.task SET state_id = 'CS' WHERE id % 2 = 0")
+        cur.execute("UPDATE long_task.task SET state_id = 'AW' WHERE id % 2 = 1")
+    return run_loop(ctx, cur, node_count, create)
+
+def scenario_sched(ctx, cur, node_count:int) -> dict:
+    def create(cur):
+        cur.execute("INSERT INTO long_task.task(group_id, state_id, priority, command) \
+            SELECT 0, 'DR', 0, '{/bin/true}' FROM generate_series(1, %s)", (ctx.args.sched,))
+        cur.execute("UPDATE long_task.task SET state_id = 'CS', next_start = localtimestamp + interval '1 second', \
+            shed_period_id = 'SEC', shed_period_count = 1")
+    return run_loop(ctx, cur, node_count, create)
+
+SCENARIOS = {
+    'burst': scenario_burst,
+    'pairs': scenario_pairs,
+    'sched': scenario_sched,
+    'failover': scenario_failover,
+}
+
+def git_version() -> str:
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=root).decode().strip()
+    except Exception:
+        return None
+
+class Context:
+    pass
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='pg_tasks throughput benchmark')
+    parser.add_argument('--nodes', default='1,2,4', help='node counts to run, comma separated')
+    parser.add_argument('--slots', type=int, default=50, help='max_task_count of each node')
+    parser.add_argument('--tasks', type=int, default=10000, help='tasks of burst and failover')
+    parser.add_argument('--pairs', type=int, default=10, help='task pairs of the pairs scenario')
+    parser.add_argument('--sched', type=int, default=100, help='tasks of the sched scenario')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to measure pairs and sched')
+    parser.add_argument('--timeout', type=float, default=600, help='max seconds of a burst')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--engine', default=None, choices=['select', 'asyncio'], help='config.engine of the nodes, default - config.py')
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--pg-bin', default=None, help='Postgres binaries directory')
+    parser.add_argument('--keep', action='store_true', help='keep the temp dir (DB and node logs)')
+    args = parser.parse_args()
+
+    ctx = Context()
+    ctx.args = args
+    ctx.pg = Postgres(find_pg_bin(args.pg_bin))
+    ctx.work_dir = os.path.join(ctx.pg.dir, 'work')
+    os.mkdir(ctx.work_dir)
+    with open(os.path.join(ctx.work_dir, 'db_config.json'), 'w') as f:
+        json.dump(ctx.pg.db_config(), f)
+
+    report = {
+        "version": git_version(),
+        "time": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "params": vars(args),
+        "results": [],
+    }
+    print('Temp dir', ctx.pg.dir)
+    ctx.pg.start()
+    try:
+        setup_db(ctx.pg)
+        report["statements_source"] = 'pg_stat_statements' if ctx.pg.has_pg_stat_statements else 'pg_stat_database transactions'
+        # not "with conn": psycopg2 >= 2.9 opens a transaction there even in autocommit,
+        # the TRUNCATE of reset() would lock the nodes out
+        conn = ctx.pg.connect()
+        try:
+            with conn.cursor() as cur:
+                for name in args.scenarios.split(','):
+                    for node_count in [int(n) for n in args.nodes.split(',')]:
+                        reset(cur)
+                        res = SCENARIOS[name](ctx, cur, node_count)
+                        if res is None:
+                            continue
+                        res = dict(scenario=name, nodes=node_count, **res)
+                        print(json.dumps(res))
+                        report["results"].append(res)
+                        with open(args.out, 'w') as f:
+                            json.dump(report, f, indent=2)
+        finally:
+            conn.close()
+    finally:
+        ctx.pg.stop()
+        if not args.keep:
+            shutil.rmtree(ctx.pg.dir, ignore_errors=True)
+    print('Results', args.out)
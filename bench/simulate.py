@@ -0,0 +1,215 @@
+# Scheduler simulation without a DB
+# Runs the node (node.py) with config.storage "memory" (storage.MemoryStorage) and fake task
+# processes, so the time measured is the CPU the node spends per task: the claims, the state
+# writes, the notifications and the active objects passes, with no process start and no DB round trip.
+#
+#   <tasks> tasks queued at once (each {sleep,<duration>} "runs" for duration simulated seconds),
+#   <sched> tasks cloned every second (shed_clone, shed_period SEC),
+#   <peers> other workers holding their locks (refreshed and watched by the node),
+#   one failed worker with <failed> tasks left executing (recovered by the node)
+#
+# For each size of the queue: tasks completed per second, node CPU per task (process_time),
+# storage calls per task, controller passes, the RSS growth of the startup tasks refresh
+# and the top classes by process() time (profiler.py).
+# Each size runs in a separate process as the node module keeps its state in globals.
+#
+# python bench/simulate.py [--tasks 1000,10000,100000] [--slots 50] [--duration 0] [--sched 0]
+#                          [--peers 10] [--failed 100] [--out simulate.json]
+
+import os
+import sys
+import json
+import time
+import heapq
+import argparse
+import itertools
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+root = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+class FakeProcess:
+    """
+    Stands for TaskProcess (node.process_class): exits after the duration given by {sleep,<seconds>}
+    """
+    reports_exit = True
+    exit_reported = True
+    pids = itertools.count(1000000)
+    running = [] # heap of (exit time, pid)
+
+    def __init__(self, commands:list, id, cwd=None, capture_stdout:int=0):
+        self.id = id
+        self.proc = self
+        self.pid = next(FakeProcess.pids)
+        self.wait_until = None
+        self.exit_code = None
+        duration = float(commands[1]) if len(commands) > 1 and commands[0] == 'sleep' else 0
+        heapq.heappush(FakeProcess.running, (time.monotonic() + duration, self.pid))
+
+    def set_exit_code(self, exit_code:int):
+        self.exit_code = exit_code
+
+    def check_result(self):
+        return self.exit_code
+
+    def terminate(self):
+        self.exit_code = -15
+
+    def kill(self):
+        self.exit_code = -9
+
+    def close(self):
+        pass
+
+    def get_error(self) -> str:
+        return 'exit code ' + str(self.exit_code)
+
+    @classmethod
+    def exit_due(cls, backlog:list) -> float:
+        """
+        Reports the exits due, returns the time to the next one or None
+        """
+        now = time.monotonic()
+        while cls.running and cls.running[0][0] <= now:
+            t, pid = heapq.heappop(cls.running)
+            backlog.append((pid, 0))
+        if cls.running:
+            return cls.running[0][0] - now
+        return None
+
+def simulate(args) -> dict:
+    work_dir = tempfile.mkdtemp(prefix='long_task_sim_')
+    with open(os.path.join(work_dir, 'db_config.json'), 'w') as f:
+        json.dump({'host': None, 'port': None, 'database': None, 'user': None, 'password': None}, f)
+    os.chdir(work_dir)
+    sys.argv = ['node.py', '1', '0', str(args.slots), 'sim']
+    sys.path.insert(0, root)
+    import node
+    import storage
+
+    completed = [0]
+
+    class Storage(storage.MemoryStorage):
+        def update_task(self, row:dict, values:dict):
+            if values.get('state_id') == 'CS' and row['state_id'] != 'CS' and row['shed_parent_id'] is None:
+                completed[0] += 1
+            super().update_task(row, values)
+
+    config = node.config
+    config.storage = 'memory'
+    config.notify_coalesce_window = timedelta(0)
+    notify_fields = None
+    if config.notify_payload:
+        notify_fields = {node.Task.table_name: node.Task.table_fields, node.Worker.table_name: node.Worker.table_fields}
+    db = Storage(config.schema, notify_fields)
+    node.storage = db
+    node.process_class = FakeProcess
+
+    now = datetime.now()
+    for i in range(args.peers):
+        db.lock_worker(100 + i, 0, 'peer', 0, now + timedelta(days=1), None)
+    if args.failed > 0:
+        db.lock_worker(99, 0, 'failed', args.failed, now - timedelta(hours=1), None)
+        for i in range(args.failed):
+            id = db.insert_task(['sleep', '0'], 0)
+            db.update_task(db.tasks[id], {'state_id': 'AE', 'worker_id': 99})
+    for i in range(args.sched):
+        db.insert_task(['sleep', str(args.duration)], 0, 'DR', next_start=now, \
+            shed_period_id='SEC', shed_period_count=1, shed_clone=True)
+    for i in range(args.tasks):
+        db.insert_task(['sleep', str(args.duration)], 0, priority=i % 3)
+    expected = args.tasks
+
+    node.open_pools()
+    node.listener = node.connect_listen()
+    node.start_node()
+    statements = db.statements
+    passes = 0
+    cpu = time.process_time()
+    wall = time.monotonic()
+    while completed[0] < expected:
+        next_time = node.process_controller()
+        node.save_db_states()
+        passes += 1
+        exits = len(node.terminated_processes_backlog)
+        dt = FakeProcess.exit_due(node.terminated_processes_backlog)
+        exited = len(node.terminated_processes_backlog) > exits # SIGCHLD wakes the node up
+        node.process_signal_backlog()
+        node.Worker.clear_changes()
+        node.Task.clear_changes()
+        node.receive_notifications()
+        node.apply_changes()
+        if completed[0] >= expected:
+            break
+        if not exited and not node.Task.has_changes() and next_time is not None:
+            # nothing to do until the next exit or the next timer
+            wait_time = node.get_wait_time(next_time)
+            if dt is not None and dt < wait_time:
+                wait_time = dt
+            if wait_time > 0.001:
+                time.sleep(wait_time)
+    cpu = time.process_time() - cpu
+    wall = time.monotonic() - wall
+
+    top = sorted(node.profiler.stats.items(), key=lambda i: -i[1][1])[:5]
+    return {
+        'tasks': args.tasks,
+        'slots': args.slots,
+        'duration': args.duration,
+        'sched': args.sched,
+        'completed': completed[0],
+        'seconds': round(wall, 3),
+        'tasks_per_second': round(completed[0] / wall, 1) if wall > 0 else None,
+        'cpu_us_per_task': round(cpu * 1e6 / completed[0], 1) if completed[0] > 0 else None,
+        'storage_calls_per_task': round((db.statements - statements) / completed[0], 2) if completed[0] > 0 else None,
+        'passes': passes,
+        'failed_left': sum(1 for row in db.tasks.values() if row['worker_id'] == 99 and row['state_id'] in ('AE', 'AC')),
+        'sched_fired': sum(1 for row in db.tasks.values() if row['shed_parent_id'] is not None),
+        'notifications': node.notify_stats.notifications,
+        'refresh_peak_rss_kb': node.metrics.refresh_peak_rss.value // 1024,
+        'top_classes': {name: {'calls': s[0], 'seconds': round(s[1], 3)} for name, s in top},
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Scheduler simulation with the in-memory storage')
+    parser.add_argument('--tasks', default='1000,10000,100000')
+    parser.add_argument('--slots', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=0, help='simulated task run time, s')
+    parser.add_argument('--sched', type=int, default=0)
+    parser.add_argument('--peers', type=int, default=10)
+    parser.add_argument('--failed', type=int, default=100)
+    parser.add_argument('--out', default=None)
+    parser.add_argument('--smoke', action='store_true', help='1000 tasks, 5 schedules, 10 tasks to recover: checks the node still runs them all')
+    parser.add_argument('--one', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.one:
+        args.tasks = int(args.tasks)
+        print(json.dumps(simulate(args)))
+        return
+
+    if args.smoke:
+        args.tasks, args.sched, args.duration, args.peers, args.failed = '1000', 5, 0, 2, 10
+
+    results = []
+    for tasks in args.tasks.split(','):
+        cmd = [sys.executable, os.path.abspath(__file__), '--one', '--tasks', tasks, \
+            '--slots', str(args.slots), '--duration', str(args.duration), '--sched', str(args.sched), \
+            '--peers', str(args.peers), '--failed', str(args.failed)]
+        out = subprocess.check_output(cmd).decode()
+        res = json.loads(out.strip().splitlines()[-1])
+        print('{tasks:>8} tasks: {tasks_per_second} tasks/s, {cpu_us_per_task} us CPU/task, ' \
+            '{storage_calls_per_task} storage calls/task, {passes} passes'.format(**res), flush=True)
+        results.append(res)
+        if args.smoke:
+            ok = res['completed'] == res['tasks'] and res['failed_left'] == 0 and res['sched_fired'] > 0
+            print('smoke:', 'ok' if ok else 'FAILED', flush=True)
+            if not ok:
+                sys.exit(1)
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+# Spawn latency and processes per second of the spawn backends (see spawn.py)
+# The node heap is emulated by allocating <heap_mb> of python objects before spawning
+#
+# python bench/spawn_latency.py [<count> [<concurrency> [<heap_mb> [<command>...]]]]
+
+import os
+import sys
+import time
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import spawn
+
+count = int(sys.argv[1]) if len(sys.argv) >= 2 else 500
+concurrency = int(sys.argv[2]) if len(sys.argv) >= 3 else 50
+heap_mb = int(sys.argv[3]) if len(sys.argv) >= 4 else 0
+command = sys.argv[4:] if len(sys.argv) >= 5 else ['/bin/true']
+
+def percentile(values:list, p:float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+class Runner:
+
+    def __init__(self, name:str):
+        self.spawner = spawn.SPAWNERS[name]()
+
+    def run(self):
+        latencies = []
+        running = collections.deque()
+        t = time.monotonic()
+        for i in range(count):
+            if len(running) >= concurrency:
+                running.popleft().wait()
+            t0 = time.perf_counter()
+            running.append(self.spawner.spawn(command, os.getcwd()))
+            latencies.append(time.perf_counter() - t0)
+        while len(running) > 0:
+            running.popleft().wait()
+        return latencies, time.monotonic() - t
+
+    def close(self):
+        self.spawner.close()
+
+if __name__ == '__main__':
+
+    # started before the heap grows, the same as the node does
+    runners = {name: Runner(name) for name in spawn.SPAWNERS}
+
+    heap = [{'i': i, 's': str(i)} for i in range(heap_mb * 1024 * 1024 // 300)]
+
+    print("command: {}, count: {}, concurrency: {}, heap: {} MB".format(' '.join(command), count, concurrency, heap_mb))
+    print("{:>12} {:>10} {:>10} {:>10} {:>10}".format("backend", "p50 ms", "p99 ms", "max ms", "procs/s"))
+    for name, runner in runners.items():
+        latencies, dt = runner.run()
+        print("{:>12} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.1f}".format(name, \
+            percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, max(latencies) * 1000, count / dt))
+        runner.close()
@@ -26,6 +26,111 @@ def get_config():
 
         "node_name": socket.gethostname() if len(sys.argv)<=4 else sys.argv[4],
 
+        # подбирать лимит одновременных задач от min_task_count до max_task_count (AIMD): +1 за окно, пока лимит
+        # достигнут и задачи не замедляются и не падают, иначе умножается на adaptive_decrease (см. adaptive.py)
+        # adjust the simultanious tasks limit from min_task_count to max_task_count (AIMD): +1 per window while
+        # the limit is reached and the tasks neither slow down nor fail, otherwise multiplied by adaptive_decrease (see adaptive.py)
+        "adaptive_task_count": False,
+        "min_task_count": 1,
+        # лимит при старте, None - max_task_count (базовая длительность меряется при нем, чтобы найти перегрузку
+        # ниже max_task_count, начинайте с меньшего); без завершившихся за окно задач лимит растет, пока запущенные
+        # не работают дольше adaptive_latency_tolerance базовых длительностей
+        # the limit at the start, None - max_task_count (the baseline duration is measured at it, start lower
+        # to find the overload below max_task_count); with no tasks completed in the window the limit grows
+        # while the running ones don't run longer than adaptive_latency_tolerance times the baseline
+        "initial_task_count": None,
+        "adaptive_window": timedelta(seconds=30),
+        # снижать, если средняя длительность задач за окно больше базовой во столько раз
+        # decrease if the mean tasks duration of the window exceeds the baseline so many times
+        "adaptive_latency_tolerance": 2.0,
+        # или доля завершившихся с ошибкой больше
+        # or the part of the tasks failed is above
+        "adaptive_max_failure_rate": 0.2,
+        "adaptive_decrease": 0.7,
+
+        # ресурсы узла в единицах task.cpu_units и task.mem_units (например ядра и Мб): берутся только задачи,
+        # помещающиеся в оставшееся от запущенных, None - не ограничено (только max_task_count)
+        # the node resources in task.cpu_units and task.mem_units (e.g. cores and Mb): only the tasks fitting
+        # into what is left by the running ones are claimed, None - not limited (max_task_count only)
+        "cpu_capacity": None,
+        "mem_capacity": None,
+
+        # не брать задачи, пока нагрузка хоста выше порога (см. pressure.py), None - не проверять:
+        # PSI avg10 "some" из /proc/pressure/cpu, memory, io (% времени ожидания, Linux 4.20+)
+        # don`t claim tasks while the host load is above the threshold (see pressure.py), None - don`t check:
+        # PSI avg10 "some" of /proc/pressure/cpu, memory, io (% of time stalled, Linux 4.20+)
+        "psi_cpu_limit": None,
+        "psi_memory_limit": None,
+        "psi_io_limit": None,
+        # доля использованной памяти от лимита cgroup узла (например 0.9)
+        # the node cgroup memory used as a fraction of its limit (e.g. 0.9)
+        "cgroup_memory_limit": None,
+        # как часто перечитывать
+        # how often to re-read
+        "pressure_check_interval": timedelta(seconds=1),
+
+        # движок узла: "select" - цикл на select.select, "asyncio" - на asyncio (node_async.py).
+        # В "asyncio" асинхронны только процессы задач и LISTEN (asyncpg), остальные запросы к БД
+        # (захват задач, продление блокировки, запись) синхронные psycopg2 в одном потоке контроллера;
+        # spawn_backend, py_pool_size и child_supervision не применяются (каждая задача - новый процесс)
+        # node engine: "select" - select.select loop, "asyncio" - asyncio based (node_async.py).
+        # With "asyncio" only the task processes and LISTEN (asyncpg) are async, the other DB calls
+        # (claims, lease, writes) are synchronous psycopg2 in the single controller thread;
+        # spawn_backend, py_pool_size and child_supervision don`t apply (each task is a new process)
+        "engine": "select",
+
+        # хранилище записей worker и task: "pg" - БД, "memory" - в памяти процесса для моделирования (см. storage.py, bench/simulate.py)
+        # storage of the worker and task records: "pg" - the DB, "memory" - in the process memory to simulate (see storage.py, bench/simulate.py)
+        "storage": "pg",
+
+        # способ запуска процессов задач: "popen", "posix_spawn", "forkserver" (см. spawn.py)
+        # how the task processes are started: "popen", "posix_spawn", "forkserver" (see spawn.py)
+        "spawn_backend": "popen",
+
+        # число заранее запущенных интерпретаторов Python для команд py:module:function (см. pypool.py), 0 - без пула
+        # pre-started Python interpreters for the py:module:function commands (see pypool.py), 0 - no pool
+        "py_pool_size": 0,
+        # модули, импортируемые интерпретаторами пула при запуске
+        # modules imported by the pool interpreters on start
+        "py_pool_preload": ["psycopg2"],
+        # интерпретатор пула перезапускается после стольких задач
+        # the pool interpreter is restarted after so many tasks
+        "py_pool_max_tasks": 100,
+        # или когда его память (RSS) превысит столько Мб, None - не проверять
+        # or when its memory (RSS) exceeds so many Mb, None - don`t check
+        "py_pool_max_rss": 200,
+
+        # как узнавать о завершении процессов: "signal" - SIGCHLD и периодическая проверка,
+        # "pidfd" - pidfd каждого процесса в select основного цикла (Linux 5.3+, Python 3.9+)
+        # how the processes exit is discovered: "signal" - SIGCHLD and periodical check,
+        # "pidfd" - pidfd of each process in the main loop select (Linux 5.3+, Python 3.9+)
+        "child_supervision": "signal",
+
+        # сколько последних байт вывода процесса сохранять в task.error при ошибке, 0 - не захватывать
+        # how many last bytes of the process output to keep in task.error on fail, 0 - don`t capture
+        "capture_stdout": 0,
+
+        # писать вывод процессов задач в таблицу task_log (пачками через COPY)
+        # write the task processes output into task_log table (in batches with COPY)
+        "task_log": False,
+        # записывать, когда накопилось столько байт
+        # write when so many bytes are collected
+        "task_log_flush_bytes": 256 * 1024,
+        # или прошло столько времени
+        # or so much time has passed
+        "task_log_flush_interval": timedelta(seconds=1),
+        # не читать вывод процессов, пока не записано столько байт (БД не успевает)
+        # stop reading the processes output while so many bytes are not written (the DB is slow)
+        "task_log_max_pending": 4 * 1024 * 1024,
+
+        # как узел подтверждает, что его worker жив: "lease" - продлевает worker.locked_until (lock_worker),
+        # "session" - держит advisory lock сессии по worker_id, строка worker пишется только при изменении
+        # task_count/node_name, проверка раз в half_locking_time без записи (у всех узлов должно быть одинаково)
+        # how the node proves its worker is alive: "lease" - prolongs worker.locked_until (lock_worker),
+        # "session" - holds the session advisory lock by worker_id, the worker row is written when
+        # task_count/node_name change only, checked each half_locking_time with no write (the same on all the nodes)
+        "liveness": "lease",
+
         # половина времени продления блокировки worker
         # half of the locking period to prolongate one
         "half_locking_time": timedelta(seconds=5),
@@ -38,6 +143,36 @@ def get_config():
         # workers state refresh period (for worker failed state discovery only)
         "workers_refresh_inverval": timedelta(seconds=30),
 
+        # кто следит за отказами других workers: "elected" - один узел, держащий advisory lock (остальные
+        # подхватывают в пределах workers_refresh_inverval после его падения), "all" - каждый узел читает всех workers
+        # who watches the other workers failure: "elected" - one node holding the advisory lock (the others
+        # take over within workers_refresh_inverval after it dies), "all" - each node reads all the workers
+        "watchdog": "elected",
+
+        # задачи при обновлении читаются курсором на сервере порциями по столько записей, по одной за проход контроллера
+        # the tasks refresh reads the records with a server side cursor in chunks of this size, one chunk per controller pass
+        "refresh_chunk_size": 1000,
+
+        # как срабатывают расписания (task.next_start): "objects" - объект Task на каждое расписание,
+        # "sql" - все наступившие расписания группы одним вызовом long_task.sched_fire_due по одному таймеру
+        # how the schedules (task.next_start) are fired: "objects" - a Task object per schedule,
+        # "sql" - all the due schedules of the group with one long_task.sched_fire_due call on a single timer
+        "schedule_engine": "objects",
+        # расписаний за один вызов, остальные - на следующем проходе контроллера
+        # schedules per call, the rest on the next controller pass
+        "schedule_fire_limit": 1000,
+        # расписание срабатывает позже next_start на постоянную для id задачи задержку до стольких (но меньше периода),
+        # чтобы расписания с одинаковым next_start не срабатывали одновременно; next_start не сдвигается (одинаково на всех узлах)
+        # the schedule fires later than next_start by a delay up to so much (but below the period) constant per task id,
+        # so the schedules with the same next_start don`t fire at once; next_start is not shifted (the same on all the nodes)
+        "schedule_spread": timedelta(0),
+        # срабатываний расписаний в секунду на группу (общий token bucket в long_task.sched_bucket), None - без ограничения
+        # schedule fires per second per group (the shared token bucket in long_task.sched_bucket), None - no limit
+        "schedule_rate": None,
+        # сколько срабатываний можно подряд после простоя
+        # how many fires are allowed in a row after an idle time
+        "schedule_burst": 100,
+
         # задержка повтора обработки после ошибки (удваивается при повторе)
         # delay to retry after error (starts with min and doubled on retry)
         "min_task_retry_delay": timedelta(seconds=1), # минимум (min)
@@ -53,6 +188,36 @@ def get_config():
         "min_delay_after_db_error": timedelta(seconds=1), # минимум (min)
         "max_delay_after_db_error": timedelta(seconds=30), # максимум (max)
 
+        # брать состояние записи из уведомления без повторного чтения из БД
+        # (в БД: ALTER DATABASE <db> SET long_task.notify_payload = on)
+        # take the record state from the notification payload without re-reading it from DB
+        # (in DB: ALTER DATABASE <db> SET long_task.notify_payload = on)
+        "notify_payload": False,
+
+        # сколько ждать остальные уведомления пачки перед их применением, 0 - не ждать
+        # how long to wait for the rest of a notification burst before applying it, 0 - don`t wait
+        "notify_coalesce_window": timedelta(milliseconds=5),
+
+        # записывать изменения задач одним запросом в конце прохода контроллера
+        # write the tasks changes with one query at the end of the controller pass
+        "write_behind": True,
+
+        # число соединений с БД для команд (кроме LISTEN и продления блокировки worker)
+        # DB connections for the commands (except LISTEN and the worker lock prolongation)
+        "db_pool_size": 2,
+
+        # порт HTTP для метрик в формате Prometheus, None - не запускать
+        # HTTP port of the metrics in Prometheus format, None - don`t start
+        "metrics_port": None,
+        "metrics_host": "0.0.0.0",
+
+        # по SIGUSR1 статистика process() и профиль cProfile пишутся в файл в этой директории
+        # on SIGUSR1 the process() stats and cProfile profile are written to a file in this directory
+        "profile_dir": ".",
+        # длительность снятия профиля cProfile, сек
+        # cProfile capture duration, sec
+        "profile_seconds": 10,
+
         # корневая директория для запускаемых процессов, None - текущий каталог
         # the root directory for processes being started, None - current cwd
         "root_dir": None,
@@ -64,6 +229,11 @@ def get_config():
 class Messages_eng:
     REFRESH_WORKERS = None #"Reloading workers"
     REFRESH_TASKS = None #"Reloading tasks"
+    TASKS_REFRESHED = "Tasks refreshed: {} rows in {} chunks, {:.3f} s, peak RSS +{} KB"
+    WATCHDOG_LEADER = "Watching the other workers"
+    WATCHDOG_FOLLOWER = "Not watching the other workers"
+    ENGINE_OPTION_IGNORED = "config.{} = {!r} doesn`t apply to the asyncio engine, ignored"
+    TASK_LIMIT = "Task limit {} -> {}: {:.2f} tasks/s, {:.3f} s per task, {:.0%} failed"
     LOCK_AQUIRED = "Lock aquired"
     LOCK_RELEASED = "Lock released"
     STOP_VAL = "stop={}"
@@ -82,6 +252,11 @@ class Messages_eng:
 class Messages_rus:
     REFRESH_WORKERS = None #"Reloading workers"
     REFRESH_TASKS = None #"Reloading tasks"
+    TASKS_REFRESHED = "Задачи обновлены: {} записей за {} порций, {:.3f} с, пик RSS +{} КБ"
+    WATCHDOG_LEADER = "Наблюдение за другими workers"
+    WATCHDOG_FOLLOWER = "Наблюдение за другими workers передано"
+    ENGINE_OPTION_IGNORED = "config.{} = {!r} не применяется движком asyncio, игнорируется"
+    TASK_LIMIT = "Лимит задач {} -> {}: {:.2f} задач/с, {:.3f} с на задачу, {:.0%} с ошибкой"
     LOCK_AQUIRED = "Блокировка получена"
     LOCK_RELEASED = "Блокировка снята"
     STOP_VAL = "stop={}"
@@ -0,0 +1,20 @@
+﻿CREATE OR REPLACE FUNCTION long_task.add_period_until(p_start timestamp without time zone, p_until timestamp without time zone, p_period interval)
+ RETURNS timestamp without time zone
+ LANGUAGE plpgsql
+ IMMUTABLE
+AS $function$
+DECLARE
+  v_period2 INTERVAL := p_period + p_period;
+  v_t TIMESTAMP := p_start + v_period2;
+BEGIN
+	-- the same as add_period_until() of node.py: doubles the period while it fits
+	IF v_t > p_until THEN
+		RETURN p_start;
+	END IF;
+	v_t := long_task.add_period_until(v_t, p_until, v_period2);
+	IF v_t + p_period <= p_until THEN
+		RETURN v_t + p_period;
+	END IF;
+	RETURN v_t;
+END;
+$function$
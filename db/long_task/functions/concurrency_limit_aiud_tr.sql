@@ -0,0 +1,25 @@
+﻿CREATE OR REPLACE FUNCTION long_task.concurrency_limit_aiud_tr()
+ RETURNS trigger
+ LANGUAGE plpgsql
+AS $function$
+BEGIN
+	-- concurrency_usage is kept for the limited keys only: counted from the tasks when the key gets a limit,
+	-- dropped with the limit
+	IF TG_OP in ('UPDATE', 'DELETE') THEN
+		IF TG_OP = 'DELETE' OR NEW.key <> OLD.key THEN
+			DELETE FROM long_task.concurrency_usage WHERE key = OLD.key;
+		END IF;
+	END IF;
+	IF TG_OP in ('INSERT', 'UPDATE') THEN
+		IF TG_OP = 'INSERT' OR NEW.key <> OLD.key THEN
+			INSERT INTO long_task.concurrency_usage(key, running)
+			SELECT NEW.key, count(*)
+			FROM long_task.task t
+			WHERE t.concurrency_key = NEW.key
+			AND t.state_id in ('AE', 'AC')
+			ON CONFLICT (key) DO UPDATE SET running = EXCLUDED.running;
+		END IF;
+	END IF;
+	RETURN NULL;
+END;
+$function$
\ No newline at end of file
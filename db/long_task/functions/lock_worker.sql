@@ -1,4 +1,4 @@
-﻿CREATE OR REPLACE FUNCTION long_task.lock_worker(p_id bigint, p_group_id integer, p_node_name character varying, p_task_count integer, p_lock_until timestamp without time zone, p_prev_locked_until timestamp without time zone DEFAULT NULL::timestamp without time zone)
+﻿CREATE OR REPLACE FUNCTION long_task.lock_worker(p_id bigint, p_group_id integer, p_node_name character varying, p_task_count integer, p_lock_until timestamp without time zone, p_prev_locked_until timestamp without time zone DEFAULT NULL::timestamp without time zone, p_task_limit integer DEFAULT NULL::integer)
  RETURNS timestamp without time zone
  LANGUAGE plpgsql
 AS $function$
@@ -16,8 +16,8 @@ BEGIN
       WHERE id = p_id;
 
       IF NOT FOUND THEN
-        INSERT INTO long_task.worker(id, active, locked_until, task_count, group_id, node_name)
-        VALUES(p_id, true, p_lock_until, p_task_count, p_group_id, p_node_name);
+        INSERT INTO long_task.worker(id, active, locked_until, task_count, group_id, node_name, task_limit)
+        VALUES(p_id, true, p_lock_until, p_task_count, p_group_id, p_node_name, p_task_limit);
         RETURN NULL;
       END IF;
     
@@ -27,12 +27,12 @@ BEGIN
     
 	  IF p_prev_locked_until is not null AND p_prev_locked_until=v_locked_until THEN
         UPDATE long_task.worker
-        SET locked_until = p_lock_until, task_count=p_task_count, group_id=p_group_id, node_name=p_node_name
+        SET locked_until = p_lock_until, task_count=p_task_count, task_limit=p_task_limit, group_id=p_group_id, node_name=p_node_name
         WHERE id = p_id AND (locked_until is NULL OR locked_until = p_prev_locked_until OR locked_until < now())
         RETURNING id INTO v_id;
       ELSE
         UPDATE long_task.worker
-        SET locked_until = p_lock_until, task_count=p_task_count, group_id=p_group_id, active=true, node_name=p_node_name
+        SET locked_until = p_lock_until, task_count=p_task_count, task_limit=p_task_limit, group_id=p_group_id, active=true, node_name=p_node_name
         WHERE id = p_id AND (locked_until is NULL OR locked_until < now())
         RETURNING id INTO v_id;      
       END IF;
@@ -0,0 +1,26 @@
+﻿CREATE OR REPLACE FUNCTION long_task.notify_payload(p_op character, p_id bigint, p_row anyelement, p_fields character varying[])
+ RETURNS character varying
+ LANGUAGE plpgsql
+ STABLE
+AS $function$
+DECLARE
+  v_payload VARCHAR;
+  v_state VARCHAR;
+BEGIN
+  v_payload := p_op || ' ' || p_id::varchar;
+  IF coalesce(current_setting('long_task.notify_payload', true), '') <> 'on' THEN
+    RETURN v_payload;
+  END IF;
+
+  SELECT jsonb_object_agg(key, value)::varchar
+  INTO v_state
+  FROM jsonb_each(to_jsonb(p_row))
+  WHERE key = any(p_fields);
+
+  -- NOTIFY payload must be shorter than 8000 bytes, the listener re-reads the row then
+  IF v_state IS NULL OR octet_length(v_payload) + octet_length(v_state) >= 7999 THEN
+    RETURN v_payload;
+  END IF;
+  RETURN v_payload || ' ' || v_state;
+END;
+$function$
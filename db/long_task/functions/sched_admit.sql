@@ -0,0 +1,33 @@
+﻿CREATE OR REPLACE FUNCTION long_task.sched_admit(p_group_id integer, p_count integer, p_rate double precision, p_burst double precision)
+ RETURNS integer
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+  v_tokens double precision;
+  v_refilled_at timestamp with time zone;
+  v_now timestamp with time zone := clock_timestamp();
+  v_granted integer;
+BEGIN
+	IF p_rate IS NULL THEN
+		RETURN p_count;
+	END IF;
+	INSERT INTO long_task.sched_bucket(group_id, tokens, refilled_at)
+	VALUES (p_group_id, p_burst, v_now)
+	ON CONFLICT (group_id) DO NOTHING;
+	-- the fires of the group nodes queue here
+	SELECT b.tokens, b.refilled_at INTO v_tokens, v_refilled_at
+	FROM long_task.sched_bucket b
+	WHERE b.group_id = p_group_id
+	FOR UPDATE;
+	v_tokens := least(p_burst, v_tokens + greatest(0, extract(epoch FROM v_now - v_refilled_at)) * p_rate);
+	IF p_count < 0 THEN
+		v_granted := p_count; -- returned unused
+	ELSE
+		v_granted := least(p_count, floor(v_tokens)::integer);
+	END IF;
+	UPDATE long_task.sched_bucket
+	SET tokens = least(p_burst, v_tokens - v_granted), refilled_at = v_now
+	WHERE group_id = p_group_id;
+	RETURN v_granted;
+END;
+$function$
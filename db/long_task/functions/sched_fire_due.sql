@@ -0,0 +1,48 @@
+﻿CREATE OR REPLACE FUNCTION long_task.sched_fire_due(p_group_id integer, p_limit integer, p_spread interval, p_rate double precision, p_burst double precision)
+ RETURNS TABLE(id bigint, new_task_id bigint, next_start timestamp without time zone)
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+  r RECORD;
+  v_now TIMESTAMP := localtimestamp;
+  v_interval INTERVAL;
+  v_granted integer;
+  v_fired integer := 0;
+BEGIN
+	v_granted := long_task.sched_admit(p_group_id, p_limit, p_rate, p_burst);
+	IF v_granted <= 0 THEN
+		RETURN;
+	END IF;
+	-- the schedules fired by a concurrent call are skipped
+	FOR r IN
+		SELECT t.id, t.next_start, t.shed_period_id, t.shed_period_count
+		FROM long_task.task t
+		WHERE t.group_id = p_group_id
+		AND t.next_start <= v_now
+		AND t.shed_enabled
+		AND NOT t.cleanup_pending
+		AND t.next_start + long_task.sched_jitter(t.id, t.next_start, long_task.shed_interval(t.shed_period_id, t.shed_period_count), p_spread) <= v_now
+		ORDER BY t.next_start
+		LIMIT v_granted
+		FOR UPDATE SKIP LOCKED
+	LOOP
+		v_interval := long_task.shed_interval(r.shed_period_id, r.shed_period_count);
+		id := r.id;
+		IF v_interval IS NULL THEN
+			next_start := NULL;
+		ELSE
+			-- next_start stays on the period grid, the jitter moves the fire only
+			next_start := long_task.add_period_until(r.next_start, v_now, v_interval) + v_interval;
+		END IF;
+		UPDATE long_task.task t
+		SET next_start = sched_fire_due.next_start
+		WHERE t.id = r.id;
+		new_task_id := long_task.sched_start(r.id);
+		v_fired := v_fired + 1;
+		RETURN NEXT;
+	END LOOP;
+	IF v_fired < v_granted THEN
+		PERFORM long_task.sched_admit(p_group_id, v_fired - v_granted, p_rate, p_burst);
+	END IF;
+END;
+$function$
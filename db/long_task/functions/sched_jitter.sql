@@ -0,0 +1,12 @@
+﻿CREATE OR REPLACE FUNCTION long_task.sched_jitter(p_id bigint, p_start timestamp without time zone, p_interval interval, p_spread interval)
+ RETURNS interval
+ LANGUAGE sql
+ IMMUTABLE
+AS $function$
+	-- the same as storage.sched_jitter()
+	SELECT CASE WHEN p_interval IS NULL OR p_spread IS NULL OR p_spread <= interval '0' THEN interval '0'
+	ELSE
+		least(p_spread, (p_start + p_interval) - p_start)
+		* ((((p_id::numeric * 2654435761) % 4294967296) / 4294967296)::double precision)
+	END;
+$function$
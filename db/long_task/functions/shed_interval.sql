@@ -0,0 +1,16 @@
+﻿CREATE OR REPLACE FUNCTION long_task.shed_interval(p_period_id character varying, p_count integer)
+ RETURNS interval
+ LANGUAGE sql
+ IMMUTABLE
+AS $function$
+	SELECT CASE WHEN p_count > 0 THEN
+		CASE p_period_id
+			WHEN 'SEC' THEN make_interval(secs => p_count)
+			WHEN 'MIN' THEN make_interval(mins => p_count)
+			WHEN 'HOU' THEN make_interval(hours => p_count)
+			WHEN 'DAY' THEN make_interval(days => p_count)
+			WHEN 'WEE' THEN make_interval(weeks => p_count)
+			WHEN 'MON' THEN make_interval(months => p_count)
+		END
+	END;
+$function$
@@ -0,0 +1,97 @@
+﻿CREATE OR REPLACE FUNCTION long_task.start_tasks(p_group_id integer, p_worker_id integer, p_count integer, p_cpu_units integer = NULL, p_mem_units integer = NULL)
+ RETURNS SETOF long_task.task
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+  v_ids bigint[]; -- the batch locked
+  v_keys varchar[];
+  v_cpu integer[];
+  v_mem integer[];
+  v_limited varchar[]; -- the limited keys of the batch, their usage rows locked
+  v_left integer[]; -- the tasks of the limited keys may start yet
+  v_claimed bigint[] := '{}';
+  v_cpu_units integer := 0; -- taken by the tasks claimed
+  v_mem_units integer := 0;
+  i integer;
+  k integer;
+BEGIN
+
+	-- The batch is locked at once, rows locked by the concurrent claims are skipped,
+	-- so nodes take different rows. The keys at the limit by concurrency_usage are skipped
+	-- without a lock, as the tasks bigger than the free units of the node
+	-- (p_cpu_units, p_mem_units, NULL - not limited)
+	SELECT array_agg(c.id ORDER BY c.priority, c.last_state_change, c.id),
+		array_agg(c.concurrency_key ORDER BY c.priority, c.last_state_change, c.id),
+		array_agg(c.cpu_units ORDER BY c.priority, c.last_state_change, c.id),
+		array_agg(c.mem_units ORDER BY c.priority, c.last_state_change, c.id)
+	INTO v_ids, v_keys, v_cpu, v_mem
+	FROM (
+      SELECT t.id, t.concurrency_key, t.cpu_units, t.mem_units, t.priority, t.last_state_change
+      FROM long_task.task t
+      WHERE t.group_id=p_group_id
+      AND t.state_id = 'AW'
+      AND (t.worker_id is null or t.worker_id=p_worker_id)
+      AND (p_cpu_units IS NULL OR t.cpu_units <= p_cpu_units)
+      AND (p_mem_units IS NULL OR t.mem_units <= p_mem_units)
+      AND (t.concurrency_key IS NULL OR NOT EXISTS (
+        SELECT 1
+        FROM long_task.concurrency_usage u
+        JOIN long_task.concurrency_limit l ON l.key = u.key
+        WHERE u.key = t.concurrency_key
+        AND u.running >= l.max_count
+      ))
+      ORDER BY t.priority, t.last_state_change
+      LIMIT p_count
+      FOR UPDATE OF t SKIP LOCKED
+	) c;
+	IF v_ids IS NULL THEN
+		RETURN;
+	END IF;
+
+	-- Only the usage rows of the limited keys the batch has are locked, in the key order
+	-- as task_concurrency_tr does, so the claims and the task updates don't deadlock,
+	-- and the limits are rechecked under the lock. A batch with no key locks nothing
+	IF array_length(array_remove(v_keys, NULL), 1) > 0 THEN
+		SELECT array_agg(lk.key ORDER BY lk.key), array_agg(lk.left_count ORDER BY lk.key)
+		INTO v_limited, v_left
+		FROM (
+	      SELECT u.key, l.max_count - u.running AS left_count
+	      FROM long_task.concurrency_usage u
+	      JOIN long_task.concurrency_limit l ON l.key = u.key
+	      WHERE u.key = ANY(v_keys)
+	      ORDER BY u.key
+	      FOR UPDATE OF u
+		) lk;
+	END IF;
+
+	-- the tasks of the batch in the priority order fitting into the units and the limits left
+	FOR i IN 1 .. array_length(v_ids, 1) LOOP
+		CONTINUE WHEN p_cpu_units IS NOT NULL AND v_cpu_units + v_cpu[i] > p_cpu_units;
+		CONTINUE WHEN p_mem_units IS NOT NULL AND v_mem_units + v_mem[i] > p_mem_units;
+		k := array_position(v_limited, v_keys[i]);
+		IF k IS NOT NULL THEN
+			CONTINUE WHEN v_left[k] <= 0;
+			v_left[k] := v_left[k] - 1;
+		END IF;
+		v_claimed := v_claimed || v_ids[i];
+		v_cpu_units := v_cpu_units + v_cpu[i];
+		v_mem_units := v_mem_units + v_mem[i];
+	END LOOP;
+
+	-- one statement, task_concurrency_tr counts the keys once
+	RETURN QUERY
+    WITH claimed AS (
+      UPDATE long_task.task t
+      SET state_id = 'AE',
+          worker_id = p_worker_id,
+          started = now(),
+          error = NULL
+      WHERE t.id = ANY(v_claimed)
+      RETURNING t.*
+    )
+    SELECT *
+    FROM claimed
+    ORDER BY priority, id;
+
+END;
+$function$
\ No newline at end of file
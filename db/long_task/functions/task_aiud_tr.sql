@@ -25,6 +25,7 @@ BEGIN
         END IF;
         RETURN NEW;
     ELSIF TG_OP = 'DELETE' THEN
+    	DELETE FROM long_task.task_log WHERE task_id = OLD.id;
   		RETURN OLD;
     END IF;
 END;
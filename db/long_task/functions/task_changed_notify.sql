@@ -2,15 +2,18 @@
  RETURNS trigger
  LANGUAGE plpgsql
 AS $function$
+DECLARE
+  -- the same as Task.table_fields of node.py
+  v_fields VARCHAR[] := '{state_id,worker_id,group_id,next_start,shed_period_id,shed_period_count,shed_enabled,cleanup_pending,last_state_change}';
 BEGIN
   IF TG_OP = 'INSERT' THEN
-    PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME || '.' || NEW.group_id::varchar, 'I ' || NEW.id::varchar);
+    PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME || '.' || NEW.group_id::varchar, long_task.notify_payload('I', NEW.id, NEW, v_fields));
   	RETURN NEW;
   ELSIF TG_OP = 'UPDATE' THEN
     IF OLD.group_id IS DISTINCT FROM NEW.group_id THEN
-        PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME || '.' || OLD.group_id::varchar, 'U ' || NEW.id::varchar);
+        PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME || '.' || OLD.group_id::varchar, long_task.notify_payload('U', NEW.id, NEW, v_fields));
     END IF;
-    PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME || '.' || NEW.group_id::varchar, 'U ' || NEW.id::varchar);
+    PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME || '.' || NEW.group_id::varchar, long_task.notify_payload('U', NEW.id, NEW, v_fields));
    	RETURN NEW;
   ELSIF TG_OP = 'DELETE' THEN
     PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME || '.' || OLD.group_id::varchar, 'D ' || OLD.id::varchar);
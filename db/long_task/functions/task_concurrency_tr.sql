@@ -0,0 +1,53 @@
+﻿CREATE OR REPLACE FUNCTION long_task.task_concurrency_tr()
+ RETURNS trigger
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+  v_keys varchar[];
+  v_deltas integer[];
+BEGIN
+	-- concurrency_usage: the executing (AE, AC) tasks per limited concurrency_key (the keys with no usage row
+	-- are not counted). Once per statement, the usage rows are locked in the key order, so the statements
+	-- changing several keys (the node write-behind) don't deadlock each other and start_tasks
+	IF TG_OP = 'UPDATE' THEN
+		SELECT array_agg(d.key ORDER BY d.key), array_agg(d.delta ORDER BY d.key)
+		INTO v_keys, v_deltas
+		FROM (
+			SELECT k.key, sum(k.delta)::integer AS delta
+			FROM (
+				SELECT o.concurrency_key AS key, -1 AS delta
+				FROM old_rows o
+				WHERE o.state_id in ('AE', 'AC') AND o.concurrency_key IS NOT NULL
+				UNION ALL
+				SELECT n.concurrency_key, 1
+				FROM new_rows n
+				WHERE n.state_id in ('AE', 'AC') AND n.concurrency_key IS NOT NULL
+			) k
+			GROUP BY k.key
+			HAVING sum(k.delta) <> 0
+		) d;
+	ELSE
+		SELECT array_agg(d.key ORDER BY d.key), array_agg(d.delta ORDER BY d.key)
+		INTO v_keys, v_deltas
+		FROM (
+			SELECT o.concurrency_key AS key, -count(*)::integer AS delta
+			FROM old_rows o
+			WHERE o.state_id in ('AE', 'AC') AND o.concurrency_key IS NOT NULL
+			GROUP BY o.concurrency_key
+		) d;
+	END IF;
+	IF v_keys IS NULL THEN
+		RETURN NULL;
+	END IF;
+	PERFORM 1
+	FROM long_task.concurrency_usage u
+	WHERE u.key = ANY(v_keys)
+	ORDER BY u.key
+	FOR UPDATE;
+	UPDATE long_task.concurrency_usage u
+	SET running = u.running + d.delta
+	FROM unnest(v_keys, v_deltas) d(key, delta)
+	WHERE u.key = d.key;
+	RETURN NULL;
+END;
+$function$
\ No newline at end of file
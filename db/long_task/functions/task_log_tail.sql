@@ -0,0 +1,12 @@
+﻿CREATE OR REPLACE FUNCTION long_task.task_log_tail(p_task_id bigint, p_after_seq bigint, p_limit integer = 1000)
+ RETURNS SETOF long_task.task_log
+ LANGUAGE sql
+ STABLE
+AS $function$
+	SELECT *
+	FROM long_task.task_log
+	WHERE task_id = p_task_id
+		AND seq > coalesce(p_after_seq, 0)
+	ORDER BY seq
+	LIMIT p_limit;
+$function$
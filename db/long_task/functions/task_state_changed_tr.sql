@@ -8,11 +8,15 @@ BEGIN
             NEW.last_state_change = now();
             IF NEW.state_id = 'AW' THEN
                 NEW.error = NULL;
+                NEW.queued = now();
             END IF;
         END IF;
    		RETURN NEW;
     ELSIF TG_OP = 'INSERT' THEN
 		NEW.last_state_change = now();
+        IF NEW.state_id = 'AW' THEN
+            NEW.queued = now();
+        END IF;
         RETURN NEW;
     ELSIF TG_OP = 'DELETE' THEN
   		RETURN OLD;
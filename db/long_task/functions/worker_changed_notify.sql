@@ -2,12 +2,15 @@
  RETURNS trigger
  LANGUAGE plpgsql
 AS $function$
+DECLARE
+  -- the same as Worker.table_fields of node.py
+  v_fields VARCHAR[] := '{active,locked_until,stop}';
 BEGIN
   IF TG_OP = 'INSERT' THEN
-    PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME, 'I ' || NEW.id::varchar);
+    PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME, long_task.notify_payload('I', NEW.id, NEW, v_fields));
   	RETURN NEW;
   ELSIF TG_OP = 'UPDATE' THEN
-    PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME, 'U ' || NEW.id::varchar);
+    PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME, long_task.notify_payload('U', NEW.id, NEW, v_fields));
    	RETURN NEW;
   ELSIF TG_OP = 'DELETE' THEN
     PERFORM pg_notify('!'||TG_TABLE_SCHEMA||'.'||TG_TABLE_NAME, 'D ' || OLD.id::varchar);
@@ -0,0 +1,3 @@
+﻿DROP TRIGGER IF EXISTS concurrency_limit_aiud_tr ON long_task.concurrency_limit;
+
+CREATE TRIGGER concurrency_limit_aiud_tr AFTER INSERT OR DELETE OR UPDATE OF key ON long_task.concurrency_limit FOR EACH ROW EXECUTE FUNCTION concurrency_limit_aiud_tr()
\ No newline at end of file
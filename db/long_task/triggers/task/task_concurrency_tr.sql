@@ -0,0 +1,7 @@
+﻿DROP TRIGGER IF EXISTS task_concurrency_u_tr ON long_task.task;
+
+CREATE TRIGGER task_concurrency_u_tr AFTER UPDATE ON long_task.task REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION task_concurrency_tr();
+
+DROP TRIGGER IF EXISTS task_concurrency_d_tr ON long_task.task;
+
+CREATE TRIGGER task_concurrency_d_tr AFTER DELETE ON long_task.task REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION task_concurrency_tr()
\ No newline at end of file
@@ -0,0 +1,93 @@
+# This code is under MIT licence, you can find the complete file here: https://github.com/ivanovrvl/pg_tasks/blob/main/LICENSE
+import threading
+from contextlib import contextmanager
+import psycopg2
+
+class ConnectionPool:
+    """
+    A small set of DB connections for the commands
+    A broken connection is dropped and a new one is made on the next use,
+    so a DB error fails the current command only.
+    Nested use in the same thread shares the connection taken
+    """
+
+    def __init__(self, connect, max_size:int=1):
+        self._connect = connect
+        self.max_size = max_size
+        self._idle = []
+        self._count = 0 # connections made and not dropped
+        self._cond = threading.Condition()
+        self._local = threading.local()
+
+    def _acquire(self):
+        with self._cond:
+            while True:
+                while len(self._idle) > 0:
+                    conn = self._idle.pop()
+                    if not conn.closed:
+                        return conn
+                    self._count -= 1
+                if self._count < self.max_size:
+                    self._count += 1
+                    break
+                self._cond.wait()
+        try:
+            return self._connect()
+        except:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, conn, broken:bool=False):
+        with self._cond:
+            if broken or conn.closed:
+                self._count -= 1
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            else:
+                self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None:
+            local.depth += 1
+            try:
+                yield conn
+            finally:
+                local.depth -= 1
+            return
+        conn = self._acquire()
+        local.conn = conn
+        local.depth = 1
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            local.conn = None
+            local.depth = 0
+            self._release(conn, broken)
+
+    @contextmanager
+    def cursor(self, *args, **kwargs):
+        with self.connection() as conn:
+            with conn.cursor(*args, **kwargs) as cur:
+                yield cur
+
+    def close(self):
+        with self._cond:
+            for conn in self._idle:
+                self._count -= 1
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+            self._idle.clear()
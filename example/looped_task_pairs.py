@@ -2,6 +2,8 @@
 # 1 <-> 2
 # 3 <-> 4
 # ...
+# Runs as an OS process: {python,example/looped_task_pairs.py,%TASK}
+# or in the warm interpreter pool: {py:example.looped_task_pairs:main,%TASK}
 
 import os
 import sys
@@ -11,7 +13,7 @@ import random
 import psycopg2
 from psycopg2.extras import Json
 
-if True:
+def main():
 
     task_id = int(sys.argv[1])
 
@@ -57,4 +59,7 @@ if True:
     finally:
         conn.close()
 
-#time.sleep(0.1)
\ No newline at end of file
+#time.sleep(0.1)
+
+if __name__ == '__main__':
+    main()
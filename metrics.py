@@ -0,0 +1,143 @@
+# This code is under MIT licence, you can find the complete file here: https://github.com/ivanovrvl/pg_tasks/blob/main/LICENSE
+"""
+Node metrics in Prometheus text format served by HTTP (config.metrics_port)
+
+The metrics are updated by the main loop with a few arithmetic operations,
+the text is made by the HTTP server thread on request only
+"""
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+registry = []
+lock = threading.Lock()
+
+class Metric:
+
+    type_name = None
+
+    def __init__(self, name:str, help:str):
+        self.name = name
+        self.help = help
+        registry.append(self)
+
+    def samples(self) -> list:
+        return []
+
+    def render(self) -> list:
+        lines = ['# HELP ' + self.name + ' ' + self.help, '# TYPE ' + self.name + ' ' + self.type_name]
+        for name, value in self.samples():
+            lines.append(name + ' ' + repr(float(value)))
+        return lines
+
+class Counter(Metric):
+
+    type_name = 'counter'
+
+    def __init__(self, name:str, help:str, func=None):
+        super().__init__(name, help)
+        self.value = 0
+        self.func = func # the value getter instead of inc()
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self) -> list:
+        return [(self.name, self.func() if self.func is not None else self.value)]
+
+class Gauge(Metric):
+
+    type_name = 'gauge'
+
+    def __init__(self, name:str, help:str, func=None):
+        super().__init__(name, help)
+        self.value = 0
+        self.func = func # the value getter instead of set()
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self) -> list:
+        return [(self.name, self.func() if self.func is not None else self.value)]
+
+class Histogram(Metric):
+
+    type_name = 'histogram'
+
+    def __init__(self, name:str, help:str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value:float):
+        i = bisect.bisect_left(self.buckets, value)
+        with lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t)
+
+    def samples(self) -> list:
+        with lock:
+            counts = list(self.counts)
+            sum = self.sum
+        res = []
+        total = 0
+        for bound, count in zip(self.buckets, counts):
+            total += count
+            res.append((self.name + '_bucket{le="' + repr(float(bound)) + '"}', total))
+        total += counts[-1]
+        res.append((self.name + '_bucket{le="+Inf"}', total))
+        res.append((self.name + '_sum', sum))
+        res.append((self.name + '_count', total))
+        return res
+
+def render() -> str:
+    lines = []
+    for metric in registry:
+        try:
+            lines.extend(metric.render())
+        except Exception as e:
+            lines.append('# ' + metric.name + ' ' + str(e))
+    return '\n'.join(lines) + '\n'
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_server(host:str, port:int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+queue_wait = Histogram('long_task_queue_wait_seconds', 'Time from AW to AE (claimed by this node)', \
+    (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 1800))
+spawn_latency = Histogram('long_task_spawn_seconds', 'Time to start a task OS process')
+start_tasks_time = Histogram('long_task_start_tasks_seconds', 'start_tasks (claim) round trip')
+lock_worker_time = Histogram('long_task_lock_worker_seconds', 'lock_worker (lease) round trip')
+controller_pass = Histogram('long_task_controller_pass_seconds', 'controller.process pass duration')
+refresh_time = Histogram('long_task_refresh_seconds', 'Tasks refresh (all the chunks) duration', \
+    (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+refresh_peak_rss = Gauge('long_task_refresh_peak_rss_bytes', 'RSS growth during the last tasks refresh')
+lease_margin = Gauge('long_task_lease_margin_seconds', 'Time left to the lease deadline when it was prolonged last time')
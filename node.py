@@ -2,13 +2,18 @@
 import json
 import sys, os, select, time, datetime
 import psycopg2.extensions
-import subprocess
 from datetime import datetime, timedelta
-from dateutil.relativedelta import relativedelta
 from config import get_config, Messages
-import copy
+import storage as storage_module
+import spawn
+import pypool
+from task_log import TaskLogWriter
+import metrics
+import profiler
 import signal
 import eventfd
+import pressure
+import adaptive
 
 class AttrDict(dict):
     def __transform__(value):
@@ -27,13 +32,10 @@ config = AttrDict(get_config())
 #config.debug = True
 
 capture_stdout = config.capture_stdout
-if capture_stdout is not None and capture_stdout > 0:
-    import queue
-    import threading
-else:
+if capture_stdout is None or capture_stdout < 0:
     capture_stdout = 0
 
-sys.path.append(os.path.abspath('py_active_objects'))
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'py_active_objects'))
 from active_objects import ActiveObjectWithRetries, ActiveObjectsController
 
 controller = ActiveObjectsController(priority_count=2)
@@ -43,7 +45,10 @@ refreshTasks = None
 refreshWorkers = None
 worker = None # Node`s worker
 
-conn = None # DB Connection
+storage = None # storage.PgStorage or storage.MemoryStorage (config.storage)
+listener = None # storage listener of the notifications
+
+NOT_LOADED = object() # DbObject._db_version before the state is read
 
 no_more_waiting_tasks = False # no more AW tasks
 locked_other_workers_count = 0
@@ -53,38 +58,134 @@ wakeup = eventfd.EventFD()
 def get_msg(msg_const:str, default:str):
     return messages.get(msg_const, default)
 
+def deobfuscate(password:str) -> str:
+    return password
+
 child_processes = {}
 
-def capture_stdout_func(input, buffer, max_size):
-    while True:
-        b = input.readline()
-        if not b: break
-        buffer.put(b)
-        while buffer.qsize() > capture_stdout:
-            buffer.get()
+spawner = spawn.PopenSpawner() # replaced in run() according to config.spawn_backend
+py_pool = None # pypool.PyPool for the py:module:function commands if config.py_pool_size > 0
+
+io_handlers = {} # file object -> callback, watched by the main loop
+output_handlers = {} # processes output pipe -> callback, not watched while task_log_writer is full
+
+task_log_writer = None # TaskLogWriter if config.task_log
+
+# the limit of the running tasks adjusted by their duration, failures and throughput, None - max_task_count
+task_limiter = adaptive.AimdLimit(min(config.min_task_count, config.max_task_count), config.max_task_count, \
+    config.adaptive_latency_tolerance, config.adaptive_max_failure_rate, config.adaptive_decrease, \
+    initial_limit=config.initial_task_count) \
+    if config.adaptive_task_count else None
+
+def task_limit() -> int:
+    return task_limiter.limit if task_limiter is not None else config.max_task_count
+
+# stops the claims while the host is overloaded (PSI, cgroup memory)
+pressure_gate = pressure.PressureGate(config.psi_cpu_limit, config.psi_memory_limit, config.psi_io_limit, \
+    config.cgroup_memory_limit, config.pressure_check_interval.total_seconds())
+
+class OutputBuffer:
+    """
+    Ring buffer keeping the last size bytes of the process output
+    """
+    def __init__(self, size:int):
+        self.buf = bytearray(size)
+        self.size = size
+        self.pos = 0
+        self.full = False
+
+    def write(self, data:bytes):
+        n = len(data)
+        if n >= self.size:
+            self.buf[:] = data[n - self.size:]
+            self.pos = 0
+            self.full = True
+            return
+        end = self.pos + n
+        if end <= self.size:
+            self.buf[self.pos:end] = data
+        else:
+            k = self.size - self.pos
+            self.buf[self.pos:] = data[:k]
+            self.buf[:n - k] = data[k:]
+        if end >= self.size:
+            self.full = True
+        self.pos = end % self.size
+
+    def getvalue(self) -> bytes:
+        if self.full:
+            return bytes(self.buf[self.pos:]) + bytes(self.buf[:self.pos])
+        return bytes(self.buf[:self.pos])
+
+    def clear(self):
+        self.pos = 0
+        self.full = False
+
+def get_command_line(commands:list, id) -> list:
+    cmds = []
+    for c in commands:
+        if c == '%TASK':
+            cmds.append(str(id))
+        else:
+            cmds.append(c)
+    return cmds
 
 class TaskProcess:
     """
     OS process wrapper
     """
     def __init__(self, commands:list, id, cwd=None, capture_stdout:int=0):
-        cmds = []
-        for c in commands:
-            if c == '%TASK':
-                cmds.append(str(id))
-            else:
-                cmds.append(c)
+        cmds = get_command_line(commands, id)
         self.id = id
         self.wait_until = None
         self.exit_code = None
         self.capture_stdout = capture_stdout
-        if self.capture_stdout > 0:
-            self.stdout = queue.Queue()
-            self.proc = subprocess.Popen(cmds, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd = cwd)
-            self.stdout_thread = threading.Thread(target=capture_stdout_func, args=(self.proc.stdout, self.stdout, self.capture_stdout))
-            self.stdout_thread.start()
-        else:
-            self.proc = subprocess.Popen(cmds, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd = cwd)
+        self.task_log = task_log_writer
+        capture = self.capture_stdout > 0 or self.task_log is not None
+        self.proc = None
+        if py_pool is not None and pypool.is_py_command(cmds):
+            self.proc = py_pool.spawn(cmds, cwd, capture=capture)
+        if self.proc is None:
+            self.proc = spawner.spawn(pypool.command_line(cmds), cwd, capture=capture)
+        self.stdout = OutputBuffer(self.capture_stdout) if self.capture_stdout > 0 else None
+        self.stdout_file = None
+        if capture:
+            # the pipe is read by the main loop
+            self.stdout_file = self.proc.stdout
+            os.set_blocking(self.stdout_file.fileno(), False)
+            output_handlers[self.stdout_file] = self.read_stdout
+        # the exit comes as an event, no need to poll
+        self.exit_reported = getattr(self.proc, 'reports_exit', False)
+        self.pidfd = None
+        if config.child_supervision == 'pidfd' and not self.exit_reported:
+            try:
+                self.pidfd = os.pidfd_open(self.proc.pid)
+            except (AttributeError, OSError) as e:
+                print(e) # polled
+            else:
+                io_handlers[self.pidfd] = self.on_pidfd
+                self.exit_reported = True
+
+    def on_pidfd(self):
+        io_handlers.pop(self.pidfd, None)
+        exit_code = self.proc.poll()
+        if exit_code is not None:
+            terminated_processes_backlog.append((self.proc.pid, exit_code))
+
+    def read_stdout(self, max_reads:int=16): # don`t stall the loop with a chatty process
+        fd = self.stdout_file.fileno()
+        for i in range(max_reads):
+            try:
+                b = os.read(fd, 65536)
+            except BlockingIOError:
+                return
+            if not b:
+                output_handlers.pop(self.stdout_file, None)
+                return
+            if self.stdout is not None:
+                self.stdout.write(b)
+            if self.task_log is not None:
+                self.task_log.write(self.id, b)
 
     def set_exit_code(self, exit_code:int):
         if self.proc is not None:
@@ -108,20 +209,38 @@ class TaskProcess:
             self.proc.kill()
 
     def close(self):
+        if self.pidfd is not None:
+            if self.exit_code is None:
+                # left running (killed), reaped on exit
+                proc, pidfd = self.proc, self.pidfd
+                def reap():
+                    io_handlers.pop(pidfd, None)
+                    os.close(pidfd)
+                    proc.poll()
+                io_handlers[pidfd] = reap
+            else:
+                io_handlers.pop(self.pidfd, None)
+                os.close(self.pidfd)
+            self.pidfd = None
         if self.proc is not None:
-            if self.capture_stdout > 0:
-                self.proc.stdout.close()
+            if self.stdout_file is not None:
+                # the rest of the output written before the exit
+                if self.stdout_file in output_handlers:
+                    self.read_stdout(max_reads=64)
+                output_handlers.pop(self.stdout_file, None)
+                self.stdout_file.close()
             self.proc = None
 
     def get_error(self)->str:
-        if self.capture_stdout > 0:
-            s = b''
-            while self.stdout.qsize() > 0:
-                s += self.stdout.get()
+        if self.stdout is not None:
+            s = self.stdout.getvalue()
+            self.stdout.clear()
             return Messages.TASK_FAILED.format(self.exit_code) + '\n' + s.decode('cp866')
         else:
             return Messages.TASK_FAILED.format(self.exit_code)
 
+process_class = TaskProcess # replaced by the engine if it manages processes itself
+
 class CommonTask(ActiveObjectWithRetries):
 
     def __init__(self, controller, type_name = None, id = None):
@@ -138,35 +257,100 @@ class CommonTask(ActiveObjectWithRetries):
             print(msg)
 
     def process_internal(self):
+        t = profiler.begin()
         try:
             super().process_internal()
         except Exception as e:
             self.error(str(e))
             if config.debug:
                 raise e
+        finally:
+            profiler.end(self, t)
 
 class RefreshWorkers(CommonTask):
     """
-    Periodically updates the states of each Worker from the DB, creates new ones if necessary
+    Periodically updates the states of each Worker from the DB, creates new ones if necessary.
+    With config.watchdog = "elected" only the node`s worker is read, the other workers
+    are watched by the leader node: the one holding the advisory lock scans for the expired ones
     """
 
     def __init__(self, controller):
         super().__init__(controller)
+        self.priority = 1 # the worker lock prolongation goes first
         self.next_refresh = None
+        self.is_leader = False
+        self.dead_since = {} # config.liveness = "session": worker id -> when first seen with no session
 
     def process(self):
         if self.reached(self.next_refresh):
             self.next_refresh = self.controller.now() + config.workers_refresh_inverval
             self.schedule(self.next_refresh)
             self.info(Messages.REFRESH_WORKERS)
-            with conn.cursor() as cur:
-                sql = """
-                    SELECT id,""" + ','.join(Worker.table_fields) + """
-                    FROM """ + Worker.table_name + """
-                    """
+            if config.watchdog == 'elected':
+                self.watch()
+            else:
                 expected_ids = controller.get_ids(Worker.type_name)
-                cur.execute(sql)
-                refresh_db_states(cur, Worker, set(expected_ids))
+                failed = self.note_dead(storage.select_dead_workers(Worker)) if config.liveness == 'session' else []
+                apply_db_states(Worker, storage.select(Worker), set(expected_ids))
+                for db_state in failed:
+                    # recovered by Worker.process
+                    w = controller.find(Worker.type_name, db_state.id)
+                    if w is not None:
+                        w.signal()
+
+    def watch(self):
+        db_states = storage.select(Worker, [config.worker_id])
+        expected_ids = set([config.worker_id])
+        try:
+            is_leader = storage.try_lead(config.schema + '.watchdog')
+        except Exception:
+            self.set_leader(False)
+            raise
+        self.set_leader(is_leader)
+        if is_leader:
+            if config.liveness == 'session':
+                failed = self.note_dead(storage.select_dead_workers(Worker))
+            else:
+                failed = storage.select_expired_workers(Worker, config.failed_worker_recovery_delay)
+            for db_state in failed:
+                if db_state.id != config.worker_id:
+                    # recovered and closed by Worker.process
+                    Worker.find_or_new(db_state.id)
+                    db_states.append(db_state)
+        apply_db_states(Worker, db_states, expected_ids)
+
+    def note_dead(self, db_states:list) -> list:
+        """
+        config.liveness = "session": remembers when the workers were first seen with no session holding the lock,
+        returns the ones failed: with no session for two half_locking_time (the node keeps the lock state
+        reconnecting so long) plus failed_worker_recovery_delay, as the lease expires
+        """
+        now = self.controller.now()
+        ids = set(db_state.id for db_state in db_states)
+        for id in list(self.dead_since):
+            if id not in ids:
+                del self.dead_since[id]
+        failed = []
+        for db_state in db_states:
+            t = self.dead_since.setdefault(db_state.id, now) + config.half_locking_time + config.half_locking_time \
+                + config.failed_worker_recovery_delay
+            if t <= now:
+                failed.append(db_state)
+            elif t < self.next_refresh:
+                # check again then
+                self.next_refresh = t
+                self.schedule(t)
+        return failed
+
+    def is_dead(self, id) -> bool:
+        t = self.dead_since.get(id)
+        return t is not None and t + config.half_locking_time + config.half_locking_time \
+            + config.failed_worker_recovery_delay <= self.controller.now()
+
+    def set_leader(self, val:bool):
+        if self.is_leader != val:
+            self.is_leader = val
+            self.info(Messages.WATCHDOG_LEADER if val else Messages.WATCHDOG_FOLLOWER)
 
     def refresh_all(self):
         self.next_refresh = None
@@ -180,35 +364,76 @@ class RefreshTasks(CommonTask):
 
     def __init__(self, controller):
         super().__init__(controller)
+        self.priority = 1 # the worker lock prolongation goes first
         self.next_refresh = None
+        self.cursor = None # the refresh in progress, one chunk per pass
+        self.expected_ids = None # loaded when the refresh started
+        self.found_ids = None
+        self.touched = set() # notified since the refresh started, the chunks are older
+        self.chunks = 0
+        self.started = None
+        self.start_rss = 0
+        self.peak_rss = 0
 
     def process(self):
         global no_more_waiting_tasks
-        if self.reached(self.next_refresh):
+        if self.cursor is not None:
+            self.fetch_chunk()
+        elif self.reached(self.next_refresh):
             no_more_waiting_tasks = True
             self.info(Messages.REFRESH_TASKS)
             # update the status of tasks every 55 minutes
             # because we keep loaded only plans for the next hour
             self.next_refresh = self.controller.now() + timedelta(minutes=55)
             self.schedule(self.next_refresh)
-            with conn.cursor() as cur:
-                sql = """
-                    SELECT id,""" + ','.join(Task.table_fields) + """
-                    FROM """ + Task.table_name + """
-                    WHERE (
-                    	group_id = %s
-                        and (
-                        	state_id like %s
-                            or
-                            (next_start is not null and next_start < now() + interval '1 hour')
-                        )
-                    ) or id = any(%s)
-                    """
-                expected_ids = controller.get_ids(Task.type_name)
-                cur.execute(sql, (config.group_id, 'A%', expected_ids))
-                refresh_db_states(cur, Task, set(expected_ids))
+            self.expected_ids = set(controller.get_ids(Task.type_name))
+            self.found_ids = set()
+            self.touched.clear()
+            self.chunks = 0
+            self.started = time.monotonic()
+            self.start_rss = self.peak_rss = pypool.get_rss()
+            self.cursor = storage.open_tasks_cursor(Task, config.group_id, list(self.expected_ids), config.refresh_chunk_size)
+            self.fetch_chunk()
+
+    def fetch_chunk(self):
+        try:
+            db_states = self.cursor.fetch()
+        except Exception:
+            self.close_cursor()
+            self.next_refresh = None # start again on retry
+            raise
+        if len(db_states) == 0:
+            self.close_cursor()
+            for id in self.expected_ids.difference(self.found_ids):
+                obj = controller.find(Task.type_name, id)
+                if obj is not None and id not in self.touched:
+                    obj.set_deleted()
+            dt = time.monotonic() - self.started
+            metrics.refresh_time.observe(dt)
+            metrics.refresh_peak_rss.set(self.peak_rss - self.start_rss)
+            self.info(Messages.TASKS_REFRESHED.format(len(self.found_ids), self.chunks, dt, (self.peak_rss - self.start_rss) // 1024))
+            self.expected_ids = None
+            self.found_ids = None
+            return
+        self.chunks += 1
+        self.found_ids.update(s.id for s in db_states)
+        apply_db_states(Task, [s for s in db_states if s.id not in self.touched], skip_older=True)
+        rss = pypool.get_rss()
+        if rss > self.peak_rss:
+            self.peak_rss = rss
+        self.signal() # the next chunk on the next pass
+
+    def close_cursor(self):
+        if self.cursor is not None:
+            cursor = self.cursor
+            self.cursor = None
+            try:
+                cursor.close()
+            except Exception as e:
+                print('ERROR', e)
 
     def refresh_all(self):
+        self.close_cursor()
         self.next_refresh = None
         self.process()
 
@@ -226,80 +451,78 @@ class DbObject(CommonTask):
     table_name = None
     table_fields = None
     version_field_name = None
+    timestamp_fields = () # fields parsed from ISO strings of the notification payload
+    row_class = None # storage.row_class() of the table_fields
 
     def __init__(self, controller, id = None):
         super().__init__(controller, self.__class__.type_name, id)
-        self._old_db_state = None # last known DB state
-        self.db_state = None # current state
-        self.changed_fields = set()
+        self._db_version = NOT_LOADED # version of the last known DB state
+        self.db_state = None # current state, row_class
+        self.changed_mask = 0 # row_class.bits of the fields changed
         self.is_deleted = False
 
     def set_field(self, name:str, value, set_changed:bool=True):
         if self.db_state is None:
             raise Exception("Can`t set field")
-        try:
-            cur = self.db_state[name]
-            if cur is value or cur == value:
-                return False
-        except KeyError:
-            pass
-        self.db_state[name] = value
+        cur = getattr(self.db_state, name)
+        if cur is value or cur == value:
+            return False
+        setattr(self.db_state, name, value)
         if set_changed:
-            self.changed_fields.add(name)
+            self.changed_mask |= self.db_state.bits[name]
         return True
 
     def set_deleted(self):
         self.info("DELETED")
         self.is_deleted = True
-        self._old_db_state = None
+        self._db_version = NOT_LOADED
         self.db_state = None
-        self.changed_fields.clear()
+        self.changed_mask = 0
         self.signal()
 
     def set_db_state(self, state):
-        if self._old_db_state is None \
-        or (self.__class__.version_field_name is not None \
-        and self._old_db_state[self.__class__.version_field_name] != state[self.__class__.version_field_name]):
-            self._old_db_state = state
-            self.db_state = copy.copy(state)
-            self.changed_fields.clear()
-        else:
-            self._old_db_state = state
-            old = self.db_state
-            self.db_state = copy.copy(state)
-            for n in self.changed_fields:
-                self.db_state[n] = old[n]
+        version_field_name = self.__class__.version_field_name
+        version = getattr(state, version_field_name) if version_field_name is not None else None
+        if self._db_version is NOT_LOADED \
+        or (version_field_name is not None and self._db_version != version):
+            self.changed_mask = 0
+        elif self.changed_mask != 0:
+            # the changes not written yet are kept
+            state.merge(self.db_state, self.changed_mask)
+        self._db_version = version
+        self.db_state = state
         self.signal()
 
     def refresh_db_state(self):
-        self._old_db_state = None
-        with conn.cursor() as cur:
-            sql = """
-                SELECT id,""" + ','.join(self.__class__.table_fields) + """
-                FROM """ + self.__class__.table_name + """
-                WHERE id = %s"""
-            cur.execute(sql, (self.id,))
-            refresh_db_states(cur, self.__class__, set([self.id]))
+        if self in self.__class__.dirty:
+            # don`t lose the changes not written yet
+            self.__class__.dirty.discard(self)
+            self.write_db_state()
+        self._db_version = NOT_LOADED
+        apply_db_states(self.__class__, storage.select(self.__class__, [self.id]), set([self.id]))
 
     def save_db_state(self):
-        if len(self.changed_fields) > 0:
-            sql = """
-                update """ + self.__class__.table_name + """
-                set """ + ','.join([n + '=%s' for n in self.changed_fields]) + """
-                where id=%s
-            """
-            values = [self.db_state[n] for n in self.changed_fields]
-            values.append(self.id)
-            if self.__class__.version_field_name is not None:
-                values.append(self.db_state[self.__class__.version_field_name])
-                sql = sql + "and " + self.__class__.version_field_name + "=%s"
-            with conn.cursor() as cur:
-                cur.execute(sql, values)
-                self.changed_fields.clear()
-                if cur.rowcount == 0:
-                    self.refresh_db_state()
-                    if config.debug:
-                        self.error(Messages.TASK_CATCHED_BY_OTHER_SIDE)
+        """
+        Writes the changed fields, with config.write_behind they are written by save_db_states()
+        at the end of the controller pass
+        """
+        if self.changed_mask != 0:
+            if config.write_behind:
+                self.__class__.dirty.add(self)
+            else:
+                self.write_db_state()
+
+    def write_db_state(self):
+        if self.changed_mask != 0:
+            cls = self.__class__
+            values = {n: getattr(self.db_state, n) for n in cls.row_class.mask_fields(self.changed_mask)}
+            version = getattr(self.db_state, cls.version_field_name) if cls.version_field_name is not None else None
+            saved = storage.update(cls, self.id, values, version)
+            self.changed_mask = 0
+            if not saved:
+                self.refresh_db_state()
+                if config.debug:
+                    self.error(Messages.TASK_CATCHED_BY_OTHER_SIDE)
 
     def info(self, msg:str):
         if msg is not None:
@@ -309,38 +532,140 @@ class DbObject(CommonTask):
         if msg is not None:
             super().error(self.type_name + str(self.id) + '! ' + msg)
 
+    @classmethod
+    def save_db_states(cls):
+        """
+        Writes the changes of all the dirty objects, one UPDATE per set of the fields changed
+        """
+        groups = {}
+        for obj in cls.dirty:
+            if obj.changed_mask != 0 and obj.db_state is not None:
+                groups.setdefault(obj.changed_mask, []).append(obj)
+        cls.dirty.clear()
+
+        lost = []
+        try:
+            for mask, objs in groups.items():
+                if len(objs) == 1:
+                    objs[0].write_db_state()
+                    continue
+                fields = cls.row_class.mask_fields(mask)
+                records = []
+                for obj in objs:
+                    r = {n: getattr(obj.db_state, n) for n in fields}
+                    r['id'] = obj.id
+                    if cls.version_field_name is not None:
+                        r[cls.version_field_name] = getattr(obj.db_state, cls.version_field_name)
+                    records.append(r)
+                saved = storage.update_many(cls, fields, records)
+                for obj in objs:
+                    obj.changed_mask = 0
+                    if obj.id not in saved:
+                        lost.append(obj)
+        except Exception:
+            # to be written on the next pass
+            for objs in groups.values():
+                cls.dirty.update(obj for obj in objs if obj.changed_mask != 0)
+            raise
+
+        if len(lost) > 0:
+            # the version race is lost, the same as in write_db_state()
+            for obj in lost:
+                obj._db_version = NOT_LOADED
+                if config.debug:
+                    obj.error(Messages.TASK_CATCHED_BY_OTHER_SIDE)
+            ids = set(obj.id for obj in lost)
+            apply_db_states(cls, storage.select(cls, list(ids)), ids)
+
     @classmethod
     def clear_changes(cls):
         cls.changed.clear()
+        cls.states.clear()
         cls.deleted.clear()
 
     @classmethod
-    def add_change(cls, msg:str):
+    def parse_db_state(cls, id, payload:str) -> map:
+        """
+        Makes the DB state from the JSON of the notification payload.
+        Returns None if it can`t be used instead of reading the record
+        """
+        try:
+            state = json.loads(payload)
+            values = []
+            for n in cls.table_fields:
+                value = state[n]
+                if value is not None and n in cls.timestamp_fields:
+                    value = datetime.fromisoformat(value)
+                values.append(value)
+            return cls.row_class(id, *values)
+        except Exception as e:
+            if config.debug:
+                print('Bad payload', id, e)
+            return None
+
+    @classmethod
+    def has_changes(cls) -> bool:
+        return len(cls.changed) > 0 or len(cls.states) > 0 or len(cls.deleted) > 0
+
+    @classmethod
+    def add_change(cls, msg:str) -> bool:
+        """
+        Registers the change notified. Returns False if the id is already pending
+        """
         if len(msg) > 2 and msg[1] == ' ' and msg[0] in ('I','U','D'):
-            id = int(msg[2:])
+            # "<op> <id>" or "<op> <id> <json state>"
+            s = msg[2:].split(' ', 1)
+            id = int(s[0])
+            if not cls.is_watched(id):
+                return False
+            is_new = not (id in cls.changed or id in cls.states or id in cls.deleted)
             if msg[0] == 'D':
                 cls.deleted.add(id)
             else:
-                cls.changed.add(id)
+                db_state = None
+                if len(s) > 1 and config.notify_payload:
+                    db_state = cls.parse_db_state(id, s[1])
+                if db_state is None:
+                    cls.states.pop(id, None)
+                    cls.changed.add(id)
+                else:
+                    # the latest notification wins
+                    cls.changed.discard(id)
+                    cls.states[id] = db_state
+            return is_new
+        return False
+
+    @classmethod
+    def is_watched(cls, id) -> bool:
+        """
+        The changes of the record are of interest
+        """
+        return True
 
     @classmethod
-    def apply_changes(cls):
-        with conn.cursor() as cur:
-            sql = """
-                SELECT id,""" + ','.join(cls.table_fields) + """
-                FROM """ + cls.table_name + """
-                WHERE id = any(%s)
-                """
-            cur.execute(sql, (list(cls.changed.difference(cls.deleted)),))
-            refresh_db_states(cur, cls)
-            cls.changed.clear()
-
-            for id in cls.deleted:
-                task = controller.find(cls.type_name, id)
-                if task is not None:
-                    task.set_deleted()
-
-            cls.deleted.clear()
+    def changed_ids(cls) -> set:
+        """
+        Ids to be re-read from the DB
+        """
+        return cls.changed.difference(cls.deleted)
+
+    @classmethod
+    def apply_changes(cls, db_states:list):
+        """
+        Applies the states read for changed_ids() and the ones carried by the notifications
+        """
+        cls.changed.clear()
+        db_states.extend(s for id, s in cls.states.items() if id not in cls.deleted)
+        cls.states.clear()
+        if len(db_states) > 0:
+            apply_db_states(cls, db_states)
+
+        for id in cls.deleted:
+            task = controller.find(cls.type_name, id)
+            if task is not None:
+                task.set_deleted()
+
+        cls.deleted.clear()
 
     @classmethod
     def find_or_new(cls, id) -> CommonTask:
@@ -357,13 +682,19 @@ class Worker(DbObject):
     table_name = config.schema + ".worker"
     table_fields = ['active', 'locked_until', 'stop']
     notify_key = '!' + table_name
+    row_class = storage_module.row_class('WorkerRow', table_fields)
 
+    timestamp_fields = ('locked_until',)
+
+    dirty = set()
     changed = set()
+    states = {}
     deleted = set()
 
     def __init__(self, controller, id = None):
         super().__init__(controller, id)
         self.lock_time = None
+        self.next_check = None # config.liveness = "session"
         self.stop = 0
         self.has_lock = False
         #self.state = 0
@@ -384,6 +715,7 @@ class Worker(DbObject):
             if self.id == config.worker_id:
                 startMoreTasks.start_more()
                 refreshTasks.refresh_all()
+                scheduleTasks.refresh_all()
             else:
                 locked_other_workers_count += 1
         else:
@@ -407,35 +739,87 @@ class Worker(DbObject):
                 self.controller.signal(Task.type_name)
             elif old >= 0 and val < 0:
                 self.controller.signal(Task.type_name)
+            if val == 0:
+                scheduleTasks.refresh_all() # the schedules are fired with stop = 0 only
         return True
 
     def lock(self) -> bool:
         """
         Tries to get or prolongate the lock
         """
-        with conn.cursor() as cur:
-            lock_until = self.controller.now() + config.half_locking_time + config.half_locking_time
-            sql = "SELECT " + config.schema + ".lock_worker(%s,%s,%s,%s,%s,%s)"
+        if config.liveness == 'session':
+            return self.lock_session()
+        lock_until = self.controller.now() + config.half_locking_time + config.half_locking_time
+        with metrics.lock_worker_time.time():
             if self.id == config.worker_id:
-                cur.execute(sql, (self.id, config.group_id, config.node_name, len(child_processes), lock_until, self.lock_time))
+                res = storage.lock_worker(self.id, config.group_id, config.node_name, len(child_processes), lock_until, self.lock_time, task_limit())
             else:
-                cur.execute(sql, (self.id, -1, config.node_name, -1, lock_until, self.lock_time))
-            res = cur.fetchone()[0]
-            if res is None:
-                self.db_state['locked_until'] = lock_until
-                self.lock_time = lock_until
-                self.set_has_lock(True)
+                res = storage.lock_worker(self.id, -1, config.node_name, -1, lock_until, self.lock_time)
+        if res is None:
+            if self.id == config.worker_id and self.lock_time is not None:
+                metrics.lease_margin.set((self.lock_time - self.controller.now()).total_seconds())
+            self.db_state['locked_until'] = lock_until
+            self.lock_time = lock_until
+            self.set_has_lock(True)
+        else:
+            self.db_state['locked_until'] = res
+            self.lock_time = None
+            self.set_has_lock(False)
+
+        return self.has_lock
+
+    def lock_session(self) -> bool:
+        """
+        Tries to get the session lock or checks it is still held
+        """
+        try:
+            with metrics.lock_worker_time.time():
+                if self.id == config.worker_id:
+                    res = storage.lock_worker_session(self.id, config.group_id, config.node_name, len(child_processes), task_limit())
+                else:
+                    res = storage.lock_worker_session(self.id, None, None, None)
+        except Exception:
+            # the session is lost with the lock unless it is taken again in time
+            if self.in_session_grace():
+                self.retry_session_soon()
             else:
-                self.db_state['locked_until'] = res
-                self.lock_time = None
                 self.set_has_lock(False)
-
+            raise
+        if res:
+            # kept for two half_locking_time after the last check passed (as the lease)
+            self.lock_time = self.controller.now() + config.half_locking_time + config.half_locking_time
+            self.set_has_lock(True)
+        elif self.in_session_grace():
+            # the lost session may still hold the lock till the server notices
+            self.retry_session_soon()
+        else:
+            self.set_has_lock(False)
         return self.has_lock
 
+    def in_session_grace(self) -> bool:
+        """
+        The node`s worker keeps the lock state while reconnecting until lock_time
+        """
+        return self.id == config.worker_id and self.has_lock and self.lock_time is not None \
+            and self.controller.now() < self.lock_time
+
+    def retry_session_soon(self):
+        t = self.controller.now() + timedelta(seconds=1)
+        if self.next_check is None or t < self.next_check:
+            self.next_check = t
+            self.schedule(t)
+
     def keep_lock(self):
         """
         Aquires lock and prolongates it periodicically
         """
+        if config.liveness == 'session':
+            if self.reached(self.next_check):
+                self.next_check = self.controller.now() + config.half_locking_time
+                self.schedule(self.next_check)
+                self.lock()
+            return self.has_lock
+
         if self.has_lock:
             t = self.db_state['locked_until']
             if t is None or t != self.lock_time:
@@ -458,18 +842,14 @@ class Worker(DbObject):
         return self.has_lock
 
     def unlock_and_deactivate(self):
-        with conn.cursor() as cur:
-            sql = "UPDATE " + Worker.table_name + " SET active=false, locked_until=NULL, task_count=%s WHERE id=%s"
-            cur.execute(sql, (len(child_processes) if self.id==config.worker_id else 0, self.id))
-            self.db_state['active'] = False
-            self.db_state['locked_until'] = None
-            self.set_has_lock(False)
+        storage.unlock_worker(self.id, len(child_processes) if self.id==config.worker_id else 0)
+        self.db_state['active'] = False
+        self.db_state['locked_until'] = None
+        self.set_has_lock(False)
 
     def recover_worker_tasks(self):
         self.info(Messages.RECOVER_TASKS)
-        with conn.cursor() as cur:
-            sql = "SELECT " + config.schema + ".recover_worker_tasks(%s)"
-            cur.execute(sql, (self.id,))
+        storage.recover_worker_tasks(self.id)
 
     def process(self):
         self.save_db_state()
@@ -483,8 +863,13 @@ class Worker(DbObject):
             self.keep_lock()
         else:
             if self.db_state['active']:
-                t = self.db_state['locked_until']
-                if t is None or t + config.failed_worker_recovery_delay < self.controller.now():
+                if config.liveness == 'session':
+                    # the lock is free since the worker session is gone (RefreshWorkers.note_dead)
+                    failed = refreshWorkers.is_dead(self.id)
+                else:
+                    t = self.db_state['locked_until']
+                    failed = t is None or t + config.failed_worker_recovery_delay < self.controller.now()
+                if failed:
                     if self.lock():
                         self.refresh_db_state()
                         if self.db_state['active']: # check again after lock
@@ -492,21 +877,33 @@ class Worker(DbObject):
                         self.unlock_and_deactivate()
         self.save_db_state()
 
+        if config.watchdog == 'elected' and self.id != config.worker_id and not self.has_lock:
+            # loaded by the watchdog scan for one check
+            self.close()
+
     def is_intresting_db_state(db_state:map) -> bool:
-        return True
+        return config.watchdog != 'elected' or db_state.id == config.worker_id
+
+    @classmethod
+    def is_watched(cls, id) -> bool:
+        return config.watchdog != 'elected' or id == config.worker_id or controller.find(cls.type_name, id) is not None
 
 class Task(DbObject):
     """
     task record
     """
 
+    dirty = set()
     changed = set()
+    states = {}
     deleted = set()
 
     type_name = "t"
     table_name = config.schema + ".task"
     version_field_name = 'last_state_change'
     table_fields = ['state_id', 'worker_id', 'group_id', 'next_start', 'shed_period_id', 'shed_period_count', 'shed_enabled', 'cleanup_pending', version_field_name]
+    timestamp_fields = ('next_start', version_field_name)
+    row_class = storage_module.row_class('TaskRow', table_fields, ['error'])
     notify_key = "!" + table_name + "." + str(config.group_id)
 
     def __init__(self, controller, id = None):
@@ -515,6 +912,8 @@ class Task(DbObject):
         self.__process__ = None
         self.next_process_check = None
         self.stop_type = None # тип прерывания 'S' - Stop, 'C' - Cancel
+        self.units = (0, 0) # (task.cpu_units, task.mem_units) taken by the process started
+        self.started_at = None # time.monotonic() of the process start
 
     def set_process(self, process:TaskProcess):
         global child_processes
@@ -523,11 +922,12 @@ class Task(DbObject):
         if self.__process__ is not None:
             self.__process__.close()
             self.__process__ = None
-            child_processes.pop(self.pid)
+            if child_processes.get(self.pid) is self:
+                del child_processes[self.pid]
             if process is None:
                 startMoreTasks.start_more()
         if process is not None:
-            self.pid = process.proc.pid
+            self.pid = process.proc.pid # OS pid or pypool.PoolProcess token
             child_processes[self.pid] = self
             self.stop_type = None
         self.__process__ = process
@@ -565,6 +965,8 @@ class Task(DbObject):
             if res_code is None: return True
             error = process.get_error()
             self.set_process(None)
+            if task_limiter is not None and self.stop_type is None and self.started_at is not None:
+                task_limiter.record(time.monotonic() - self.started_at, res_code != 0)
             if self.stop_type is None or self.stop_type == 'S':
                 if res_code == 0:
                     self.complete()
@@ -610,24 +1012,27 @@ class Task(DbObject):
         """
         Calculates the time of the next launch. Other algorithms can be implemented here.
         """
-        period = self.db_state['shed_period_id']
-        count = self.db_state['shed_period_count']
-        if count is not None and count > 0:
-            add_interval = None
-            if period == 'SEC':
-                add_interval = relativedelta(seconds=count)
-            elif period == 'MIN':
-                add_interval = relativedelta(minutes=count)
-            elif period == 'HOU':
-                add_interval = relativedelta(hours=count)
-            elif period == 'DAY':
-                add_interval = relativedelta(days=count)
-            elif period == 'WEE':
-                add_interval = relativedelta(weeks=count)
-            elif period == 'MON':
-                add_interval = relativedelta(months=count)
-            if add_interval is not None:
-                return add_period_until(self.db_state['next_start'], controller.now(), add_interval) + add_interval
+        add_interval = storage_module.shed_interval(self.db_state['shed_period_id'], self.db_state['shed_period_count'])
+        if add_interval is not None:
+            return storage_module.add_period_until(self.db_state['next_start'], controller.now(), add_interval) + add_interval
+
+    def get_fire_time(self, next_start:datetime) -> datetime:
+        """
+        next_start plus the jitter of the task (config.schedule_spread)
+        """
+        interval = storage_module.shed_interval(self.db_state['shed_period_id'], self.db_state['shed_period_count'])
+        return next_start + storage_module.sched_jitter(self.id, next_start, interval, config.schedule_spread)
+
+    def admit_fire(self) -> bool:
+        """
+        Takes the fire from the group token bucket (config.schedule_rate), waits for a token if there is none
+        """
+        if config.schedule_rate is None:
+            return True
+        if storage.sched_admit(config.group_id, 1, config.schedule_rate, config.schedule_burst) > 0:
+            return True
+        self.schedule_with_limit(self.controller.now() + timedelta(seconds=1 / config.schedule_rate))
+        return False
 
     def start(self, command, cwd:str=None):
         global capture_stdout
@@ -643,11 +1048,13 @@ class Task(DbObject):
             else:
                 cwd = root
 
-        proc = TaskProcess(list(command), self.id, cwd, capture_stdout=capture_stdout)
+        with metrics.spawn_latency.time():
+            proc = process_class(list(command), self.id, cwd, capture_stdout=capture_stdout)
+        self.started_at = time.monotonic()
         self.set_process(proc)
         self.next_process_check = None # check the process state immediatelly
 
-        self.refresh_db_state()
+        # the state claimed is already set, further changes come with notifications
         self.info(Messages.TASK_STARTED.format(list(command)))
 
     def fail(self, error:str, canceled:bool=False):
@@ -709,14 +1116,15 @@ class Task(DbObject):
                         self.error(Messages.TASK_CATCHED_BY_OTHER_SIDE)
                         self.set_stop('C')
 
-            if self.next_process_check is None:
-                self.check_proces_state_interval = config.min_check_proces_state_interval
-            if self.reached(self.next_process_check):
-                self.next_process_check = self.controller.now() + self.check_proces_state_interval
-                self.schedule(self.next_process_check)
-                self.check_proces_state_interval = self.check_proces_state_interval + self.check_proces_state_interval
-                if self.check_proces_state_interval > config.max_check_proces_state_interval:
-                    self.check_proces_state_interval = config.max_check_proces_state_interval
+            if not process.exit_reported:
+                if self.next_process_check is None:
+                    self.check_proces_state_interval = config.min_check_proces_state_interval
+                if self.reached(self.next_process_check):
+                    self.next_process_check = self.controller.now() + self.check_proces_state_interval
+                    self.schedule(self.next_process_check)
+                    self.check_proces_state_interval = self.check_proces_state_interval + self.check_proces_state_interval
+                    if self.check_proces_state_interval > config.max_check_proces_state_interval:
+                        self.check_proces_state_interval = config.max_check_proces_state_interval
 
         else:
             if worker.has_lock and self.db_state is not None:
@@ -724,26 +1132,26 @@ class Task(DbObject):
                 if state_id.startswith('A') and state_id != 'AW':
                     self.fail(Messages.TASK_PHANTOM)
 
-        # check task.next_start reached
-        if self.db_state is not None and self.db_state['shed_enabled'] and not self.db_state['cleanup_pending'] and worker.has_lock and self.stop_type is None:
+        # check task.next_start reached (ScheduleTasks does it with config.schedule_engine = "sql")
+        if config.schedule_engine == 'objects' and self.db_state is not None and self.db_state['shed_enabled'] and not self.db_state['cleanup_pending'] and worker.has_lock and self.stop_type is None:
             next_start = self.db_state['next_start']
-            if next_start is not None and self.reached_with_limit(next_start):
+            if next_start is not None and self.reached_with_limit(self.get_fire_time(next_start)):
                 new_next_start = self.get_next_start()
-                with conn.cursor() as cur:
-                    sql = "UPDATE " + Task.table_name + " SET next_start=%s WHERE id=%s AND next_start=%s"
-                    cur.execute(sql, (new_next_start, self.id, next_start))
-                    if cur.rowcount > 0:
-                        self.set_field('next_start', new_next_start, set_changed=False)
-                        if new_next_start is not None:
-                            self.schedule_with_limit(new_next_start)
-                        sql = "SELECT " + config.schema + ".sched_start(%s)"
-                        cur.execute(sql, (self.id,))
-                        new_task_id = cur.fetchone()[0]
-                        if new_task_id is not None:
-                            new_task = Task.find_or_new(new_task_id)
-                            new_task.refresh_db_state()
-                    else:
+                # only the node winning the schedule takes the token
+                if not storage.advance_schedule(Task, self.id, next_start, new_next_start):
+                    self.refresh_db_state() # fired by the other node
+                elif not self.admit_fire():
+                    # no token: next_start is put back, the fire waits for one
+                    if not storage.advance_schedule(Task, self.id, new_next_start, next_start):
                         self.refresh_db_state()
+                else:
+                    self.set_field('next_start', new_next_start, set_changed=False)
+                    if new_next_start is not None:
+                        self.schedule_with_limit(self.get_fire_time(new_next_start))
+                    new_task_id = storage.sched_start(self.id)
+                    if new_task_id is not None:
+                        new_task = Task.find_or_new(new_task_id)
+                        new_task.refresh_db_state()
 
         self.save_db_state()
 
@@ -763,7 +1171,7 @@ class Task(DbObject):
         """
         if db_state['group_id'] != config.group_id:
             return False
-        if db_state['shed_enabled'] and db_state['next_start'] is not None:
+        if config.schedule_engine == 'objects' and db_state['shed_enabled'] and db_state['next_start'] is not None:
             return True
         if db_state['state_id'] == 'AW':
             return False
@@ -782,62 +1190,176 @@ class StartMoreTasks(CommonTask):
 
     def can_start_more(self):
         global no_more_waiting_tasks
-        return len(child_processes) < config.max_task_count \
+        cpu_units, mem_units = self.free_units()
+        return len(child_processes) < task_limit() \
+            and (cpu_units is None or cpu_units > 0) and (mem_units is None or mem_units > 0) \
             and worker.has_lock and worker.stop == 0
 
+    def free_slots(self) -> int:
+        return task_limit() - len(child_processes)
+
+    def free_units(self) -> tuple:
+        """
+        (cpu, mem) of config.cpu_capacity and config.mem_capacity not taken by the processes running, None - not limited
+        """
+        cpu_units = config.cpu_capacity
+        mem_units = config.mem_capacity
+        if cpu_units is not None or mem_units is not None:
+            for task in list(child_processes.values()): # also read by the metrics thread
+                if cpu_units is not None:
+                    cpu_units -= task.units[0]
+                if mem_units is not None:
+                    mem_units -= task.units[1]
+        return cpu_units, mem_units
+
     def process(self):
         global no_more_waiting_tasks
         if self.can_start_more():
-            with conn.cursor() as cur:
-                sql = "SELECT start_task FROM " + config.schema + ".start_task(%s,%s)"
-                cur.execute(sql, (config.group_id, config.worker_id))
-                id = cur.fetchone()[0]
-                if id is None:
-                    no_more_waiting_tasks = True
-                    return
-                self.signal() # then try one more
-                sql = "SELECT command, cwd, " + ','.join(Task.table_fields) + " \
-                    FROM " + Task.table_name + " \
-                    WHERE id = %s"
-                cur.execute(sql, (id,))
-                row = cur.fetchone()
-                if row is None:
-                    return
-                task = Task.find_or_new(id)
+            if not pressure_gate.check():
+                # the host is overloaded, check again later
+                self.schedule(self.controller.now() + timedelta(seconds=pressure_gate.time_to_check()))
+                return
+            cpu_units, mem_units = self.free_units()
+            # claim the whole batch of free slots in one call
+            with metrics.start_tasks_time.time():
+                db_states = storage.start_tasks(Task, config.group_id, config.worker_id, self.free_slots(), cpu_units, mem_units)
+            if len(db_states) == 0:
+                no_more_waiting_tasks = True
+                return
+            self.signal() # then try one more
+            for db_state, command, cwd, queue_wait, units in db_states:
+                if queue_wait is not None:
+                    metrics.queue_wait.observe(float(queue_wait))
+                task = Task.find_or_new(db_state.id)
                 try:
-                    db_state = get_db_state(cur, row)
+                    task.units = units
                     task.set_db_state(db_state)
-                    task.start(row[0], row[1])
+                    task.start(command, cwd)
                 except Exception as e:
                     task.fail(str(e))
                     task.save_db_state()
                     if config.debug: raise e
+            if task_limiter is not None and len(child_processes) >= task_limiter.limit:
+                task_limiter.saturate()
 
     def start_more(self):
         if not no_more_waiting_tasks and self.can_start_more():
             self.signal()
 
+class ScheduleTasks(CommonTask):
+    """
+    With config.schedule_engine = "sql" fires the due schedules of the group in one call
+    (long_task.sched_fire_due) on a single timer for the earliest next_start
+    instead of a Task object per schedule
+    """
+
+    def __init__(self, controller):
+        super().__init__(controller)
+        self.next_fire = None
+
+    def process(self):
+        global no_more_waiting_tasks
+        if config.schedule_engine != 'sql' or worker is None or not worker.has_lock or worker.stop != 0:
+            return
+        if self.reached(self.next_fire):
+            fired = storage.sched_fire_due(config.group_id, config.schedule_fire_limit, \
+                config.schedule_spread, config.schedule_rate, config.schedule_burst)
+            if any(new_task_id is not None for id, new_task_id, next_start in fired):
+                no_more_waiting_tasks = False
+                startMoreTasks.start_more()
+            if len(fired) >= config.schedule_fire_limit:
+                self.next_fire = self.controller.now()
+                self.signal() # fire the rest on the next pass
+                return
+            next_fire = storage.next_sched_time(config.group_id, config.schedule_spread)
+            now = self.controller.now()
+            # read again by the RefreshTasks period at most
+            self.next_fire = now + timedelta(minutes=55)
+            if next_fire is not None and next_fire < self.next_fire:
+                self.next_fire = next_fire
+                if next_fire <= now:
+                    # not admitted or locked by the other node: the next token or a second later
+                    self.next_fire = now + timedelta(seconds=1 / config.schedule_rate if config.schedule_rate else 1)
+            self.schedule(self.next_fire)
+
+    def notice(self, next_start:datetime):
+        """
+        A schedule changed by the others fires before the timer
+        (next_start without the jitter is early, then the timer is set by next_sched_time)
+        """
+        if config.schedule_engine == 'sql' and (self.next_fire is None or next_start < self.next_fire):
+            self.next_fire = next_start
+            self.schedule(next_start)
+
+    def refresh_all(self):
+        self.next_fire = None
+        self.process()
+
+class AdaptTaskLimit(CommonTask):
+    """
+    With config.adaptive_task_count adjusts the running tasks limit (task_limiter) each config.adaptive_window
+    """
+
+    def __init__(self, controller):
+        super().__init__(controller)
+        self.next_update = None
+
+    def process(self):
+        if task_limiter is None:
+            return
+        if self.reached(self.next_update):
+            if self.next_update is None:
+                task_limiter.reset(time.monotonic())
+            else:
+                self.adapt()
+            self.next_update = self.controller.now() + config.adaptive_window
+            self.schedule(self.next_update)
+
+    def adapt(self):
+        old = task_limiter.limit
+        if len(child_processes) >= old and not no_more_waiting_tasks:
+            # at the limit with no claim in the window (the tasks are longer than the window)
+            task_limiter.saturate()
+        now = time.monotonic()
+        ages = [now - task.started_at for task in child_processes.values() if task.started_at is not None]
+        if task_limiter.update(now, sum(ages) / len(ages) if ages else None):
+            self.info(Messages.TASK_LIMIT.format(old, task_limiter.limit, *task_limiter.last))
+            if task_limiter.limit > old:
+                startMoreTasks.start_more()
+
 startMoreTasks = StartMoreTasks(controller)
+adaptTaskLimit = AdaptTaskLimit(controller)
+scheduleTasks = ScheduleTasks(controller)
 refreshTasks = RefreshTasks(controller)
 refreshWorkers = RefreshWorkers(controller)
 worker = Worker.find_or_new(config.worker_id) # Node`s worker
 
-def get_db_state(cur, row) -> map:
-    return {d.name: row[i] for i, d in enumerate(cur.description)}
+def save_db_states():
+    for cls in (Worker, Task):
+        cls.save_db_states()
 
-def refresh_db_states(cur, object_class, expected_ids:set=None) -> bool:
+def apply_db_states(object_class, db_states, expected_ids:set=None, skip_older:bool=False) -> int:
+    """
+    skip_older - don`t apply the states older (by the version) than the ones loaded
+    """
     global no_more_waiting_tasks
     has_aw = False
     found_ids = set()
-    for row in cur.fetchall():
-        db_state = get_db_state(cur, row)
-        id = db_state['id']
+    version = object_class.version_field_name
+    for db_state in db_states:
+        id = db_state.id
         found_ids.add(id)
-        if db_state.get('state_id') == 'AW':
+        if getattr(db_state, 'state_id', None) == 'AW':
             has_aw = True
+        if object_class is Task and db_state.shed_enabled and db_state.next_start is not None and not db_state.cleanup_pending:
+            scheduleTasks.notice(db_state.next_start)
         obj = controller.find(object_class.type_name, id)
+        if skip_older and obj is not None and obj.db_state is not None and version is not None \
+        and getattr(db_state, version) is not None and getattr(obj.db_state, version) is not None \
+        and getattr(db_state, version) < getattr(obj.db_state, version):
+            continue
         if obj is None and object_class.is_intresting_db_state(db_state):
-            obj = object_class(controller, db_state['id'])
+            obj = object_class(controller, id)
         if obj is not None:
             obj.set_db_state(db_state)
     if expected_ids is not None:
@@ -852,21 +1374,74 @@ def refresh_db_states(cur, object_class, expected_ids:set=None) -> bool:
                 startMoreTasks.start_more()
     return len(found_ids)
 
-def add_period_until(start:datetime, until:datetime, period:relativedelta):
+notify_stats = AttrDict(
+    notifications = 0, # notifications received
+    ids_deduplicated = 0, # notifications for the ids already pending
+    queries = 0, # queries made to apply the changes
+    queries_saved = 0, # compared to one query per table on each main loop pass
+)
+
+def add_notification(channel:str, payload:str):
+    if channel == Task.notify_key:
+        is_new = Task.add_change(payload)
+    elif channel == Worker.notify_key:
+        is_new = Worker.add_change(payload)
+    else:
+        return
+    notify_stats.notifications += 1
+    if not is_new:
+        notify_stats.ids_deduplicated += 1
+
+def poll_notifications() -> int:
+    notifies = listener.poll()
+    # in the order of arrival as the latest state carried wins
+    for channel, payload in notifies:
+        add_notification(channel, payload)
+    return len(notifies)
+
+def receive_notifications():
+    """
+    Takes the notifications arrived, waits notify_coalesce_window for the rest of a burst
+    """
+    if poll_notifications() > 0:
+        window = config.notify_coalesce_window.total_seconds()
+        if window > 0:
+            deadline = time.monotonic() + window
+            while True:
+                dt = deadline - time.monotonic()
+                if dt <= 0:
+                    break
+                r, w, e = select.select([listener], [], [], dt)
+                if not r:
+                    break
+                poll_notifications()
+
+def select_changed(classes) -> dict:
+    """
+    Reads the changed records of all the classes with one query
+    Returns {class: [db_state]}
+    """
+    requests = {cls: cls.changed_ids() for cls in classes}
+    if any(len(ids) > 0 for ids in requests.values()):
+        notify_stats.queries += 1
+    return storage.select_changed(requests)
 
-    def add(start:datetime, period:relativedelta):
-        period2 = period + period
-        t = start + period2
-        if t > until:
-            return start
-        else:
-            t = add(t, period2)
-            t1 = t + period
-            if t1 <= until:
-                return t1
-            else:
-                return t
-    return add(start, period)
+def apply_changes():
+    """
+    Applies the notifications received. Makes no queries if nothing changed
+    """
+    classes = (Worker, Task)
+    if not any(cls.has_changes() for cls in classes):
+        notify_stats.queries_saved += len(classes)
+        return
+    queries = notify_stats.queries
+    if refreshTasks.cursor is not None:
+        # the chunks not read yet are older than these changes
+        refreshTasks.touched.update(Task.changed, Task.states, Task.deleted)
+    db_states = select_changed(classes)
+    notify_stats.queries_saved += len(classes) - (notify_stats.queries - queries)
+    for cls in classes:
+        cls.apply_changes(db_states[cls])
 
 def terminate() -> bool:
     if controller.terminated:
@@ -903,6 +1478,34 @@ def on_term_signal(signum, frame):
     terminate_backlog.append(4)
     wakeup.set()
 
+def on_profile_signal(signum, frame):
+    profiler.request_dump()
+    wakeup.set()
+
+def on_spawned_exit(pid:int, exit_code:int):
+    terminated_processes_backlog.append((pid, exit_code))
+
+def open_spawner():
+    global spawner, py_pool
+    if config.spawn_backend == 'forkserver':
+        spawner = spawn.ForkServerSpawner(on_spawned_exit)
+        io_handlers[spawner] = spawner.handle_events
+    else:
+        spawner = spawn.SPAWNERS[config.spawn_backend]()
+    if config.py_pool_size > 0:
+        py_pool = pypool.PyPool(config.py_pool_size, io_handlers, on_spawned_exit, \
+            max_tasks=config.py_pool_max_tasks, \
+            max_rss=config.py_pool_max_rss * 1024 * 1024 if config.py_pool_max_rss is not None else None, \
+            preload=config.py_pool_preload)
+
+def close_spawner():
+    global py_pool
+    if py_pool is not None:
+        py_pool.close()
+        py_pool = None
+    io_handlers.pop(spawner, None)
+    spawner.close()
+
 def process_signal_backlog():
     try:
         while True:
@@ -921,104 +1524,209 @@ def process_signal_backlog():
     except IndexError:
         pass
 
+def connect_db():
+    db_config = config.db
+    conn = psycopg2.connect( \
+        host=db_config['host'], \
+        port=db_config['port'], \
+        dbname=db_config['database'], \
+        user=db_config['user'], \
+        password=deobfuscate(db_config['password']), \
+        cursor_factory=profiler.TracingCursor \
+    )
+    conn.autocommit = True
+    conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+    return conn
+
+def start_node():
+    """
+    Registers the node`s worker and loads the states after (re)connect
+    """
+    try:
+        storage.register_worker(config.worker_id)
+    except Exception as e:
+        pass
+
+    refreshWorkers.refresh_all()
+    if not terminate():
+        refreshTasks.refresh_all()
+        scheduleTasks.refresh_all()
+        adaptTaskLimit.signal()
+
+def process_controller() -> datetime:
+    profiler.poll(config.profile_dir, config.worker_id, config.profile_seconds)
+    with metrics.controller_pass.time():
+        return controller.process(max_count=100)
+
+def get_wait_time(next_time:datetime) -> float:
+    wait_time = 5 if config.debug else 60
+    dt = (next_time - controller.now()).total_seconds()
+    if dt > 0:
+        if dt < wait_time:
+            wait_time = dt
+    else:
+        wait_time = 0.1
+    if task_log_writer is not None:
+        dt = task_log_writer.time_to_flush()
+        if dt is not None and dt < wait_time:
+            wait_time = dt
+    return wait_time
+
+def flush_task_log():
+    """
+    Writes the tasks output collected if it is time to
+    """
+    if task_log_writer is not None:
+        dt = task_log_writer.time_to_flush()
+        if dt is not None and dt <= 0:
+            try:
+                storage.write_task_log(task_log_writer)
+            except Exception as e:
+                # the output is kept and written later, the pipes are not read while it is piling up
+                if config.debug: raise e
+                print('ERROR', e)
+
+def start_metrics():
+    """
+    Starts the metrics HTTP endpoint if config.metrics_port is set
+    """
+    if config.metrics_port is None:
+        return
+    metrics.Gauge('long_task_running_tasks', 'Task processes running', lambda: len(child_processes))
+    metrics.Gauge('long_task_slots', 'Max task processes (max_task_count)', lambda: config.max_task_count)
+    metrics.Gauge('long_task_task_limit', 'Task processes limit: max_task_count or the adaptive one (config.adaptive_task_count)', task_limit)
+    if config.cpu_capacity is not None:
+        metrics.Gauge('long_task_free_cpu_units', 'config.cpu_capacity not taken by the tasks running', lambda: startMoreTasks.free_units()[0])
+    if config.mem_capacity is not None:
+        metrics.Gauge('long_task_free_mem_units', 'config.mem_capacity not taken by the tasks running', lambda: startMoreTasks.free_units()[1])
+    if pressure_gate.is_enabled():
+        metrics.Gauge('long_task_pressure_blocked', 'The claims are stopped by PSI or cgroup memory', lambda: 0 if pressure_gate.blocked_by is None else 1)
+    metrics.Gauge('long_task_has_lock', 'The node`s worker lease is held', lambda: 1 if worker.has_lock else 0)
+    metrics.Gauge('long_task_watchdog_leader', 'The node watches the other workers (config.watchdog = "elected")', lambda: 1 if refreshWorkers.is_leader else 0)
+    metrics.Counter('long_task_notifications_total', 'Notifications received', lambda: notify_stats.notifications)
+    metrics.Counter('long_task_notifications_deduplicated_total', 'Notifications for the ids already pending', lambda: notify_stats.ids_deduplicated)
+    metrics.start_server(config.metrics_host, config.metrics_port)
+
+def open_storage():
+    if config.storage == 'memory':
+        return storage_module.MemoryStorage(config.schema)
+    return storage_module.PgStorage(config.schema)
+
+def open_pools():
+    global storage, task_log_writer
+    if storage is None:
+        storage = open_storage()
+    storage.open(connect_db, config.db_pool_size)
+    if config.task_log and task_log_writer is None:
+        task_log_writer = TaskLogWriter(config.schema + '.task_log', config.task_log_flush_bytes, \
+            config.task_log_flush_interval.total_seconds(), config.task_log_max_pending)
+
+def close_pools():
+    refreshTasks.close_cursor()
+    if task_log_writer is not None:
+        try:
+            storage.write_task_log(task_log_writer)
+        except Exception as e:
+            print('ERROR', e)
+    storage.close()
+
+def connect_listen():
+    return storage.listen([Task.notify_key, Worker.notify_key])
+
 def run():
-    global conn
+    global listener
 
     delay_after_db_error = config.min_delay_after_db_error
-    db_config = config.db
 
     try:
         signal.signal(signal.SIGTERM, on_term_signal)
-        signal.signal(signal.SIGCHLD, on_child_signal)
+        if config.child_supervision != 'pidfd':
+            signal.signal(signal.SIGCHLD, on_child_signal)
+        signal.signal(signal.SIGUSR1, on_profile_signal)
     except AttributeError as e:
         print(e)
 
     nextSignalAll = datetime.now() + timedelta(minutes=5)
 
-    while True: # DB reconnect loop
-        try:
-            conn = psycopg2.connect( \
-                host=db_config['host'], \
-                port=db_config['port'], \
-                dbname=db_config['database'], \
-                user=db_config['user'], \
-                password=deobfuscate(db_config['password']) \
-            )
+    start_metrics()
+    # before the tasks are loaded to keep the fork server small
+    open_spawner()
+    open_pools()
+    resync = True
+    try:
+        while True: # Main loop
             try:
 
-                conn.autocommit = True
-                conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-
-                try:
-                    with conn.cursor() as cur:
-                        cur.execute("INSERT INTO " + Worker.table_name + "(id) VALUES(%s)", [config.worker_id])
-                except Exception as e:
-                    pass
-
-                with conn.cursor() as cur:
-                    cur.execute('LISTEN "' + Task.notify_key + '"')
-                    cur.execute('LISTEN "' + Worker.notify_key + '"')
-
-                refreshWorkers.refresh_all()
-                if not terminate():
-                    refreshTasks.refresh_all()
-
-                delay_after_db_error = config.min_delay_after_db_error
-
-                while True: # Main loop
-
-                    next_time = controller.process(max_count=100)
-
-                    if terminate():
-                        unlock_workers()
-                        return
-
-                    if next_time is not None:
-                        wait_time = 5 if config.debug else 60
-                        dt = (next_time - controller.now()).total_seconds()
-                        if dt > 0:
-                            if dt < wait_time:
-                                wait_time = dt
-                        else:
-                            wait_time = 0.1
-
-                        #if config.debug: print(wait_time)
-                        r, w, e = select.select([conn, wakeup], [], [], wait_time)
-                        if wakeup in r:
-                            wakeup.clear()
-                            process_signal_backlog()
-
-                    Worker.clear_changes()
-                    Task.clear_changes()
-                    conn.poll()
-                    while conn.notifies:
-                        n = conn.notifies.pop()
-                        if n.channel == Task.notify_key:
-                            Task.add_change(n.payload)
-                        elif n.channel == Worker.notify_key:
-                            Worker.add_change(n.payload)
-                    Worker.apply_changes()
-                    Task.apply_changes()
-
-                    if nextSignalAll <= datetime.now():
-                        if config.debug:
-                            nextSignalAll = datetime.now() + timedelta(seconds=10)
-                        else:
-                            nextSignalAll = datetime.now() + timedelta(minutes=5)
-                        controller.signal()
-
-            finally:
-                conn.close()
+                if resync:
+                    # the connections are restored independently,
+                    # the states are reloaded as the notifications could be lost
+                    if listener is None:
+                        listener = connect_listen()
+                    start_node()
+                    resync = False
+                    delay_after_db_error = config.min_delay_after_db_error
+
+                next_time = process_controller()
+                save_db_states()
+                flush_task_log()
+
+                if terminate():
+                    unlock_workers()
+                    return
 
-        except Exception as e:
-            if config.debug: raise e
-            print('ERROR', e)
-            time.sleep(delay_after_db_error.total_seconds())
-            delay_after_db_error += delay_after_db_error
-            if delay_after_db_error > config.max_delay_after_db_error:
-                delay_after_db_error = config.max_delay_after_db_error
+                if next_time is not None:
+                    wait_time = get_wait_time(next_time)
+
+                    #if config.debug: print(wait_time)
+                    readers = [listener, wakeup] + list(io_handlers)
+                    if task_log_writer is None or not task_log_writer.is_full():
+                        readers += list(output_handlers)
+                    r, w, e = select.select(readers, [], [], wait_time)
+                    for f in r:
+                        handler = io_handlers.get(f) or output_handlers.get(f)
+                        if handler is not None:
+                            handler()
+                    if wakeup in r:
+                        wakeup.clear()
+                    process_signal_backlog()
+
+                Worker.clear_changes()
+                Task.clear_changes()
+                receive_notifications()
+                apply_changes()
+
+                if nextSignalAll <= datetime.now():
+                    if config.debug:
+                        print('notifications', notify_stats)
+                        nextSignalAll = datetime.now() + timedelta(seconds=10)
+                    else:
+                        nextSignalAll = datetime.now() + timedelta(minutes=5)
+                    controller.signal()
+
+            except Exception as e:
+                if config.debug: raise e
+                print('ERROR', e)
+                resync = True
+                if listener is not None and listener.closed:
+                    listener = None
+                time.sleep(delay_after_db_error.total_seconds())
+                delay_after_db_error += delay_after_db_error
+                if delay_after_db_error > config.max_delay_after_db_error:
+                    delay_after_db_error = config.max_delay_after_db_error
+    finally:
+        if listener is not None:
+            listener.close()
+        close_pools()
+        close_spawner()
 
 if __name__ == '__main__':
 
-    run()
+    # the engines import this module as "node"
+    sys.modules.setdefault('node', sys.modules[__name__])
+
+    if config.engine == 'asyncio':
+        import node_async
+        node_async.run()
+    else:
+        run()
 
@@ -0,0 +1,242 @@
+# This code is under MIT licence, you can find the complete file here: https://github.com/ivanovrvl/pg_tasks/blob/main/LICENSE
+"""
+asyncio based node engine (config.engine = "asyncio")
+
+The event loop supervises the OS processes (asyncio subprocesses), captures their output,
+listens the notifications (asyncpg) and handles the signals. The active objects are processed
+by the same ActiveObjectsController in the single controller thread, so DB calls made by them
+don`t stall the processes supervision. Events received by the loop are applied between
+the controller passes.
+"""
+import asyncio
+import concurrent.futures
+import signal
+from datetime import datetime, timedelta
+import asyncpg
+
+import node
+import pypool
+from node import config, controller, Task, Worker, Messages
+
+loop = None # the engine event loop
+wakeup = None # asyncio.Event to wake up the main loop
+notifications = [] # (channel, payload) received between the controller passes
+
+class AsyncTaskProcess:
+    """
+    OS process wrapper, the process is managed by the event loop
+    """
+    def __init__(self, commands:list, id, cwd=None, capture_stdout:int=0):
+        # the asyncio engine runs py:module:function commands in a new interpreter
+        cmds = pypool.command_line(node.get_command_line(commands, id))
+        self.id = id
+        self.wait_until = None
+        self.exit_code = None
+        self.exit_reported = True # by supervise()
+        self.capture_stdout = capture_stdout
+        self.task_log = node.task_log_writer
+        self.stdout = node.OutputBuffer(capture_stdout) if capture_stdout > 0 else None
+        # called in the controller thread, the process is spawned by the loop
+        self.proc = asyncio.run_coroutine_threadsafe(self.spawn(cmds, cwd), loop).result()
+
+    async def spawn(self, cmds:list, cwd):
+        if self.stdout is not None or self.task_log is not None:
+            proc = await asyncio.create_subprocess_exec(*cmds, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, cwd=cwd)
+        else:
+            proc = await asyncio.create_subprocess_exec(*cmds, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL, cwd=cwd)
+        loop.create_task(self.supervise(proc))
+        return proc
+
+    async def supervise(self, proc):
+        if proc.stdout is not None:
+            while True:
+                while self.task_log is not None and self.task_log.is_full():
+                    # the DB is slow, the process blocks on write meanwhile
+                    await asyncio.sleep(0.1)
+                b = await proc.stdout.read(65536)
+                if not b: break
+                if self.stdout is not None:
+                    self.stdout.write(b)
+                if self.task_log is not None:
+                    self.task_log.write(self.id, b)
+        exit_code = await proc.wait()
+        # applied by node.process_signal_backlog() between the controller passes
+        node.terminated_processes_backlog.append((proc.pid, exit_code))
+        wakeup.set()
+
+    def set_exit_code(self, exit_code:int):
+        if self.proc is not None:
+            self.exit_code = exit_code
+            self.close()
+
+    def check_result(self):
+        # the exit code is set by the loop when the process exits
+        return self.exit_code
+
+    def send_signal(self, sig):
+        proc = self.proc
+        if proc is not None:
+            def send():
+                try:
+                    proc.send_signal(sig)
+                except ProcessLookupError:
+                    pass
+            loop.call_soon_threadsafe(send)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+    def close(self):
+        self.proc = None
+
+    def get_error(self)->str:
+        if self.stdout is not None:
+            s = self.stdout.getvalue()
+            self.stdout.clear()
+            return Messages.TASK_FAILED.format(self.exit_code) + '\n' + s.decode('cp866')
+        else:
+            return Messages.TASK_FAILED.format(self.exit_code)
+
+def on_notification(connection, pid, channel, payload):
+    notifications.append((channel, payload))
+    wakeup.set()
+
+def on_term_signal():
+    print("SIGTERM")
+    node.terminate_backlog.append(4)
+    wakeup.set()
+
+def on_profile_signal():
+    node.profiler.request_dump()
+    wakeup.set()
+
+def take_notifications() -> int:
+    count = len(notifications)
+    for channel, payload in notifications:
+        node.add_notification(channel, payload)
+    notifications.clear()
+    return count
+
+async def receive_notifications():
+    """
+    Takes the notifications arrived, waits notify_coalesce_window for the rest of a burst
+    """
+    if take_notifications() > 0:
+        window = config.notify_coalesce_window.total_seconds()
+        if window > 0:
+            await asyncio.sleep(window)
+            take_notifications()
+
+async def listen():
+    db_config = config.db
+    listen_conn = await asyncpg.connect( \
+        host=db_config['host'], \
+        port=int(db_config['port']), \
+        database=db_config['database'], \
+        user=db_config['user'], \
+        password=node.deobfuscate(db_config['password']) \
+    )
+    await listen_conn.add_listener(Task.notify_key, on_notification)
+    await listen_conn.add_listener(Worker.notify_key, on_notification)
+    return listen_conn
+
+async def main():
+    global loop, wakeup
+
+    loop = asyncio.get_running_loop()
+    wakeup = asyncio.Event()
+    node.process_class = AsyncTaskProcess
+
+    try:
+        loop.add_signal_handler(signal.SIGTERM, on_term_signal)
+        loop.add_signal_handler(signal.SIGUSR1, on_profile_signal)
+    except NotImplementedError as e:
+        print(e)
+
+    # all the active objects are processed in this thread only
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='controller')
+
+    async def call(func, *args):
+        return await loop.run_in_executor(executor, func, *args)
+
+    delay_after_db_error = config.min_delay_after_db_error
+    nextSignalAll = datetime.now() + timedelta(minutes=5)
+
+    node.start_metrics()
+    node.open_pools()
+    listen_conn = None
+    resync = True
+    try:
+        while True: # Main loop
+            try:
+
+                if listen_conn is not None and listen_conn.is_closed():
+                    listen_conn = None
+                    resync = True
+
+                if resync:
+                    # the connections are restored independently,
+                    # the states are reloaded as the notifications could be lost
+                    if listen_conn is None:
+                        listen_conn = await listen()
+                    await call(node.start_node)
+                    resync = False
+                    delay_after_db_error = config.min_delay_after_db_error
+
+                next_time = await call(node.process_controller)
+                await call(node.save_db_states)
+                await call(node.flush_task_log)
+
+                if node.terminate():
+                    await call(node.unlock_workers)
+                    return
+
+                if next_time is not None:
+                    try:
+                        await asyncio.wait_for(wakeup.wait(), node.get_wait_time(next_time))
+                    except asyncio.TimeoutError:
+                        pass
+                wakeup.clear()
+                node.process_signal_backlog()
+
+                Worker.clear_changes()
+                Task.clear_changes()
+                await receive_notifications()
+                await call(node.apply_changes)
+
+                if nextSignalAll <= datetime.now():
+                    if config.debug:
+                        print('notifications', node.notify_stats)
+                        nextSignalAll = datetime.now() + timedelta(seconds=10)
+                    else:
+                        nextSignalAll = datetime.now() + timedelta(minutes=5)
+                    controller.signal()
+
+            except Exception as e:
+                if config.debug: raise e
+                print('ERROR', e)
+                resync = True
+                await asyncio.sleep(delay_after_db_error.total_seconds())
+                delay_after_db_error += delay_after_db_error
+                if delay_after_db_error > config.max_delay_after_db_error:
+                    delay_after_db_error = config.max_delay_after_db_error
+    finally:
+        if listen_conn is not None:
+            await listen_conn.close()
+        await call(node.close_pools)
+
+def check_options():
+    """
+    Reports the options the engine ignores: the processes are spawned and supervised by the loop
+    """
+    defaults = (('spawn_backend', 'popen'), ('py_pool_size', 0), ('child_supervision', 'signal'))
+    for name, default in defaults:
+        if config[name] != default:
+            print(Messages.ENGINE_OPTION_IGNORED.format(name, config[name]))
+
+def run():
+    check_options()
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+# This code is under MIT licence, you can find the complete file here: https://github.com/ivanovrvl/pg_tasks/blob/main/LICENSE
+"""
+Host load signals to stop claiming tasks before the host is overloaded:
+PSI (/proc/pressure, Linux 4.20+) and the cgroup memory usage (cgroup v2 or v1).
+A signal not available on the host is not checked
+"""
+import time
+
+CGROUP_V2 = ('/sys/fs/cgroup/memory.current', '/sys/fs/cgroup/memory.max')
+CGROUP_V1 = ('/sys/fs/cgroup/memory/memory.usage_in_bytes', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+UNLIMITED = 1 << 60 # v1 reports the huge number when there is no limit
+
+def read_psi(resource:str, line:str='some') -> float:
+    """
+    avg10 of /proc/pressure/<resource> (cpu, memory, io): % of the time the tasks stalled, None if not available
+    """
+    try:
+        with open('/proc/pressure/' + resource) as f:
+            for s in f:
+                parts = s.split()
+                if parts and parts[0] == line:
+                    for p in parts[1:]:
+                        if p.startswith('avg10='):
+                            return float(p[6:])
+    except (OSError, ValueError):
+        pass
+    return None
+
+def read_cgroup_memory() -> float:
+    """
+    Memory usage of the node`s cgroup as a fraction of its limit, None if there is no limit or not available
+    """
+    for current_path, max_path in (CGROUP_V2, CGROUP_V1):
+        try:
+            with open(current_path) as f:
+                current = int(f.read())
+            with open(max_path) as f:
+                limit = f.read().strip()
+        except (OSError, ValueError):
+            continue
+        if limit == 'max' or int(limit) >= UNLIMITED:
+            return None
+        return current / int(limit)
+    return None
+
+class PressureGate:
+    """
+    Decides if more tasks may be claimed by the thresholds given (None - not checked).
+    The files are read once per interval at most, the main loop asks on each pass
+    """
+
+    def __init__(self, cpu_limit:float=None, memory_limit:float=None, io_limit:float=None, cgroup_memory_limit:float=None, interval:float=1):
+        self.limits = {'cpu': cpu_limit, 'memory': memory_limit, 'io': io_limit}
+        self.cgroup_memory_limit = cgroup_memory_limit
+        self.interval = interval
+        self.checked = None
+        self.values = {} # signal -> last value read
+        self.blocked_by = None # the signal over its limit
+
+    def is_enabled(self) -> bool:
+        return self.cgroup_memory_limit is not None or any(v is not None for v in self.limits.values())
+
+    def check(self) -> bool:
+        """
+        True if the host is not overloaded
+        """
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.interval:
+            return self.blocked_by is None
+        self.checked = now
+        self.blocked_by = None
+        for resource, limit in self.limits.items():
+            if limit is not None:
+                value = read_psi(resource)
+                self.values[resource] = value
+                if value is not None and value >= limit and self.blocked_by is None:
+                    self.blocked_by = resource
+        if self.cgroup_memory_limit is not None:
+            value = read_cgroup_memory()
+            self.values['cgroup_memory'] = value
+            if value is not None and value >= self.cgroup_memory_limit and self.blocked_by is None:
+                self.blocked_by = 'cgroup_memory'
+        return self.blocked_by is None
+
+    def time_to_check(self) -> float:
+        if self.checked is None:
+            return 0
+        return max(0, self.checked + self.interval - time.monotonic())
@@ -0,0 +1,107 @@
+# This code is under MIT licence, you can find the complete file here: https://github.com/ivanovrvl/pg_tasks/blob/main/LICENSE
+"""
+Timing of the active objects process() calls by the object class,
+the slowest calls are kept with the SQL they executed.
+
+On SIGUSR1 the node writes the snapshot to profile_<worker_id>_<time>.txt in config.profile_dir
+and appends the cProfile stats of the controller thread for the next config.profile_seconds
+"""
+import os
+import io
+import time
+import heapq
+import cProfile
+import pstats
+from datetime import datetime
+import psycopg2.extensions
+
+stats = {} # class name -> [count, total seconds, max seconds]
+slow_calls = [] # heap of (seconds, seq, class name, id, started, [(sql, seconds)])
+slow_calls_count = 20
+max_sql_count = 20 # kept for a call
+sql_log = None # [(sql, seconds)] of the call being processed
+seq = 0
+
+dump_requested = False
+profile = None # cProfile.Profile capturing
+profile_until = None
+profile_file = None
+
+class TracingCursor(psycopg2.extensions.cursor):
+    """
+    Records the statements into the current call sample
+    """
+    def execute(self, query, vars=None):
+        t = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            if sql_log is not None and len(sql_log) < max_sql_count:
+                sql_log.append((query, time.perf_counter() - t))
+
+def begin() -> float:
+    global sql_log
+    sql_log = []
+    return time.perf_counter()
+
+def end(obj, t:float):
+    global sql_log, seq
+    dt = time.perf_counter() - t
+    name = obj.__class__.__name__
+    s = stats.get(name)
+    if s is None:
+        s = [0, 0.0, 0.0]
+        stats[name] = s
+    s[0] += 1
+    s[1] += dt
+    if dt > s[2]:
+        s[2] = dt
+    if len(slow_calls) < slow_calls_count or dt > slow_calls[0][0]:
+        seq += 1
+        sample = (dt, seq, name, obj.id, datetime.now(), sql_log)
+        if len(slow_calls) < slow_calls_count:
+            heapq.heappush(slow_calls, sample)
+        else:
+            heapq.heapreplace(slow_calls, sample)
+    sql_log = None
+
+def request_dump():
+    """
+    Can be called from a signal handler
+    """
+    global dump_requested
+    dump_requested = True
+
+def snapshot() -> str:
+    out = io.StringIO()
+    out.write('{:<20} {:>10} {:>12} {:>10} {:>10}\n'.format('class', 'calls', 'total s', 'avg ms', 'max ms'))
+    for name, s in sorted(stats.items(), key=lambda i: -i[1][1]):
+        out.write('{:<20} {:>10} {:>12.3f} {:>10.3f} {:>10.3f}\n'.format(name, s[0], s[1], s[1] * 1000 / s[0], s[2] * 1000))
+    out.write('\nSlowest calls\n')
+    for dt, n, name, id, started, sqls in sorted(slow_calls, reverse=True):
+        out.write('{:.3f} ms {} {} at {}\n'.format(dt * 1000, name, id, started))
+        for sql, sql_dt in sqls:
+            out.write('    {:.3f} ms {}\n'.format(sql_dt * 1000, ' '.join(str(sql).split())[:500]))
+    return out.getvalue()
+
+def poll(dir:str, worker_id, seconds:float):
+    """
+    Called by the controller thread between the passes: writes the snapshot requested
+    and starts/stops the cProfile capture
+    """
+    global dump_requested, profile, profile_until, profile_file
+    if dump_requested and profile is None:
+        dump_requested = False
+        profile_file = os.path.join(dir, 'profile_{}_{}.txt'.format(worker_id, datetime.now().strftime('%Y%m%d_%H%M%S')))
+        with open(profile_file, 'w') as f:
+            f.write(snapshot())
+        print('Profile', profile_file)
+        profile = cProfile.Profile()
+        profile_until = time.monotonic() + seconds
+        profile.enable()
+    elif profile is not None and time.monotonic() >= profile_until:
+        profile.disable()
+        with open(profile_file, 'a') as f:
+            f.write('\ncProfile of the controller thread for {} s\n'.format(seconds))
+            pstats.Stats(profile, stream=f).sort_stats('cumulative').print_stats(50)
+        profile = None
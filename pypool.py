@@ -0,0 +1,271 @@
+# This code is under MIT licence, you can find the complete file here: https://github.com/ivanovrvl/pg_tasks/blob/main/LICENSE
+"""
+Warm Python interpreter pool for the tasks with the Python entry point command:
+    {py:module:function,arg1,arg2,...}
+The function is called without parameters, sys.argv is [py:module:function, arg1, arg2, ...],
+the return value or SystemExit code is the exit code, an exception gives the exit code 1.
+
+The pool workers are interpreters started in advance with config.py_pool_preload modules imported.
+A worker runs one task at a time in the task cwd with stdout/stderr redirected to the task output,
+so the imported modules (and their state) are kept between the tasks.
+Stop/cancel signals the worker the same way as an OS process, the worker dies and is replaced.
+A worker is recycled after config.py_pool_max_tasks tasks or when its RSS
+grows above config.py_pool_max_rss.
+
+Without the pool (or when all its workers are busy) the command runs in a new interpreter:
+    python pypool.py run module:function arg1 arg2 ...
+"""
+import os
+import sys
+import json
+import signal
+import socket
+import importlib
+import traceback
+import itertools
+import subprocess
+
+PREFIX = 'py:'
+MAX_MESSAGE = 1 << 16
+
+def is_py_command(cmds:list) -> bool:
+    return len(cmds) > 0 and cmds[0].startswith(PREFIX)
+
+def command_line(cmds:list) -> list:
+    """
+    The OS command line for the command, the Python entry point runs in a new interpreter
+    """
+    if is_py_command(cmds):
+        return [sys.executable, os.path.abspath(__file__), 'run', cmds[0][len(PREFIX):]] + cmds[1:]
+    return cmds
+
+class PoolProcess:
+    """
+    Popen-like task running in a pool worker. pid is a negative token unique per task, not the worker`s pid:
+    the node keys the running tasks and the exit reports by it, and the worker runs the next task
+    as soon as the exit message arrives, before the node has applied the previous task exit
+    """
+    reports_exit = True # the exit comes through the worker socket
+    tokens = itertools.count(-1, -1)
+
+    def __init__(self, worker, stdout=None):
+        self.worker = worker
+        self.pid = next(PoolProcess.tokens)
+        self.stdout = stdout
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.worker.pool.handle_events(self.worker)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            self.worker.signal = int(sig)
+            try:
+                os.kill(self.worker.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class PoolWorker:
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.setblocking(False)
+        self.proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'worker', str(child_sock.fileno()), json.dumps(pool.options)], \
+            pass_fds=[child_sock.fileno()], stdin=subprocess.DEVNULL, start_new_session=True)
+        child_sock.close()
+        self.pid = self.proc.pid
+        self.task = None # PoolProcess running
+        self.signal = None # the signal sent to the task
+        self.retire = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def close(self):
+        self.sock.close()
+
+class PyPool:
+    """
+    The workers sockets are registered in io_handlers watched by the node`s main loop,
+    task exits are reported with on_exit(pid, exit_code)
+    """
+
+    def __init__(self, size:int, io_handlers:dict, on_exit=None, max_tasks:int=100, max_rss:int=None, preload:list=[]):
+        self.size = size
+        self.io_handlers = io_handlers
+        self.on_exit = on_exit
+        self.options = {'max_tasks': max_tasks, 'max_rss': max_rss, 'preload': list(preload)}
+        self.workers = []
+        for i in range(size):
+            self.start_worker()
+
+    def start_worker(self) -> PoolWorker:
+        worker = PoolWorker(self)
+        self.workers.append(worker)
+        self.io_handlers[worker] = lambda: self.handle_events(worker)
+        return worker
+
+    def stop_worker(self, worker:PoolWorker):
+        self.workers.remove(worker)
+        self.io_handlers.pop(worker, None)
+        worker.close()
+
+    def spawn(self, cmds:list, cwd=None, capture:bool=False):
+        """
+        Returns None if there is no idle worker
+        """
+        # retired after the last task exit is applied, not to mix it with the worker exit
+        for worker in [w for w in self.workers if w.retire]:
+            self.stop_worker(worker)
+        while len(self.workers) < self.size:
+            self.start_worker()
+        for worker in self.workers:
+            if worker.task is None:
+                break
+        else:
+            return None
+        msg = {'target': cmds[0][len(PREFIX):], 'args': cmds[1:], 'cwd': cwd}
+        r = None
+        try:
+            if capture:
+                r, w = os.pipe()
+                try:
+                    socket.send_fds(worker.sock, [json.dumps(msg).encode()], [w])
+                finally:
+                    os.close(w)
+            else:
+                worker.sock.send(json.dumps(msg).encode())
+        except OSError:
+            if r is not None:
+                os.close(r)
+            self.stop_worker(worker)
+            return None
+        worker.signal = None
+        worker.task = PoolProcess(worker, os.fdopen(r, 'rb') if r is not None else None)
+        return worker.task
+
+    def handle_events(self, worker:PoolWorker):
+        while not worker.retire:
+            try:
+                data = worker.sock.recv(MAX_MESSAGE)
+            except BlockingIOError:
+                break
+            except OSError:
+                data = b''
+            if data:
+                msg = json.loads(data)
+                self.task_exit(worker, msg['exit'])
+                worker.retire = msg['recycle']
+            else:
+                # the worker is dead
+                worker.retire = True
+                if worker.task is not None:
+                    code = -worker.signal if worker.signal is not None else worker.proc.poll()
+                    self.task_exit(worker, code if code else 1)
+        if worker.retire:
+            self.io_handlers.pop(worker, None)
+
+    def task_exit(self, worker:PoolWorker, exit_code:int):
+        task = worker.task
+        if task is not None:
+            worker.task = None
+            task.returncode = exit_code
+            if self.on_exit is not None:
+                self.on_exit(task.pid, exit_code)
+
+    def close(self):
+        workers = list(self.workers)
+        for worker in workers:
+            self.stop_worker(worker)
+        for worker in workers:
+            worker.proc.wait()
+
+def call(target:str) -> int:
+    module, func = target.split(':', 1)
+    try:
+        res = getattr(importlib.import_module(module), func)()
+    except SystemExit as e:
+        res = e.code
+    except BaseException:
+        traceback.print_exc()
+        return 1
+    if res is None:
+        return 0
+    if isinstance(res, int):
+        return res
+    print(res, file=sys.stderr)
+    return 1
+
+def run_task(msg:dict, fd:int) -> int:
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = (os.dup(1), os.dup(2))
+    saved = (os.getcwd(), sys.argv, list(sys.path))
+    if fd is None:
+        fd = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    try:
+        if msg['cwd'] is not None:
+            os.chdir(msg['cwd'])
+        sys.argv = [PREFIX + msg['target']] + msg['args']
+        sys.path.insert(0, os.getcwd())
+        return call(msg['target'])
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        os.close(saved_fds[0])
+        os.close(saved_fds[1])
+        os.chdir(saved[0])
+        sys.argv = saved[1]
+        sys.path[:] = saved[2]
+
+def get_rss() -> int:
+    """
+    Current RSS in bytes
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def serve(sock:socket.socket, options:dict):
+    """
+    The pool worker loop
+    """
+    for module in options['preload']:
+        importlib.import_module(module)
+    count = 0
+    while True:
+        data, fds, flags, addr = socket.recv_fds(sock, MAX_MESSAGE, 1)
+        if not data:
+            break # the pool is closed or the worker is retired
+        code = run_task(json.loads(data), fds[0] if len(fds) > 0 else None)
+        count += 1
+        recycle = count >= options['max_tasks'] \
+            or (options['max_rss'] is not None and get_rss() > options['max_rss'])
+        sock.send(json.dumps({'exit': code, 'recycle': recycle}).encode())
+
+if __name__ == '__main__':
+
+    if sys.argv[1] == 'worker':
+        serve(socket.socket(fileno=int(sys.argv[2])), json.loads(sys.argv[3]))
+    else: # run
+        target = sys.argv[2]
+        sys.argv = [PREFIX + target] + sys.argv[3:]
+        sys.path.insert(0, os.getcwd())
+        sys.exit(call(target))
@@ -0,0 +1,272 @@
+# This code is under MIT licence, you can find the complete file here: https://github.com/ivanovrvl/pg_tasks/blob/main/LICENSE
+"""
+OS process spawn backends for TaskProcess (config.spawn_backend)
+
+popen       - subprocess.Popen from the node process
+posix_spawn - os.posix_spawnp from the node process, falls back to popen if a cwd
+              other than the current one is requested (posix_spawn can`t change it)
+forkserver  - a small helper process started before the node loads the tasks launches
+              the processes on request, so the node`s heap is never forked
+
+Each backend returns a Popen-like object: pid, stdout (a pipe if capture requested),
+poll(), terminate(), kill(). The processes started by posix_spawn and forkserver get
+/dev/null as stdin
+"""
+import os
+import sys
+import json
+import select
+import signal
+import socket
+import subprocess
+
+class PopenSpawner:
+
+    def spawn(self, cmds:list, cwd=None, capture:bool=False):
+        if capture:
+            return subprocess.Popen(cmds, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd = cwd)
+        else:
+            return subprocess.Popen(cmds, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, cwd = cwd)
+
+    def close(self):
+        pass
+
+class SpawnedProcess:
+    """
+    Popen-like child process started by os.posix_spawnp
+    """
+    def __init__(self, pid:int, stdout=None):
+        self.pid = pid
+        self.stdout = stdout
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            try:
+                pid, status = os.waitpid(self.pid, os.WNOHANG)
+            except ChildProcessError:
+                # reaped by the SIGCHLD handler, the exit code comes from there
+                return None
+            if pid == self.pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, 0)
+            self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+class PosixSpawner:
+
+    def __init__(self):
+        self.popen = PopenSpawner()
+
+    def spawn(self, cmds:list, cwd=None, capture:bool=False):
+        if cwd is not None and os.path.realpath(cwd) != os.getcwd():
+            return self.popen.spawn(cmds, cwd, capture)
+        # the child stdin is /dev/null
+        actions = [(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0)]
+        r = None
+        if capture:
+            r, w = os.pipe()
+            actions += [
+                (os.POSIX_SPAWN_DUP2, w, 1),
+                (os.POSIX_SPAWN_DUP2, w, 2),
+            ]
+        else:
+            actions += [
+                (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+                (os.POSIX_SPAWN_DUP2, 1, 2),
+            ]
+        try:
+            pid = os.posix_spawnp(cmds[0], cmds, os.environ, file_actions=actions)
+        finally:
+            if capture:
+                os.close(w)
+        if capture:
+            return SpawnedProcess(pid, os.fdopen(r, 'rb'))
+        return SpawnedProcess(pid)
+
+    def close(self):
+        pass
+
+class ForkServerProcess:
+    """
+    Popen-like process launched by the fork server
+    """
+    reports_exit = True # the exit comes through the spawner socket
+
+    def __init__(self, client, pid:int, stdout=None):
+        self.client = client
+        self.pid = pid
+        self.stdout = stdout
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.client.handle_events()
+        return self.returncode
+
+    def wait(self):
+        while self.returncode is None:
+            select.select([self.client], [], [])
+            self.client.handle_events()
+        return self.returncode
+
+    def send_signal(self, sig):
+        if self.returncode is None:
+            self.client.send({'pid': self.pid, 'signal': int(sig)})
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+MAX_MESSAGE = 1 << 16
+
+class ForkServerSpawner:
+    """
+    Client of the fork server. Exits of the processes are reported through the socket,
+    so fileno() must be watched by the node`s main loop that calls handle_events()
+    """
+
+    def __init__(self, on_exit=None):
+        self.on_exit = on_exit # on_exit(pid, exit_code)
+        self.processes = {}
+        self.exits = [] # exits received while waiting a reply
+        self.sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.server = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(child_sock.fileno())], \
+            pass_fds=[child_sock.fileno()], stdin=subprocess.DEVNULL, start_new_session=True)
+        child_sock.close()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, msg:dict, fds:list=[]):
+        socket.send_fds(self.sock, [json.dumps(msg).encode()], fds)
+
+    def receive(self, block:bool) -> dict:
+        try:
+            data = self.sock.recv(MAX_MESSAGE, 0 if block else socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return None
+        if not data:
+            raise Exception('Fork server is down')
+        return json.loads(data)
+
+    def spawn(self, cmds:list, cwd=None, capture:bool=False):
+        msg = {'cmds': cmds, 'cwd': cwd}
+        r = None
+        if capture:
+            r, w = os.pipe()
+            try:
+                self.send(msg, [w])
+            finally:
+                os.close(w)
+        else:
+            self.send(msg)
+        while True:
+            reply = self.receive(True)
+            if 'exit' in reply:
+                self.exits.append(reply)
+                continue
+            break
+        if 'error' in reply:
+            if r is not None:
+                os.close(r)
+            raise OSError(reply['error'])
+        proc = ForkServerProcess(self, reply['pid'], os.fdopen(r, 'rb') if r is not None else None)
+        self.processes[proc.pid] = proc
+        return proc
+
+    def handle_events(self):
+        while True:
+            msg = self.receive(False)
+            if msg is None:
+                break
+            if 'exit' in msg:
+                self.exits.append(msg)
+        exits = self.exits
+        self.exits = []
+        for msg in exits:
+            proc = self.processes.pop(msg['exit'], None)
+            if proc is not None:
+                proc.returncode = msg['code']
+                if self.on_exit is not None:
+                    self.on_exit(proc.pid, proc.returncode)
+
+    def close(self):
+        self.sock.close()
+        self.server.wait()
+
+# config.spawn_backend
+SPAWNERS = {
+    'popen': PopenSpawner,
+    'posix_spawn': PosixSpawner,
+    'forkserver': ForkServerSpawner,
+}
+
+def serve(sock:socket.socket):
+    """
+    The fork server loop
+    """
+    children = {}
+    wakeup_r, wakeup_w = os.pipe()
+    os.set_blocking(wakeup_w, False)
+    signal.set_wakeup_fd(wakeup_w)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+
+    def reply(msg):
+        sock.send(json.dumps(msg).encode())
+
+    while True:
+        r, w, e = select.select([sock, wakeup_r], [], [])
+        if wakeup_r in r:
+            os.read(wakeup_r, 1000)
+            for pid, proc in list(children.items()):
+                code = proc.poll()
+                if code is not None:
+                    children.pop(pid)
+                    reply({'exit': pid, 'code': code})
+        if sock in r:
+            data, fds, flags, addr = socket.recv_fds(sock, MAX_MESSAGE, 1)
+            if not data:
+                break # the node is gone
+            msg = json.loads(data)
+            if 'signal' in msg:
+                proc = children.get(msg['pid'])
+                if proc is not None:
+                    proc.send_signal(msg['signal'])
+                continue
+            stdout = fds[0] if len(fds) > 0 else subprocess.DEVNULL
+            try:
+                proc = subprocess.Popen(msg['cmds'], stdin=subprocess.DEVNULL, stdout=stdout, stderr=subprocess.STDOUT, cwd=msg['cwd'])
+                children[proc.pid] = proc
+                reply({'pid': proc.pid})
+            except Exception as e:
+                reply({'error': str(e)})
+            finally:
+                if len(fds) > 0:
+                    os.close(fds[0])
+
+    for proc in children.values():
+        proc.kill()
+
+if __name__ == '__main__':
+
+    serve(socket.socket(fileno=int(sys.argv[1])))
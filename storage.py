@@ -0,0 +1,1045 @@
+# This code is under MIT licence, you can find the complete file here: https://github.com/ivanovrvl/pg_tasks/blob/main/LICENSE
+"""
+Storage of the worker and task records used by the node (config.storage)
+
+pg     - PgStorage, the long_task schema in Postgres
+memory - MemoryStorage, the same semantics in the process memory to simulate
+         the node with a lot of tasks without a DB (see bench/simulate.py)
+
+The methods get the DbObject class (Worker, Task) to know the table, its fields and version field.
+A record state is an instance of the class row_class, made by row_class() from the table fields
+"""
+import os
+import json
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+from db_pool import ConnectionPool
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(type(value).__name__ + ' is not JSON serializable')
+
+def shed_interval(period:str, count:int) -> relativedelta:
+    """
+    The schedule interval of task.shed_period_id and task.shed_period_count, None if not repeated
+    (long_task.shed_interval)
+    """
+    if count is not None and count > 0:
+        if period == 'SEC':
+            return relativedelta(seconds=count)
+        elif period == 'MIN':
+            return relativedelta(minutes=count)
+        elif period == 'HOU':
+            return relativedelta(hours=count)
+        elif period == 'DAY':
+            return relativedelta(days=count)
+        elif period == 'WEE':
+            return relativedelta(weeks=count)
+        elif period == 'MON':
+            return relativedelta(months=count)
+    return None
+
+def add_period_until(start:datetime, until:datetime, period:relativedelta):
+    """
+    start plus the whole number of periods not passing until (long_task.add_period_until)
+    """
+    def add(start:datetime, period:relativedelta):
+        period2 = period + period
+        t = start + period2
+        if t > until:
+            return start
+        else:
+            t = add(t, period2)
+            t1 = t + period
+            if t1 <= until:
+                return t1
+            else:
+                return t
+    return add(start, period)
+
+def sched_jitter(id:int, start:datetime, interval:relativedelta, spread:timedelta) -> timedelta:
+    """
+    The fire delay of the schedule after next_start: stable per task id, below spread and the period
+    (long_task.sched_jitter)
+    """
+    if interval is None or not spread:
+        return timedelta(0)
+    return min(spread, start + interval - start) * ((id * 2654435761) % 4294967296 / 4294967296)
+
+class DbRow:
+    """
+    Base of the record state classes: __slots__ for the id and the fields instead of a dict per record.
+    The fields are accessed as the attributes or by the name like a dict.
+    The changed fields are tracked by the bit mask of their indexes (bits, mask_fields())
+    """
+    __slots__ = ('id',)
+    fields = () # read from the DB, in the order of the constructor arguments
+    extra_fields = () # written only, None when read
+    bits = {} # field -> bit
+    mask_cache = {} # mask -> fields
+
+    def __init__(self, id, *values):
+        self.id = id
+        for n, v in zip(self.fields, values):
+            setattr(self, n, v)
+        for n in self.extra_fields:
+            setattr(self, n, None)
+
+    def __getitem__(self, name:str):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name:str, value):
+        setattr(self, name, value)
+
+    def get(self, name:str, default=None):
+        return getattr(self, name, default)
+
+    def merge(self, other, mask:int):
+        """
+        Takes the fields of the mask from the other state
+        """
+        for n in self.mask_fields(mask):
+            setattr(self, n, getattr(other, n))
+
+    @classmethod
+    def mask_fields(cls, mask:int) -> tuple:
+        fields = cls.mask_cache.get(mask)
+        if fields is None:
+            fields = tuple(n for n, bit in cls.bits.items() if mask & bit)
+            cls.mask_cache[mask] = fields
+        return fields
+
+    @classmethod
+    def from_dict(cls, state:dict):
+        return cls(state['id'], *[state.get(n) for n in cls.fields])
+
+    def to_dict(self) -> dict:
+        state = {'id': self.id}
+        for n in self.fields:
+            state[n] = getattr(self, n)
+        return state
+
+    def __repr__(self):
+        return self.__class__.__name__ + repr(self.to_dict())
+
+def row_class(name:str, fields:list, extra_fields:list=()) -> type:
+    """
+    Makes the record state class with the given fields
+    """
+    names = list(fields) + [n for n in extra_fields if n not in fields]
+    return type(name, (DbRow,), {
+        '__slots__': tuple(names),
+        'fields': tuple(fields),
+        'extra_fields': tuple(n for n in extra_fields if n not in fields),
+        'bits': {n: 1 << i for i, n in enumerate(names)},
+        'mask_cache': {},
+    })
+
+class Storage:
+
+    def open(self, connect, pool_size:int):
+        pass
+
+    def close(self):
+        pass
+
+    def select(self, cls, ids:list=None) -> list:
+        """
+        The records by ids, all the records if ids is None
+        """
+        raise NotImplementedError()
+
+    def open_tasks_cursor(self, cls, group_id:int, ids:list, chunk_size:int):
+        """
+        Active tasks of the group, the ones starting within an hour and the ones by ids.
+        Returns the cursor: fetch() -> next chunk of states, [] at the end, close()
+        """
+        raise NotImplementedError()
+
+    def select_changed(self, requests:dict) -> dict:
+        """
+        Reads the records {class: ids} with one request. Returns {class: [state]}
+        """
+        raise NotImplementedError()
+
+    def update(self, cls, id, values:dict, version) -> bool:
+        """
+        Writes the values if the record version is the same. Returns False if the race is lost
+        """
+        raise NotImplementedError()
+
+    def update_many(self, cls, fields:list, records:list) -> set:
+        """
+        Writes the fields of the records [{'id':, <version field>:, <fields>...}].
+        Returns the ids written
+        """
+        raise NotImplementedError()
+
+    def lock_worker(self, id, group_id:int, node_name:str, task_count:int, lock_until:datetime, prev_locked_until:datetime, task_limit:int=None) -> datetime:
+        """
+        long_task.lock_worker: returns None if the lock is aquired or prolongated,
+        otherwise locked_until of the other side
+        """
+        raise NotImplementedError()
+
+    def unlock_worker(self, id, task_count:int):
+        """
+        Deactivates the worker, releases its session lock if held
+        """
+        raise NotImplementedError()
+
+    def lock_worker_session(self, id, group_id:int, node_name:str, task_count:int, task_limit:int=None) -> bool:
+        """
+        config.liveness = "session": tries to get or keep the session lock of the worker,
+        the liveness is the session itself. The worker row is written when the values
+        (group_id, node_name, task_count, task_limit) change only, task_count None - just the lock (a peer recovery)
+        """
+        raise NotImplementedError()
+
+    def select_expired_workers(self, cls, delay:timedelta) -> list:
+        """
+        Active workers with the lock expired more than delay ago
+        """
+        raise NotImplementedError()
+
+    def select_dead_workers(self, cls) -> list:
+        """
+        config.liveness = "session": active workers with no session holding the lock
+        """
+        raise NotImplementedError()
+
+    def try_lead(self, key:str) -> bool:
+        """
+        Tries to get or keep the leadership of the cluster nodes by the key,
+        it is lost when the node process or its connection dies
+        """
+        raise NotImplementedError()
+
+    def register_worker(self, id):
+        raise NotImplementedError()
+
+    def recover_worker_tasks(self, worker_id):
+        raise NotImplementedError()
+
+    def start_tasks(self, cls, group_id:int, worker_id, count:int, cpu_units:int=None, mem_units:int=None) -> list:
+        """
+        long_task.start_tasks: claims up to count waiting tasks fitting into cpu_units and mem_units (None - not limited).
+        Returns [(state, command, cwd, queue_wait seconds, (cpu_units, mem_units))]
+        """
+        raise NotImplementedError()
+
+    def advance_schedule(self, cls, id, next_start:datetime, new_next_start:datetime) -> bool:
+        """
+        Moves next_start if it is not changed by the other side
+        """
+        raise NotImplementedError()
+
+    def sched_start(self, id):
+        """
+        long_task.sched_start: returns the id of the task queued or None
+        """
+        raise NotImplementedError()
+
+    def sched_fire_due(self, group_id:int, limit:int, spread:timedelta=None, rate:float=None, burst:float=None) -> list:
+        """
+        long_task.sched_fire_due: fires the due schedules of the group (next_start plus sched_jitter reached)
+        as much as sched_admit grants. Returns [(id, new task id or None, new next_start)]
+        """
+        raise NotImplementedError()
+
+    def next_sched_time(self, group_id:int, spread:timedelta=None) -> datetime:
+        """
+        The earliest fire time (next_start plus sched_jitter) of the enabled schedules of the group, None if there are none
+        """
+        raise NotImplementedError()
+
+    def sched_admit(self, group_id:int, count:int, rate:float, burst:float) -> int:
+        """
+        long_task.sched_admit: takes up to count fires from the group token bucket, returns the fires granted
+        """
+        raise NotImplementedError()
+
+    def write_task_log(self, writer):
+        raise NotImplementedError()
+
+    def listen(self, channels:list):
+        """
+        Returns the listener: fileno() for select, poll() -> [(channel, payload)], close(), closed
+        """
+        raise NotImplementedError()
+
+class PgListener:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    @property
+    def closed(self) -> bool:
+        return self.conn.closed
+
+    def poll(self) -> list:
+        self.conn.poll()
+        res = [(n.channel, n.payload) for n in self.conn.notifies]
+        self.conn.notifies.clear()
+        return res
+
+    def close(self):
+        self.conn.close()
+
+class PgChunkCursor:
+    """
+    Named (server side) cursor on its own connection, the rows are transferred by chunks.
+    The connection is kept in the transaction until the end, so the other commands
+    go through the pool meanwhile
+    """
+
+    def __init__(self, connect, sql:str, params, chunk_size:int, row_class):
+        self.chunk_size = chunk_size
+        self.row_class = row_class
+        self.conn = connect()
+        try:
+            self.conn.autocommit = False
+            self.cur = self.conn.cursor(name='long_task_refresh')
+            self.cur.execute(sql, params)
+        except:
+            self.conn.close()
+            raise
+
+    def fetch(self) -> list:
+        row_class = self.row_class
+        return [row_class(*row) for row in self.cur.fetchmany(self.chunk_size)]
+
+    def close(self):
+        try:
+            self.conn.rollback()
+        finally:
+            self.conn.close()
+
+class PgStorage(Storage):
+
+    def __init__(self, schema:str):
+        self.schema = schema
+        self.connect = None
+        self.conn = None # DB connection pool for the commands
+        self.lease_conn = None # DB connection pool for the worker lock prolongation only
+        self.lead_conn = None # DB connection holding the advisory lock of the leadership or retrying to take it
+        self.leading = False # the advisory lock is held by lead_conn
+        self.session_conn = None # DB connection holding the worker session locks
+        self.session_locks = {} # worker id -> the values written (group_id, node_name, task_count, task_limit)
+
+    def open(self, connect, pool_size:int):
+        self.connect = connect
+        self.conn = ConnectionPool(connect, pool_size)
+        self.lease_conn = ConnectionPool(connect, 1)
+
+    def close(self):
+        self.conn.close()
+        self.lease_conn.close()
+        if self.lead_conn is not None:
+            self.lead_conn.close()
+            self.lead_conn = None
+        self.leading = False
+        self.close_session()
+
+    def close_session(self):
+        # the session locks are released with the connection
+        self.session_locks.clear()
+        if self.session_conn is not None:
+            self.session_conn.close()
+            self.session_conn = None
+
+    def fetch_states(self, cls, cur) -> list:
+        # the columns are id and cls.table_fields
+        row_class = cls.row_class
+        return [row_class(*row) for row in cur.fetchall()]
+
+    def select(self, cls, ids:list=None) -> list:
+        with self.conn.cursor() as cur:
+            sql = """
+                SELECT id,""" + ','.join(cls.table_fields) + """
+                FROM """ + cls.table_name
+            if ids is None:
+                cur.execute(sql)
+            elif len(ids) == 1:
+                cur.execute(sql + " WHERE id = %s", (ids[0],))
+            else:
+                cur.execute(sql + " WHERE id = any(%s)", (list(ids),))
+            return self.fetch_states(cls, cur)
+
+    def open_tasks_cursor(self, cls, group_id:int, ids:list, chunk_size:int):
+        sql = """
+            SELECT id,""" + ','.join(cls.table_fields) + """
+            FROM """ + cls.table_name + """
+            WHERE (
+            	group_id = %s
+                and (
+                	state_id like %s
+                    or
+                    (next_start is not null and next_start < now() + interval '1 hour')
+                )
+            ) or id = any(%s)
+            """
+        return PgChunkCursor(self.connect, sql, (group_id, 'A%', list(ids)), chunk_size, cls.row_class)
+
+    def select_changed(self, requests:dict) -> dict:
+        res = {cls: [] for cls in requests}
+        classes = [cls for cls, ids in requests.items() if len(ids) > 0]
+        if len(classes) == 0:
+            return res
+        fields = []
+        for cls in classes:
+            fields.extend(n for n in cls.table_fields if n not in fields)
+        sql = []
+        params = []
+        for cls in classes:
+            sql.append("SELECT %s, id," + ','.join(n if n in cls.table_fields else 'NULL AS ' + n for n in fields) \
+                + " FROM " + cls.table_name + " WHERE id = any(%s)")
+            params.extend((cls.type_name, list(requests[cls])))
+        by_type = {cls.type_name: cls for cls in classes}
+        with self.conn.cursor() as cur:
+            cur.execute(" UNION ALL ".join(sql), params)
+            columns = {cls.type_name: [fields.index(n) + 2 for n in cls.table_fields] for cls in classes}
+            for row in cur.fetchall():
+                cls = by_type[row[0]]
+                res[cls].append(cls.row_class(row[1], *[row[i] for i in columns[row[0]]]))
+        return res
+
+    def update(self, cls, id, values:dict, version) -> bool:
+        names = list(values)
+        sql = """
+            update """ + cls.table_name + """
+            set """ + ','.join([n + '=%s' for n in names]) + """
+            where id=%s
+        """
+        params = [values[n] for n in names]
+        params.append(id)
+        if cls.version_field_name is not None:
+            params.append(version)
+            sql = sql + "and " + cls.version_field_name + "=%s"
+        with self.conn.cursor() as cur:
+            cur.execute(sql, params)
+            return cur.rowcount > 0
+
+    def update_many(self, cls, fields:list, records:list) -> set:
+        # the records are typed by the table row type
+        sql = """
+            update """ + cls.table_name + """ t
+            set """ + ','.join([n + '=r.' + n for n in fields]) + """
+            from jsonb_populate_recordset(NULL::""" + cls.table_name + """, %s::jsonb) r
+            where t.id=r.id
+        """
+        if cls.version_field_name is not None:
+            sql = sql + "and t." + cls.version_field_name + "=r." + cls.version_field_name
+        sql = sql + " returning t.id"
+        with self.conn.cursor() as cur:
+            cur.execute(sql, (json.dumps(records, default=json_default),))
+            return set(row[0] for row in cur.fetchall())
+
+    def lock_worker(self, id, group_id:int, node_name:str, task_count:int, lock_until:datetime, prev_locked_until:datetime, task_limit:int=None) -> datetime:
+        with self.lease_conn.cursor() as cur:
+            sql = "SELECT " + self.schema + ".lock_worker(%s,%s,%s,%s,%s,%s,%s)"
+            cur.execute(sql, (id, group_id, node_name, task_count, lock_until, prev_locked_until, task_limit))
+            return cur.fetchone()[0]
+
+    def unlock_worker(self, id, task_count:int):
+        with self.conn.cursor() as cur:
+            sql = "UPDATE " + self.schema + ".worker SET active=false, locked_until=NULL, task_count=%s WHERE id=%s"
+            cur.execute(sql, (task_count, id))
+        if id in self.session_locks:
+            del self.session_locks[id]
+            try:
+                with self.session_conn.cursor() as cur:
+                    cur.execute("SELECT pg_advisory_unlock(hashtext(%s), %s)", (self.schema + '.worker', id))
+            except Exception:
+                self.close_session()
+                raise
+
+    def lock_worker_session(self, id, group_id:int, node_name:str, task_count:int, task_limit:int=None) -> bool:
+        try:
+            if self.session_conn is None:
+                self.session_conn = self.connect()
+            with self.session_conn.cursor() as cur:
+                if id not in self.session_locks:
+                    cur.execute("SELECT pg_try_advisory_lock(hashtext(%s), %s)", (self.schema + '.worker', id))
+                    if not cur.fetchone()[0]:
+                        return False
+                    self.session_locks[id] = None
+                elif task_count is None or self.session_locks[id] == (group_id, node_name, task_count, task_limit):
+                    # the session is alive, nothing to write
+                    cur.execute("SELECT 1")
+                    return True
+                if task_count is not None:
+                    sql = "INSERT INTO " + self.schema + """.worker AS w(id, active, locked_until, group_id, node_name, task_count, task_limit)
+                        VALUES(%s, true, NULL, %s, %s, %s, %s)
+                        ON CONFLICT (id) DO UPDATE
+                        SET active=true, locked_until=NULL, group_id=EXCLUDED.group_id, node_name=EXCLUDED.node_name,
+                            task_count=EXCLUDED.task_count, task_limit=EXCLUDED.task_limit
+                        WHERE (w.active, w.locked_until, w.group_id, w.node_name, w.task_count, w.task_limit)
+                        IS DISTINCT FROM (true, NULL::timestamp, EXCLUDED.group_id, EXCLUDED.node_name, EXCLUDED.task_count, EXCLUDED.task_limit)"""
+                    cur.execute(sql, (id, group_id, node_name, task_count, task_limit))
+                    self.session_locks[id] = (group_id, node_name, task_count, task_limit)
+            return True
+        except Exception:
+            self.close_session()
+            raise
+
+    def select_dead_workers(self, cls) -> list:
+        with self.conn.cursor() as cur:
+            # pg_try_advisory_lock(int, int) lock is shown as classid, objid and objsubid = 2
+            sql = """
+                SELECT id,""" + ','.join(cls.table_fields) + """
+                FROM """ + cls.table_name + """ w
+                WHERE active AND NOT EXISTS (
+                    SELECT 1 FROM pg_locks l
+                    WHERE l.locktype = 'advisory' AND l.granted AND l.objsubid = 2
+                    AND l.database = (SELECT oid FROM pg_database WHERE datname = current_database())
+                    AND l.classid = hashtext(%s)::oid AND l.objid = w.id::oid
+                )"""
+            cur.execute(sql, (self.schema + '.worker',))
+            return self.fetch_states(cls, cur)
+
+    def select_expired_workers(self, cls, delay:timedelta) -> list:
+        with self.conn.cursor() as cur:
+            # worker_expired_idx
+            sql = """
+                SELECT id,""" + ','.join(cls.table_fields) + """
+                FROM """ + cls.table_name + """
+                WHERE active AND (locked_until IS NULL OR locked_until < now() - %s)"""
+            cur.execute(sql, (delay,))
+            return self.fetch_states(cls, cur)
+
+    def try_lead(self, key:str) -> bool:
+        try:
+            if self.lead_conn is None:
+                self.lead_conn = self.connect()
+                self.leading = False
+            with self.lead_conn.cursor() as cur:
+                if self.leading:
+                    # the session lock is held while the connection is alive
+                    cur.execute("SELECT 1")
+                    return True
+                # the follower retries on the same connection
+                cur.execute("SELECT pg_try_advisory_lock(hashtext(%s))", (key,))
+                self.leading = cur.fetchone()[0]
+                return self.leading
+        except Exception:
+            if self.lead_conn is not None:
+                self.lead_conn.close()
+                self.lead_conn = None
+            self.leading = False
+            raise
+
+    def register_worker(self, id):
+        with self.conn.cursor() as cur:
+            cur.execute("INSERT INTO " + self.schema + ".worker(id) VALUES(%s)", [id])
+
+    def recover_worker_tasks(self, worker_id):
+        with self.conn.cursor() as cur:
+            sql = "SELECT " + self.schema + ".recover_worker_tasks(%s)"
+            cur.execute(sql, (worker_id,))
+
+    def start_tasks(self, cls, group_id:int, worker_id, count:int, cpu_units:int=None, mem_units:int=None) -> list:
+        with self.conn.cursor() as cur:
+            # claim the whole batch in one call
+            sql = "SELECT command, cwd, cpu_units, mem_units, id, " + ','.join(cls.table_fields) + ", \
+                extract(epoch from now() - queued) as queue_wait \
+                FROM " + self.schema + ".start_tasks(%s,%s,%s,%s,%s)"
+            cur.execute(sql, (group_id, worker_id, count, cpu_units, mem_units))
+            row_class = cls.row_class
+            return [(row_class(*row[4:-1]), row[0], row[1], row[-1], (row[2], row[3])) for row in cur.fetchall()]
+
+    def advance_schedule(self, cls, id, next_start:datetime, new_next_start:datetime) -> bool:
+        with self.conn.cursor() as cur:
+            sql = "UPDATE " + cls.table_name + " SET next_start=%s WHERE id=%s AND next_start IS NOT DISTINCT FROM %s"
+            cur.execute(sql, (new_next_start, id, next_start))
+            return cur.rowcount > 0
+
+    def sched_start(self, id):
+        with self.conn.cursor() as cur:
+            sql = "SELECT " + self.schema + ".sched_start(%s)"
+            cur.execute(sql, (id,))
+            return cur.fetchone()[0]
+
+    def sched_fire_due(self, group_id:int, limit:int, spread:timedelta=None, rate:float=None, burst:float=None) -> list:
+        with self.conn.cursor() as cur:
+            sql = "SELECT id, new_task_id, next_start FROM " + self.schema + ".sched_fire_due(%s,%s,%s,%s,%s)"
+            cur.execute(sql, (group_id, limit, spread, rate, burst))
+            return cur.fetchall()
+
+    def next_sched_time(self, group_id:int, spread:timedelta=None) -> datetime:
+        with self.conn.cursor() as cur:
+            # task_sched_due_idx: the jitter is below spread, so the earliest fire is within spread of the earliest next_start
+            sql = """
+                SELECT min(t.next_start + {0}.sched_jitter(t.id, t.next_start, {0}.shed_interval(t.shed_period_id, t.shed_period_count), %(spread)s))
+                FROM {0}.task t
+                WHERE t.group_id = %(group_id)s AND t.shed_enabled AND NOT t.cleanup_pending
+                AND t.next_start <= (
+                    SELECT min(f.next_start) FROM {0}.task f
+                    WHERE f.group_id = %(group_id)s AND f.shed_enabled AND NOT f.cleanup_pending AND f.next_start IS NOT NULL
+                ) + coalesce(%(spread)s, interval '0')""".format(self.schema)
+            cur.execute(sql, {'group_id': group_id, 'spread': spread})
+            return cur.fetchone()[0]
+
+    def sched_admit(self, group_id:int, count:int, rate:float, burst:float) -> int:
+        with self.conn.cursor() as cur:
+            cur.execute("SELECT " + self.schema + ".sched_admit(%s,%s,%s,%s)", (group_id, count, rate, burst))
+            return cur.fetchone()[0]
+
+    def write_task_log(self, writer):
+        with self.conn.cursor() as cur:
+            writer.flush(cur)
+
+    def listen(self, channels:list):
+        conn = self.connect()
+        with conn.cursor() as cur:
+            for channel in channels:
+                cur.execute('LISTEN "' + channel + '"')
+        return PgListener(conn)
+
+class MemoryListener:
+
+    def __init__(self, storage, channels:list):
+        self.storage = storage
+        self.channels = set(channels)
+        self.notifies = []
+        self.r, self.w = os.pipe()
+        os.set_blocking(self.r, False)
+        self.closed = False
+
+    def fileno(self):
+        return self.r
+
+    def notify(self, channel:str, payload:str):
+        if channel in self.channels:
+            if len(self.notifies) == 0:
+                os.write(self.w, b'\0')
+            self.notifies.append((channel, payload))
+
+    def poll(self) -> list:
+        try:
+            os.read(self.r, 4096)
+        except BlockingIOError:
+            pass
+        res = self.notifies
+        self.notifies = []
+        return res
+
+    def close(self):
+        self.storage.listeners.remove(self)
+        os.close(self.r)
+        os.close(self.w)
+        self.closed = True
+
+class MemoryChunkCursor:
+
+    def __init__(self, storage, cls, ids:list, chunk_size:int):
+        self.storage = storage
+        self.cls = cls
+        self.ids = ids
+        self.pos = 0
+        self.chunk_size = chunk_size
+
+    def fetch(self) -> list:
+        ids = self.ids[self.pos:self.pos + self.chunk_size]
+        self.pos += len(ids)
+        if len(ids) == 0:
+            return []
+        self.storage.statements += 1
+        table = self.storage.tasks
+        return [self.storage.state(self.cls, table[id]) for id in ids if id in table]
+
+    def close(self):
+        self.ids = None
+
+class MemoryStorage(Storage):
+    """
+    The tables and the functions of the long_task schema with their triggers and notifications.
+    AW tasks are kept in a heap per group ordered as task_waiting_idx, so a claim
+    doesn`t depend on the number of the tasks
+    """
+
+    TASK_NOTIFY_FIELDS = ('state_id', 'next_start', 'shed_period_id', 'shed_period_count', 'shed_clone', 'group_id')
+    WORKER_NOTIFY_FIELDS = ('active', 'locked_until', 'stop')
+
+    def __init__(self, schema:str, notify_fields:dict=None):
+        self.schema = schema
+        self.tasks = {}
+        self.workers = {}
+        self.waiting = {} # group_id -> heap of (priority, last_state_change, id)
+        self.next_id = itertools.count(1)
+        self.listeners = []
+        self.notify_fields = notify_fields # table name -> fields carried by the notification payload
+        self.statements = 0 # requests made, one per method call as with the DB
+        self.sessions = set() # worker ids locked by the sessions of the other (simulated) nodes
+        self.session_locks = set() # worker ids locked by the node
+        self.buckets = {} # group_id -> [tokens, refilled_at] (sched_bucket)
+        self.concurrency_limit = {} # concurrency_key -> max executing
+        self.concurrency_usage = {} # limited concurrency_key -> executing
+
+    def table(self, cls) -> dict:
+        return self.tasks if cls.table_name == self.schema + '.task' else self.workers
+
+    def now(self) -> datetime:
+        return datetime.now()
+
+    # notifications
+
+    def listen(self, channels:list):
+        listener = MemoryListener(self, channels)
+        self.listeners.append(listener)
+        return listener
+
+    def notify(self, table_name:str, channel:str, op:str, row:dict):
+        payload = op + ' ' + str(row['id'])
+        if op != 'D' and self.notify_fields is not None:
+            fields = self.notify_fields.get(table_name)
+            if fields is not None:
+                payload += ' ' + json.dumps({n: row.get(n) for n in fields}, default=json_default)
+        for listener in self.listeners:
+            listener.notify(channel, payload)
+
+    def task_changed(self, row:dict, op:str='U'):
+        self.notify(self.schema + '.task', '!' + self.schema + '.task.' + str(row['group_id']), op, row)
+
+    def worker_changed(self, row:dict, op:str='U'):
+        self.notify(self.schema + '.worker', '!' + self.schema + '.worker', op, row)
+
+    # task rows with the triggers
+
+    def insert_task(self, command:list, group_id:int=0, state_id:str='AW', priority:int=0, **values) -> int:
+        if state_id not in ('AW', 'DR'):
+            raise Exception('Can`t create task in the state except DR or AW')
+        now = self.now()
+        row = {
+            'id': next(self.next_id), 'params': None, 'state_id': state_id, 'priority': priority,
+            'group_id': group_id, 'worker_id': None, 'error': None, 'command': list(command), 'cwd': None,
+            'started': None, 'last_state_change': now, 'created': now, 'next_start': None,
+            'shed_period_id': None, 'shed_period_count': None, 'shed_clone': False, 'shed_parent_id': None,
+            'shed_enabled': True, 'cleanup_pending': False, 'queued': now if state_id == 'AW' else None,
+            'concurrency_key': None, 'cpu_units': 1, 'mem_units': 0,
+        }
+        row.update(values)
+        self.tasks[row['id']] = row
+        if state_id == 'AW':
+            self.push_waiting(row)
+        self.task_changed(row, 'I')
+        return row['id']
+
+    def push_waiting(self, row:dict):
+        heap = self.waiting.get(row['group_id'])
+        if heap is None:
+            heap = []
+            self.waiting[row['group_id']] = heap
+        heapq.heappush(heap, (row['priority'], row['last_state_change'], row['id']))
+
+    def update_task(self, row:dict, values:dict):
+        old_state = row['state_id']
+        new_state = values.get('state_id', old_state)
+        # task_aiud_tr
+        if new_state == 'AC' and old_state not in ('AE', 'AW', 'AC'):
+            raise Exception('Can`t cancel inactive task')
+        if 'worker_id' in values and old_state in ('AE', 'AC') and new_state.startswith('A') \
+        and row['worker_id'] is not None and row['worker_id'] != values['worker_id']:
+            raise Exception('Can`t change worker_id for active task ' + str(row['id']))
+        notify = any(n in values and values[n] != row[n] for n in self.TASK_NOTIFY_FIELDS)
+        old_group = row['group_id']
+        old_key = row['concurrency_key']
+        row.update(values)
+        # task_concurrency_tr: concurrency_usage of the limited keys
+        if old_state in ('AE', 'AC') and old_key in self.concurrency_usage \
+        and (new_state not in ('AE', 'AC') or row['concurrency_key'] != old_key):
+            self.concurrency_usage[old_key] -= 1
+        if new_state in ('AE', 'AC') and row['concurrency_key'] in self.concurrency_usage \
+        and (old_state not in ('AE', 'AC') or row['concurrency_key'] != old_key):
+            self.concurrency_usage[row['concurrency_key']] += 1
+        # task_state_changed_tr
+        if new_state != old_state:
+            row['last_state_change'] = self.now()
+            if new_state == 'AW':
+                row['error'] = None
+                row['queued'] = row['last_state_change']
+        if row['state_id'] == 'AW' and (new_state != old_state or row['group_id'] != old_group):
+            self.push_waiting(row)
+        if notify:
+            self.task_changed(row)
+
+    def delete_task(self, id):
+        row = self.tasks.pop(id, None)
+        if row is not None:
+            if row['state_id'] in ('AE', 'AC') and row['concurrency_key'] in self.concurrency_usage:
+                self.concurrency_usage[row['concurrency_key']] -= 1
+            self.task_changed(row, 'D')
+
+    def set_concurrency_limit(self, key:str, max_count:int):
+        """
+        The concurrency_limit row of the key, max_count None - deleted (concurrency_limit_aiud_tr)
+        """
+        if max_count is None:
+            self.concurrency_limit.pop(key, None)
+            self.concurrency_usage.pop(key, None)
+            return
+        if key not in self.concurrency_limit:
+            self.concurrency_usage[key] = sum(1 for row in self.tasks.values() \
+                if row['concurrency_key'] == key and row['state_id'] in ('AE', 'AC'))
+        self.concurrency_limit[key] = max_count
+
+    def update_worker(self, row:dict, values:dict):
+        notify = any(n in values and values[n] != row[n] for n in self.WORKER_NOTIFY_FIELDS)
+        row.update(values)
+        if notify:
+            self.worker_changed(row)
+
+    # Storage
+
+    def state(self, cls, row:dict):
+        return cls.row_class(row['id'], *[row.get(n) for n in cls.table_fields])
+
+    def select(self, cls, ids:list=None) -> list:
+        self.statements += 1
+        table = self.table(cls)
+        if ids is None:
+            return [self.state(cls, row) for row in table.values()]
+        return [self.state(cls, table[id]) for id in ids if id in table]
+
+    def open_tasks_cursor(self, cls, group_id:int, ids:list, chunk_size:int):
+        self.statements += 1
+        hour = self.now() + timedelta(hours=1)
+        ids = set(ids)
+        found = [row['id'] for row in self.tasks.values() \
+            if (row['group_id'] == group_id and (row['state_id'].startswith('A') \
+                or (row['next_start'] is not None and row['next_start'] < hour))) \
+            or row['id'] in ids]
+        return MemoryChunkCursor(self, cls, found, chunk_size)
+
+    def select_changed(self, requests:dict) -> dict:
+        if any(len(ids) > 0 for ids in requests.values()):
+            self.statements += 1
+        res = {}
+        for cls, ids in requests.items():
+            table = self.table(cls)
+            res[cls] = [self.state(cls, table[id]) for id in ids if id in table]
+        return res
+
+    def update_row(self, cls, id, values:dict, version) -> bool:
+        row = self.table(cls).get(id)
+        if row is None:
+            return False
+        if cls.version_field_name is not None and row[cls.version_field_name] != version:
+            return False
+        if row is self.tasks.get(id):
+            self.update_task(row, values)
+        else:
+            self.update_worker(row, values)
+        return True
+
+    def update(self, cls, id, values:dict, version) -> bool:
+        self.statements += 1
+        return self.update_row(cls, id, values, version)
+
+    def update_many(self, cls, fields:list, records:list) -> set:
+        self.statements += 1
+        saved = set()
+        for r in records:
+            if self.update_row(cls, r['id'], {n: r[n] for n in fields}, r.get(cls.version_field_name)):
+                saved.add(r['id'])
+        return saved
+
+    def lock_worker(self, id, group_id:int, node_name:str, task_count:int, lock_until:datetime, prev_locked_until:datetime, task_limit:int=None) -> datetime:
+        self.statements += 1
+        row = self.workers.get(id)
+        if row is None:
+            row = {'id': id, 'active': True, 'locked_until': lock_until, 'task_count': task_count, \
+                'group_id': group_id, 'stop': 0, 'node_name': node_name, 'task_limit': task_limit}
+            self.workers[id] = row
+            self.worker_changed(row, 'I')
+            return None
+        t = row['locked_until']
+        if t is None or t < self.now():
+            self.update_worker(row, {'locked_until': lock_until, 'task_count': task_count, 'task_limit': task_limit, \
+                'group_id': group_id, 'active': True, 'node_name': node_name})
+            return None
+        if prev_locked_until is not None and prev_locked_until == t:
+            self.update_worker(row, {'locked_until': lock_until, 'task_count': task_count, 'task_limit': task_limit, \
+                'group_id': group_id, 'node_name': node_name})
+            return None
+        return t
+
+    def unlock_worker(self, id, task_count:int):
+        self.statements += 1
+        row = self.workers.get(id)
+        if row is not None:
+            self.update_worker(row, {'active': False, 'locked_until': None, 'task_count': task_count})
+        self.session_locks.discard(id)
+
+    def lock_worker_session(self, id, group_id:int, node_name:str, task_count:int, task_limit:int=None) -> bool:
+        self.statements += 1
+        if id in self.sessions:
+            return False
+        self.session_locks.add(id)
+        if task_count is not None:
+            values = {'active': True, 'locked_until': None, 'group_id': group_id, 'node_name': node_name, \
+                'task_count': task_count, 'task_limit': task_limit}
+            row = self.workers.get(id)
+            if row is None:
+                row = {'id': id, 'stop': 0}
+                row.update(values)
+                self.workers[id] = row
+                self.worker_changed(row, 'I')
+            elif any(row.get(n) != v for n, v in values.items()):
+                self.update_worker(row, values)
+        return True
+
+    def select_dead_workers(self, cls) -> list:
+        self.statements += 1
+        return [self.state(cls, row) for row in self.workers.values() \
+            if row['active'] and row['id'] not in self.sessions and row['id'] not in self.session_locks]
+
+    def select_expired_workers(self, cls, delay:timedelta) -> list:
+        self.statements += 1
+        t = self.now() - delay
+        return [self.state(cls, row) for row in self.workers.values() \
+            if row['active'] and (row['locked_until'] is None or row['locked_until'] < t)]
+
+    def try_lead(self, key:str) -> bool:
+        # the only node of the process
+        return True
+
+    def register_worker(self, id):
+        self.statements += 1
+        if id in self.workers:
+            raise Exception('duplicate key value violates unique constraint "worker_pkey"')
+        row = {'id': id, 'active': False, 'locked_until': None, 'task_count': None, 'group_id': None, 'stop': 0, 'node_name': None}
+        self.workers[id] = row
+        self.worker_changed(row, 'I')
+
+    def recover_worker_tasks(self, worker_id):
+        self.statements += 1
+        for row in list(self.tasks.values()):
+            if row['worker_id'] == worker_id and row['state_id'] == 'AE':
+                self.update_task(row, {'state_id': 'CF', 'error': 'Worker failed'})
+
+    def start_tasks(self, cls, group_id:int, worker_id, count:int, cpu_units:int=None, mem_units:int=None) -> list:
+        self.statements += 1
+        taken_cpu = taken_mem = 0
+        heap = self.waiting.get(group_id)
+        res = []
+        skipped = []
+        batch = 0 # the candidates locked by the DB (LIMIT count)
+        claimed_keys = {} # concurrency_key -> claimed by the call
+        now = self.now()
+        while heap and batch < count:
+            priority, last_state_change, id = heapq.heappop(heap)
+            row = self.tasks.get(id)
+            # the entry is outdated if the task changed since it was queued
+            if row is None or row['state_id'] != 'AW' or row['group_id'] != group_id \
+            or row['priority'] != priority or row['last_state_change'] != last_state_change:
+                continue
+            if row['worker_id'] is not None and row['worker_id'] != worker_id:
+                skipped.append((priority, last_state_change, id))
+                continue
+            key = row['concurrency_key']
+            limited = key is not None and key in self.concurrency_limit
+            # not a candidate: bigger than the free units or the key at the limit before the call
+            if (cpu_units is not None and row['cpu_units'] > cpu_units) \
+            or (mem_units is not None and row['mem_units'] > mem_units) \
+            or (limited and self.concurrency_usage.get(key, 0) - claimed_keys.get(key, 0) >= self.concurrency_limit[key]):
+                skipped.append((priority, last_state_change, id))
+                continue
+            batch += 1
+            # a candidate not fitting into the units left or the limit left
+            if (cpu_units is not None and taken_cpu + row['cpu_units'] > cpu_units) \
+            or (mem_units is not None and taken_mem + row['mem_units'] > mem_units) \
+            or (limited and self.concurrency_usage.get(key, 0) >= self.concurrency_limit[key]):
+                skipped.append((priority, last_state_change, id))
+                continue
+            if limited:
+                claimed_keys[key] = claimed_keys.get(key, 0) + 1
+            queued = row['queued']
+            self.update_task(row, {'state_id': 'AE', 'worker_id': worker_id, 'started': now, 'error': None})
+            taken_cpu += row['cpu_units']
+            taken_mem += row['mem_units']
+            res.append((self.state(cls, row), row['command'], row['cwd'], \
+                (now - queued).total_seconds() if queued is not None else None, (row['cpu_units'], row['mem_units'])))
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+        res.sort(key=lambda r: (self.tasks[r[0].id]['priority'], r[0].id))
+        return res
+
+    def advance_schedule(self, cls, id, next_start:datetime, new_next_start:datetime) -> bool:
+        self.statements += 1
+        row = self.tasks.get(id)
+        if row is None or row['next_start'] != next_start:
+            return False
+        self.update_task(row, {'next_start': new_next_start})
+        return True
+
+    def sched_start(self, id):
+        self.statements += 1
+        row = self.tasks.get(id)
+        if row is None:
+            return None
+        if row['shed_clone']:
+            return self.insert_task(row['command'], row['group_id'], 'AW', row['priority'], \
+                params=row['params'], cwd=row['cwd'], shed_parent_id=id, concurrency_key=row['concurrency_key'], \
+                cpu_units=row['cpu_units'], mem_units=row['mem_units'])
+        if row['state_id'].startswith('C'):
+            self.update_task(row, {'state_id': 'AW', 'worker_id': None})
+            return id
+        return None
+
+    def fire_time(self, row:dict, spread:timedelta) -> datetime:
+        return row['next_start'] + sched_jitter(row['id'], row['next_start'], \
+            shed_interval(row['shed_period_id'], row['shed_period_count']), spread)
+
+    def sched_fire_due(self, group_id:int, limit:int, spread:timedelta=None, rate:float=None, burst:float=None) -> list:
+        granted = self.sched_admit(group_id, limit, rate, burst)
+        now = self.now()
+        due = sorted((row for row in self.tasks.values() \
+            if row['group_id'] == group_id and row['next_start'] is not None and row['next_start'] <= now \
+            and row['shed_enabled'] and not row['cleanup_pending'] and self.fire_time(row, spread) <= now), \
+            key=lambda row: row['next_start'])
+        res = []
+        for row in due[:max(granted, 0)]:
+            interval = shed_interval(row['shed_period_id'], row['shed_period_count'])
+            next_start = add_period_until(row['next_start'], now, interval) + interval if interval is not None else None
+            self.update_task(row, {'next_start': next_start})
+            self.statements -= 1 # a part of the call
+            res.append((row['id'], self.sched_start(row['id']), next_start))
+        if len(res) < granted:
+            self.sched_admit(group_id, len(res) - granted, rate, burst)
+            self.statements -= 1
+        return res
+
+    def next_sched_time(self, group_id:int, spread:timedelta=None) -> datetime:
+        self.statements += 1
+        return min((self.fire_time(row, spread) for row in self.tasks.values() \
+            if row['group_id'] == group_id and row['next_start'] is not None \
+            and row['shed_enabled'] and not row['cleanup_pending']), default=None)
+
+    def sched_admit(self, group_id:int, count:int, rate:float, burst:float) -> int:
+        self.statements += 1
+        if rate is None:
+            return count
+        now = self.now()
+        bucket = self.buckets.setdefault(group_id, [burst, now])
+        tokens = min(burst, bucket[0] + max(0, (now - bucket[1]).total_seconds()) * rate)
+        granted = count if count < 0 else min(count, int(tokens))
+        bucket[0] = min(burst, tokens - granted)
+        bucket[1] = now
+        return granted
+
+    def write_task_log(self, writer):
+        # the output is dropped
+        with writer.lock:
+            writer.chunks = {}
+            writer.pending = 0
+            writer.first_time = None
@@ -0,0 +1,93 @@
+# This code is under MIT licence, you can find the complete file here: https://github.com/ivanovrvl/pg_tasks/blob/main/LICENSE
+import io
+import time
+import threading
+
+class TaskLogWriter:
+    """
+    Collects the output of the running tasks and writes it into the task_log table
+    with one COPY for all the tasks: when flush_bytes are collected or flush_interval
+    has passed since the oldest piece.
+    The data is kept until written, so when the DB is slow or unavailable it is piling up:
+    is_full() tells to stop reading the pipes until the flush (the processes block on write).
+    write() may be called from a thread other than the flush() one.
+    """
+
+    def __init__(self, table_name:str, flush_bytes:int, flush_interval:float, max_pending:int, encoding:str='cp866'):
+        self.table_name = table_name
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.encoding = encoding
+        self.chunks = {} # task id -> [bytes]
+        self.pending = 0 # bytes not written yet (including being written)
+        self.first_time = None # time.monotonic() of the oldest piece
+        self.retry_time = None # time.monotonic() to retry the failed write
+        self.lock = threading.Lock()
+
+    def write(self, task_id, data:bytes):
+        with self.lock:
+            chunks = self.chunks.get(task_id)
+            if chunks is None:
+                chunks = []
+                self.chunks[task_id] = chunks
+            chunks.append(data)
+            self.pending += len(data)
+            if self.first_time is None:
+                self.first_time = time.monotonic()
+
+    def is_full(self) -> bool:
+        return self.pending >= self.max_pending
+
+    def time_to_flush(self) -> float:
+        """
+        Seconds to the next flush, None if there is nothing to write
+        """
+        with self.lock:
+            if self.first_time is None:
+                return None
+            if self.retry_time is not None:
+                dt = self.retry_time - time.monotonic()
+            elif self.pending >= self.flush_bytes:
+                return 0
+            else:
+                dt = self.first_time + self.flush_interval - time.monotonic()
+            return dt if dt > 0 else 0
+
+    def escape(self, data:bytes) -> str:
+        # COPY text format
+        return data.decode(self.encoding, 'replace') \
+            .replace('\\', '\\\\').replace('\0', '\n') \
+            .replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+    def flush(self, cur):
+        with self.lock:
+            chunks = self.chunks
+            if len(chunks) == 0:
+                return
+            self.chunks = {}
+            self.first_time = None
+        size = 0
+        buf = io.StringIO()
+        for task_id, data in chunks.items():
+            data = b''.join(data)
+            size += len(data)
+            buf.write(str(task_id))
+            buf.write('\t')
+            buf.write(self.escape(data))
+            buf.write('\n')
+        buf.seek(0)
+        try:
+            cur.copy_expert('COPY ' + self.table_name + '(task_id, data) FROM STDIN', buf)
+        except:
+            with self.lock:
+                # back in front of the pieces written meanwhile, retried after flush_interval
+                for task_id, data in chunks.items():
+                    data.extend(self.chunks.get(task_id, []))
+                    self.chunks[task_id] = data
+                self.first_time = time.monotonic()
+                self.retry_time = self.first_time + self.flush_interval
+            raise
+        with self.lock:
+            self.pending -= size
+            self.retry_time = None